@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+Benchmark Plaid sync throughput offline against the local Plaid stand-in
+"""
+import argparse
+import os
+import time
+import django
+
+# Setup Django
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'budget_bot.settings')
+# runs offline in one process, so it doesn't need the redis the shared cache defaults to
+os.environ.setdefault('CACHE_URL', 'locmemcache://')
+django.setup()
+
+from django.contrib.auth.models import User
+from core.models import PlaidToken
+from core.services.plaid import PlaidService
+from core.services.plaid_standin import FakePlaidClient, ReplayPlaidClient, LATENCY_PROFILES
+
+
+def timed(label, func, rows):
+    start = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - start
+    rate = rows / elapsed if elapsed else float('inf')
+    print(f"  {label:<22} {elapsed:8.3f}s  {rate:10.0f} rows/s  {result}")
+    return result
+
+
+def run_benchmark(transactions, accounts, latency, fixture=None):
+    """Run backfill, full sync and delta sync against the stand-in"""
+    print(f"⏱  Plaid sync benchmark - {transactions} transactions, {accounts} accounts, latency={latency}")
+    if fixture:
+        client = ReplayPlaidClient.from_fixture(fixture, latency=latency)
+    else:
+        client = FakePlaidClient(accounts=accounts, transactions=transactions, latency=latency)
+
+    # throwaway user so the benchmark never touches real data
+    user = User.objects.create_user(username=f'bench-{int(time.time() * 1000)}')
+    try:
+        plaid_token = PlaidToken.objects.create(user=user, access_token='access-local', item_id=f'bench-{user.id}')
+        service = PlaidService(client=client)
+
+        timed('accounts', lambda: len(service.sync_accounts(user, 'access-local', plaid_item=plaid_token)), accounts)
+        if fixture:
+            timed('incremental sync', lambda: service.run_incremental_sync(plaid_token), transactions)
+            return
+
+        timed('backfill (parallel)', lambda: service.backfill_transactions(user, 'access-local'), transactions)
+        timed('incremental sync', lambda: service.run_incremental_sync(plaid_token), transactions)
+
+        # steady state: a small delta on top of the full history
+        client.add_transactions(25)
+        client.modify_transactions(10)
+        client.remove_transactions(5)
+        timed('delta sync', lambda: service.run_incremental_sync(plaid_token), 40)
+        print(f"  plaid calls: {dict(client.calls)}")
+    finally:
+        user.delete()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--transactions', type=int, default=5000)
+    parser.add_argument('--accounts', type=int, default=3)
+    parser.add_argument('--latency', choices=sorted(LATENCY_PROFILES), default='fast')
+    parser.add_argument('--fixture', help='replay responses recorded with PlaidRecorder instead of generating data')
+    args = parser.parse_args()
+    run_benchmark(args.transactions, args.accounts, args.latency, args.fixture)
@@ -150,10 +150,43 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 # plaid banking integration configuration
 PLAID_CLIENT_ID = env('PLAID_CLIENT_ID', default='')  # plaid client id from dashboard
 PLAID_SECRET = env('PLAID_SECRET', default='')  # plaid secret key
-PLAID_ENV = 'sandbox'  # environment: sandbox, development, production
+PLAID_ENV = env('PLAID_ENV', default='sandbox')  # environment: sandbox, development, production, or local for the offline stand-in
+PLAID_WEBHOOK_URL = env('PLAID_WEBHOOK_URL', default='')  # public url of /plaid/webhook/ given to plaid link; empty leaves new history to the scheduler
+PLAID_POOL_MAXSIZE = env.int('PLAID_POOL_MAXSIZE', default=10)  # keep-alive connections per plaid client
+PLAID_CONNECT_TIMEOUT = env.float('PLAID_CONNECT_TIMEOUT', default=5.0)  # seconds to open a connection
+PLAID_READ_TIMEOUT = env.float('PLAID_READ_TIMEOUT', default=30.0)  # seconds to wait for a plaid response
+PLAID_WEBHOOK_DEBOUNCE_SECONDS = env.int('PLAID_WEBHOOK_DEBOUNCE_SECONDS', default=10)  # window that collapses webhook bursts per item
+PLAID_SYNC_LOCK_TIMEOUT = env.int('PLAID_SYNC_LOCK_TIMEOUT', default=300)  # max seconds one item sync may hold its lock
+PLAID_USER_SYNC_CONCURRENCY = env.int('PLAID_USER_SYNC_CONCURRENCY', default=3)  # items synced in parallel for one user
+PLAID_BALANCE_TTL_SECONDS = env.int('PLAID_BALANCE_TTL_SECONDS', default=900)  # reuse stored balances this long before paying for /accounts/balance/get
+PLAID_SCHEDULED_SYNC_INTERVAL = env.int('PLAID_SCHEDULED_SYNC_INTERVAL', default=6 * 3600)  # seconds between background refreshes of an item
+PLAID_SYNC_JITTER_SECONDS = env.int('PLAID_SYNC_JITTER_SECONDS', default=900)  # spreads item refreshes so they don't fire together
+PLAID_SYNC_MAX_BACKOFF_SECONDS = env.int('PLAID_SYNC_MAX_BACKOFF_SECONDS', default=24 * 3600)  # ceiling for failing items' backoff
+PLAID_MAX_CONCURRENT_SYNCS = env.int('PLAID_MAX_CONCURRENT_SYNCS', default=8)  # background item syncs in flight across all workers
+PLAID_MAX_CONCURRENT_SYNCS_PER_INSTITUTION = env.int('PLAID_MAX_CONCURRENT_SYNCS_PER_INSTITUTION', default=2)  # same, per bank
+PLAID_SCHEDULER_BATCH_SIZE = env.int('PLAID_SCHEDULER_BATCH_SIZE', default=200)  # items dispatched per scheduler tick
 
 # anthropic claude ai configuration
 ANTHROPIC_API_KEY = env('ANTHROPIC_API_KEY', default='')  # claude api key for chat feature
+ANTHROPIC_TIMEOUT = env.float('ANTHROPIC_TIMEOUT', default=60.0)  # seconds before a claude request is abandoned
+ANTHROPIC_MAX_CONNECTIONS = env.int('ANTHROPIC_MAX_CONNECTIONS', default=200)  # pooled connections shared by all chats in a process
+LLM_CONTEXT_CACHE_SECONDS = env.int('LLM_CONTEXT_CACHE_SECONDS', default=3600)  # how long a user's serialized context is kept per version
+LLM_HISTORY_TOKEN_BUDGET = env.int('LLM_HISTORY_TOKEN_BUDGET', default=2000)  # recent conversation turns sent with each question
+LLM_SUMMARY_MAX_TOKENS = env.int('LLM_SUMMARY_MAX_TOKENS', default=400)  # length cap for the rolling summary of older turns
+LLM_RESPONSE_CACHE_SIZE = env.int('LLM_RESPONSE_CACHE_SIZE', default=1000)  # replies kept per process for repeated questions
+LLM_RESPONSE_CACHE_SECONDS = env.int('LLM_RESPONSE_CACHE_SECONDS', default=900)  # how long a cached reply is served
+LLM_DAILY_TOKEN_LIMIT = env.int('LLM_DAILY_TOKEN_LIMIT', default=250000)  # billable claude tokens per user per day
+LLM_DAILY_REQUEST_LIMIT = env.int('LLM_DAILY_REQUEST_LIMIT', default=300)  # claude calls per user per day
+LLM_USER_MAX_IN_FLIGHT = env.int('LLM_USER_MAX_IN_FLIGHT', default=2)  # concurrent generations one user may hold
+LLM_MAX_IN_FLIGHT = env.int('LLM_MAX_IN_FLIGHT', default=100)  # concurrent generations across all users
+LLM_ADMISSION_WAIT_SECONDS = env.float('LLM_ADMISSION_WAIT_SECONDS', default=10.0)  # how long a request queues for a slot before it's rejected
+LLM_CHAT_DISPATCH = env('LLM_CHAT_DISPATCH', default='inline')  # inline streams replies from the asgi process, celery hands them to chat workers
+LLM_CHAT_QUEUE = env('LLM_CHAT_QUEUE', default='chat')  # celery queue dedicated to chat generation
+LLM_CONVERSATION_MAX_QUEUED = env.int('LLM_CONVERSATION_MAX_QUEUED', default=3)  # generations queued or running per conversation
+LLM_CHAT_TASK_EXPIRES = env.int('LLM_CHAT_TASK_EXPIRES', default=120)  # seconds a queued generation waits before it's dropped
+CHAT_REPLAY_BUFFER_SIZE = env.int('CHAT_REPLAY_BUFFER_SIZE', default=50)  # recent messages per conversation kept for reconnecting sockets
+CHAT_REPLAY_BUFFER_SECONDS = env.int('CHAT_REPLAY_BUFFER_SECONDS', default=3600)  # how long a quiet conversation's buffer is kept
+CHAT_REPLAY_MAX_MESSAGES = env.int('CHAT_REPLAY_MAX_MESSAGES', default=100)  # past this many missed messages the client reloads instead
 
 # Login/Logout URLs
 LOGIN_URL = '/admin/login/'
@@ -172,13 +205,43 @@ REST_FRAMEWORK = {
     'PAGE_SIZE': 20
 }
 
-# channels configuration for websockets
-CHANNEL_LAYERS = {
-    'default': {
-        'BACKEND': 'channels.layers.InMemoryChannelLayer',
-    },
+# shared cache for sync locks, coalescing, llm slots and chat markers; web, daphne and celery processes
+# must all see the same one, so it defaults to the redis instance celery already needs. the offline
+# plaid stand-in runs as a single process without redis, so it gets a local-memory cache instead
+CACHES = {
+    'default': env.cache('CACHE_URL', default='locmemcache://' if PLAID_ENV == 'local' else 'rediscache://localhost:6379/1'),
 }
 
+# tests run against a private local-memory cache instead of redis
+TEST_RUNNER = 'budget_bot.test_runner.TestRunner'
+
+# channels configuration for websockets; point CHANNEL_REDIS_URL at redis so every daphne process and celery worker share one layer
+CHANNEL_REDIS_URL = env('CHANNEL_REDIS_URL', default='')
+CHANNEL_LAYER_CAPACITY = env.int('CHANNEL_LAYER_CAPACITY', default=1000)  # messages buffered per channel before sends fail; a streamed reply is one per delta
+CHANNEL_LAYER_EXPIRY = env.int('CHANNEL_LAYER_EXPIRY', default=30)  # seconds an undelivered message waits for its consumer
+CHANNEL_LAYER_GROUP_EXPIRY = env.int('CHANNEL_LAYER_GROUP_EXPIRY', default=6 * 3600)  # seconds a connection stays in a chat group after its process dies
+
+if CHANNEL_REDIS_URL:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels_redis.core.RedisChannelLayer',
+            'CONFIG': {
+                'hosts': [CHANNEL_REDIS_URL],
+                'prefix': 'budget_bot',
+                'capacity': CHANNEL_LAYER_CAPACITY,
+                'expiry': CHANNEL_LAYER_EXPIRY,
+                'group_expiry': CHANNEL_LAYER_GROUP_EXPIRY,
+            },
+        },
+    }
+else:
+    # single process only: group_send from celery never reaches browsers
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels.layers.InMemoryChannelLayer',
+        },
+    }
+
 # celery configuration for background tasks
 CELERY_BROKER_URL = 'redis://localhost:6379/0'
 CELERY_RESULT_BACKEND = 'redis://localhost:6379/0'
@@ -186,3 +249,16 @@ CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TIMEZONE = TIME_ZONE
+
+# chat generation gets its own queue so long replies never wait behind plaid syncs
+CELERY_TASK_ROUTES = {
+    'core.tasks.process_chat_message_async': {'queue': LLM_CHAT_QUEUE},
+}
+
+# periodic tasks run by celery beat
+CELERY_BEAT_SCHEDULE = {
+    'schedule-plaid-syncs': {
+        'task': 'core.tasks.schedule_plaid_syncs',
+        'schedule': 60.0,  # dispatch due items every minute
+    },
+}
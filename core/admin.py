@@ -1,13 +1,13 @@
 from django.contrib import admin
-from .models import PlaidToken, Account, Transaction, ChatMessage
+from .models import PlaidToken, Account, Transaction, Category, Merchant, SpendingRollup, LLMUsageRecord, LLMDailyUsage, ChatMessage
 
 
 @admin.register(PlaidToken)
 class PlaidTokenAdmin(admin.ModelAdmin):
-    list_display = ['user', 'item_id', 'created_at', 'updated_at']
+    list_display = ['user', 'item_id', 'institution_id', 'last_synced_at', 'next_sync_at', 'sync_failures', 'balances_refreshed_at']
     list_filter = ['created_at', 'updated_at']
-    search_fields = ['user__username', 'item_id']
-    readonly_fields = ['access_token', 'created_at', 'updated_at']
+    search_fields = ['user__username', 'item_id', 'institution_id']
+    readonly_fields = ['access_token', 'balances_refreshed_at', 'last_synced_at', 'last_sync_error', 'created_at', 'updated_at']
     
     def get_queryset(self, request):
         return super().get_queryset(request).select_related('user')
@@ -26,12 +26,35 @@ class AccountAdmin(admin.ModelAdmin):
     is_plaid_connected.short_description = 'Plaid Connected'
 
 
+@admin.register(Category)
+class CategoryAdmin(admin.ModelAdmin):
+    list_display = ['path', 'name', 'parent']
+    search_fields = ['path']
+    readonly_fields = ['path']
+
+
+@admin.register(Merchant)
+class MerchantAdmin(admin.ModelAdmin):
+    list_display = ['name', 'normalized_name']
+    search_fields = ['name', 'normalized_name']
+    readonly_fields = ['normalized_name']
+
+
+@admin.register(SpendingRollup)
+class SpendingRollupAdmin(admin.ModelAdmin):
+    list_display = ['user', 'month', 'dimension', 'key', 'income', 'spend', 'transaction_count']
+    list_filter = ['dimension', 'month']
+    search_fields = ['user__username']
+    list_select_related = ['user']
+
+
 @admin.register(Transaction)
 class TransactionAdmin(admin.ModelAdmin):
-    list_display = ['description', 'amount', 'date', 'account', 'is_plaid_transaction']
+    list_display = ['description', 'amount', 'date', 'account', 'merchant', 'category_ref', 'is_plaid_transaction']
     list_filter = ['date', 'account__account_type']
     search_fields = ['description', 'account__user__username', 'plaid_transaction_id']
     readonly_fields = ['plaid_transaction_id', 'created_at', 'updated_at']
+    list_select_related = ['account', 'merchant', 'category_ref']
     date_hierarchy = 'date'
     
     def is_plaid_transaction(self, obj):
@@ -40,6 +63,26 @@ class TransactionAdmin(admin.ModelAdmin):
     is_plaid_transaction.short_description = 'Plaid Transaction'
 
 
+@admin.register(LLMDailyUsage)
+class LLMDailyUsageAdmin(admin.ModelAdmin):
+    list_display = ['user', 'day', 'requests', 'input_tokens', 'output_tokens', 'cache_creation_input_tokens', 'cache_read_input_tokens', 'billable_tokens']
+    list_filter = ['day']
+    search_fields = ['user__username']
+    date_hierarchy = 'day'
+    list_select_related = ['user']
+    readonly_fields = ['user', 'day', 'requests', 'input_tokens', 'output_tokens', 'cache_creation_input_tokens', 'cache_read_input_tokens']
+
+
+@admin.register(LLMUsageRecord)
+class LLMUsageRecordAdmin(admin.ModelAdmin):
+    list_display = ['user', 'kind', 'model', 'input_tokens', 'output_tokens', 'cache_creation_input_tokens', 'cache_read_input_tokens', 'created_at']
+    list_filter = ['kind', 'model', 'created_at']
+    search_fields = ['user__username']
+    date_hierarchy = 'created_at'
+    list_select_related = ['user']
+    readonly_fields = ['user', 'kind', 'model', 'input_tokens', 'output_tokens', 'cache_creation_input_tokens', 'cache_read_input_tokens', 'created_at']
+
+
 @admin.register(ChatMessage)
 class ChatMessageAdmin(admin.ModelAdmin):
     list_display = ['user', 'question_preview', 'created_at']
@@ -14,6 +14,9 @@ from .serializers import (
     MessageCreateSerializer
 )
 from .services.llm import LLMService
+from .services.history import conversation_window, record_message
+from .services.chat_replay import remember_message
+from .services.llm_quota import QuotaExceeded, AdmissionRejected
 
 
 # list user's conversations or create new conversation
@@ -26,7 +29,8 @@ class ConversationListCreateView(generics.ListCreateAPIView):
         return ConversationSerializer
     
     def get_queryset(self):
-        return Conversation.objects.filter(user=self.request.user)
+        # the list reads counters and previews from the row itself, so the summary text isn't needed
+        return Conversation.objects.filter(user=self.request.user).defer('summary')
     
     def perform_create(self, serializer):
         # create conversation with auto-generated title
@@ -63,13 +67,19 @@ def send_message(request, conversation_id):
             role='user',
             content=serializer.validated_data['content']
         )
+        record_message(user_message)
+        # reconnecting chat sockets replay from this buffer, so rest messages belong in it too
+        remember_message(user_message)
         
         # get ai response
         try:
             llm_service = LLMService()
-            ai_response = llm_service.get_response(
-                message=user_message.content,
-                user=request.user
+            # earlier turns (and the rolling summary) so follow-up questions keep their context
+            history = conversation_window(conversation.id, before=user_message.id)
+            ai_response = llm_service.get_financial_advice(
+                user_message.content,
+                request.user,
+                history=history
             )
             
             # save ai response
@@ -79,15 +89,22 @@ def send_message(request, conversation_id):
                 content=ai_response
             )
             
-            # update conversation timestamp
-            conversation.updated_at = timezone.now()
-            conversation.save()
+            # update conversation timestamp and list preview
+            record_message(ai_message)
+            remember_message(ai_message)
             
             return Response({
                 'user_message': MessageSerializer(user_message).data,
                 'ai_message': MessageSerializer(ai_message).data
             })
             
+        except (QuotaExceeded, AdmissionRejected) as e:
+            return Response(
+                {'error': str(e), 'retry_after': e.retry_after},
+                status=status.HTTP_429_TOO_MANY_REQUESTS,
+                headers={'Retry-After': str(e.retry_after)}
+            )
+
         except Exception as e:
             return Response(
                 {'error': f'Failed to get AI response: {str(e)}'}, 
@@ -5,3 +5,7 @@ class CoreConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'core'
     verbose_name = 'Financial Core'
+
+    def ready(self):
+        # connect cache invalidation signals
+        from . import signals  # noqa: F401
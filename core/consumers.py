@@ -1,10 +1,23 @@
 # websocket consumer for real-time chat functionality
+import asyncio
 import json
-from channels.generic.websocket import AsyncWebsocketConsumer
+import uuid
+from urllib.parse import parse_qs
+from asgiref.sync import sync_to_async
 from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncWebsocketConsumer
+from django.conf import settings
 from django.contrib.auth.models import User
 from .models import Conversation, Message
-from .services.llm import LLMService
+from .services.llm import AsyncLLMService
+from .services.history import aconversation_window, record_message
+from .services.llm_quota import QuotaExceeded, AdmissionRejected
+from .services.chat_dispatch import ConversationBusy, astart_generation
+from .services.chat_replay import missed_messages, remember_message
+from .tasks import process_chat_message_async
+
+# seconds of streamed text collected into one group message for the conversation's other tabs
+STREAM_BROADCAST_SECONDS = 0.25
 
 
 class ChatConsumer(AsyncWebsocketConsumer):
@@ -12,19 +25,50 @@ class ChatConsumer(AsyncWebsocketConsumer):
         self.conversation_id = self.scope['url_route']['kwargs']['conversation_id']
         self.room_group_name = f'chat_{self.conversation_id}'
         self.user = self.scope['user']
+        self.conversation = None
+        self.generation = None  # inline reply currently streaming to this socket
+        self.closed = False
 
         # only accept if user is authenticated
         if self.user.is_authenticated:
+            self.conversation = await self.get_conversation()
+
+        if self.conversation:
             # join room group
             await self.channel_layer.group_add(
                 self.room_group_name,
                 self.channel_name
             )
             await self.accept()
+            # a reconnecting client says which message it saw last and gets only what it missed
+            last_seen = self.last_seen()
+            if last_seen is not None:
+                await self.replay_missed(last_seen)
         else:
             await self.close()
 
+    def last_seen(self):
+        query = parse_qs(self.scope.get('query_string', b'').decode())
+        try:
+            return int(query['last_seen'][0])
+        except (KeyError, ValueError):
+            return None
+
+    async def replay_missed(self, last_seen):
+        missed = await database_sync_to_async(missed_messages)(self.conversation.id, last_seen)
+        await self.send(text_data=json.dumps({
+            'type': 'chat_replay',
+            'messages': missed or [],
+            'reset': missed is None  # too far behind: reload the conversation instead
+        }))
+
+    # ownership is checked once at connect, so messages can be saved without re-reading the conversation
+    async def get_conversation(self):
+        return await Conversation.objects.filter(id=self.conversation_id, user=self.user).only('id').afirst()
+
     async def disconnect(self, close_code):
+        # an inline reply keeps going for the other tabs and the replay buffer
+        self.closed = True
         # leave room group
         await self.channel_layer.group_discard(
             self.room_group_name,
@@ -37,75 +81,228 @@ class ChatConsumer(AsyncWebsocketConsumer):
         message = text_data_json['message']
 
         if self.user.is_authenticated:
+            generation_id = None
+            if settings.LLM_CHAT_DISPATCH == 'celery':
+                # take a queue slot first, so a busy conversation isn't left with a turn that never gets a reply
+                try:
+                    generation_id = await astart_generation(self.conversation_id)
+                except ConversationBusy as e:
+                    await self.chat_message({
+                        'message': str(e),
+                        'role': 'assistant',
+                        'error': True,
+                        'retry_after': e.retry_after
+                    })
+                    return
+
             # save user message to database
-            user_message = await self.save_message(self.user, message, 'user')
+            user_message = await self.save_message(message, 'user')
             
-            # send user message to room group
+            # echo to this socket directly so it comes before the reply's deltas, then to the other tabs
+            event = {
+                'type': 'chat_message',
+                'message': message,
+                'role': 'user',
+                'seq': user_message.id,
+                'message_id': user_message.id,
+                'timestamp': user_message.timestamp.isoformat()
+            }
+            await self.chat_message(event)
+            await self.channel_layer.group_send(self.room_group_name, dict(event, origin=self.channel_name))
+
+            if generation_id:
+                # a chat worker generates the reply, so this process is free as soon as it's queued
+                await self.dispatch_generation(generation_id, user_message.id)
+                return
+
+            # generate in a task so this consumer keeps draining its channel while the reply streams
+            if self.generation and not self.generation.done():
+                self.generation.cancel()  # a newer message supersedes the reply in progress
+            self.generation = asyncio.create_task(self.generate_reply(message, user_message.id))
+
+    async def generate_reply(self, message, user_message_id):
+        stream_id = uuid.uuid4().hex
+        try:
+            ai_response = await self.stream_response(message, stream_id, before=user_message_id)
+
+            # save the complete ai response once streaming finishes
+            ai_message = await self.save_message(ai_response, 'assistant')
+
+            # send final message so clients can replace the streamed draft
+            await self.channel_layer.group_send(
+                self.room_group_name,
+                {
+                    'type': 'chat_done',
+                    'stream_id': stream_id,
+                    'message': ai_response,
+                    'role': 'assistant',
+                    'seq': ai_message.id,
+                    'message_id': ai_message.id,
+                    'timestamp': ai_message.timestamp.isoformat()
+                }
+            )
+
+        except asyncio.CancelledError:
+            await self.channel_layer.group_send(
+                self.room_group_name,
+                {'type': 'chat_cancelled', 'stream_id': stream_id}
+            )
+            raise
+
+        except (QuotaExceeded, AdmissionRejected) as e:
+            # over quota or no free generation slot: tell the user when to retry
             await self.channel_layer.group_send(
                 self.room_group_name,
                 {
                     'type': 'chat_message',
-                    'message': message,
-                    'role': 'user',
-                    'message_id': user_message.id,
-                    'timestamp': user_message.timestamp.isoformat()
+                    'message': str(e),
+                    'role': 'assistant',
+                    'error': True,
+                    'retry_after': e.retry_after
                 }
             )
 
-            # get ai response
-            try:
-                llm_service = LLMService()
-                ai_response = await database_sync_to_async(llm_service.get_response)(
-                    message=message,
-                    user=self.user
-                )
-
-                # save ai response to database
-                ai_message = await self.save_message(self.user, ai_response, 'assistant')
-
-                # send ai response to room group
-                await self.channel_layer.group_send(
-                    self.room_group_name,
-                    {
-                        'type': 'chat_message',
-                        'message': ai_response,
-                        'role': 'assistant',
-                        'message_id': ai_message.id,
-                        'timestamp': ai_message.timestamp.isoformat()
-                    }
-                )
-
-            except Exception as e:
-                # send error message
-                await self.channel_layer.group_send(
-                    self.room_group_name,
-                    {
-                        'type': 'chat_message',
-                        'message': f'Sorry, I encountered an error: {str(e)}',
-                        'role': 'assistant',
-                        'error': True
-                    }
-                )
+        except Exception as e:
+            # send error message
+            await self.channel_layer.group_send(
+                self.room_group_name,
+                {
+                    'type': 'chat_message',
+                    'message': f'Sorry, I encountered an error: {str(e)}',
+                    'role': 'assistant',
+                    'error': True
+                }
+            )
+
+    # queues the generation that holds the conversation's newest slot; any earlier one is now stale
+    async def dispatch_generation(self, generation_id, user_message_id):
+        stream_id = uuid.uuid4().hex
+        # publishing to the broker blocks, so keep it off the event loop
+        await sync_to_async(process_chat_message_async.apply_async, thread_sensitive=False)(
+            args=[self.conversation.id, self.user.id, user_message_id, generation_id, stream_id],
+            expires=settings.LLM_CHAT_TASK_EXPIRES
+        )
+        return stream_id
+
+    # writes claude text deltas straight to this socket and batches them for the conversation's other tabs
+    async def stream_response(self, message, stream_id, before=None):
+        history = await aconversation_window(self.conversation_id, before=before)
+        loop = asyncio.get_running_loop()
+        parts = []
+        pending = []
+        flushed_at = loop.time()
+
+        # awaits the api and the orm directly, so slow generations don't occupy the sync thread pool
+        async for delta in AsyncLLMService().astream_financial_advice(message, self.user, history=history):
+            parts.append(delta)
+            pending.append(delta)
+            if not self.closed:
+                await self.chat_delta({'stream_id': stream_id, 'delta': delta, 'role': 'assistant'})
+            if loop.time() - flushed_at >= STREAM_BROADCAST_SECONDS:
+                await self.broadcast_deltas(stream_id, pending)
+                pending = []
+                flushed_at = loop.time()
+
+        if pending:
+            await self.broadcast_deltas(stream_id, pending)
+        return ''.join(parts)
+
+    # one group message per batch keeps long replies inside the channel layer's capacity
+    async def broadcast_deltas(self, stream_id, deltas):
+        await self.channel_layer.group_send(
+            self.room_group_name,
+            {
+                'type': 'chat_delta',
+                'stream_id': stream_id,
+                'delta': ''.join(deltas),
+                'role': 'assistant',
+                'origin': self.channel_name  # this socket already has them
+            }
+        )
 
     # receive message from room group
     async def chat_message(self, event):
+        if event.get('origin') == self.channel_name:
+            return
         # send message to websocket
         await self.send(text_data=json.dumps({
             'message': event['message'],
             'role': event['role'],
+            'seq': event.get('seq'),
             'message_id': event.get('message_id'),
             'timestamp': event.get('timestamp'),
-            'error': event.get('error', False)
+            'error': event.get('error', False),
+            'retry_after': event.get('retry_after')
+        }))
+
+    # receive streamed text delta from room group
+    async def chat_delta(self, event):
+        if event.get('origin') == self.channel_name:
+            return
+        await self.send(text_data=json.dumps({
+            'type': 'chat_delta',
+            'stream_id': event['stream_id'],
+            'delta': event['delta'],
+            'role': event['role']
         }))
 
+    # receive notice that a stale generation was dropped before it finished
+    async def chat_cancelled(self, event):
+        await self.send(text_data=json.dumps({
+            'type': 'chat_cancelled',
+            'stream_id': event['stream_id']
+        }))
+
+    # receive end of stream with the persisted message
+    async def chat_done(self, event):
+        await self.send(text_data=json.dumps({
+            'type': 'chat_done',
+            'stream_id': event['stream_id'],
+            'message': event['message'],
+            'role': event['role'],
+            'seq': event['seq'],
+            'message_id': event['message_id'],
+            'timestamp': event['timestamp']
+        }))
+
+    # one insert plus a targeted conversation update, in a single trip to the database thread
     @database_sync_to_async
-    def save_message(self, user, content, role):
-        conversation = Conversation.objects.get(id=self.conversation_id, user=user)
+    def save_message(self, content, role):
         message = Message.objects.create(
-            conversation=conversation,
+            conversation=self.conversation,
             role=role,
             content=content
         )
-        # Update conversation timestamp
-        conversation.save()
-        return message
\ No newline at end of file
+        record_message(message)
+        remember_message(message)
+        return message
+
+
+# pushes plaid sync pipeline progress to the user's dashboard
+class SyncProgressConsumer(AsyncWebsocketConsumer):
+    async def connect(self):
+        self.user = self.scope['user']
+
+        # only accept if user is authenticated
+        if self.user.is_authenticated:
+            self.group_name = f'sync_{self.user.id}'
+            await self.channel_layer.group_add(
+                self.group_name,
+                self.channel_name
+            )
+            await self.accept()
+        else:
+            self.group_name = None
+            await self.close()
+
+    async def disconnect(self, close_code):
+        if self.group_name:
+            await self.channel_layer.group_discard(
+                self.group_name,
+                self.channel_name
+            )
+
+    # receive progress event from celery tasks
+    async def sync_progress(self, event):
+        payload = {key: value for key, value in event.items() if key != 'type'}
+        await self.send(text_data=json.dumps(payload))
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:08
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0004_conversation_message'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='account',
+            name='plaid_item',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='accounts', to='core.plaidtoken'),
+        ),
+        migrations.AlterField(
+            model_name='plaidtoken',
+            name='item_id',
+            field=models.CharField(blank=True, max_length=128, null=True, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='plaidtoken',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='plaid_tokens', to=settings.AUTH_USER_MODEL),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_plaidtoken_multiple_items'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='plaidtoken',
+            name='balance_ttl_seconds',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='plaidtoken',
+            name='balances_refreshed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
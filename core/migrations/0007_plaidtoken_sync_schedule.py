@@ -0,0 +1,38 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_plaidtoken_balance_ttl'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='plaidtoken',
+            name='institution_id',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='plaidtoken',
+            name='last_sync_error',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddField(
+            model_name='plaidtoken',
+            name='last_synced_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='plaidtoken',
+            name='next_sync_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='plaidtoken',
+            name='sync_failures',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,49 @@
+from django.db import migrations
+
+BATCH_SIZE = 2000
+
+
+def backfill_categories(apps, schema_editor):
+    Category = apps.get_model('core', 'Category')
+    Transaction = apps.get_model('core', 'Transaction')
+    category_ids = {}
+
+    def intern(value):
+        parts = [part.strip()[:100] for part in value.split(',') if part.strip()]
+        parent_id = None
+        for depth in range(1, len(parts) + 1):
+            path = ', '.join(parts[:depth])[:255]
+            if path not in category_ids:
+                category_ids[path] = Category.objects.get_or_create(
+                    path=path,
+                    defaults={'name': parts[depth - 1], 'parent_id': parent_id}
+                )[0].id
+            parent_id = category_ids[path]
+        return parent_id
+
+    # walk the table in primary key batches so large tables never load at once
+    pending = Transaction.objects.filter(category_ref__isnull=True).exclude(category__isnull=True).exclude(category='')
+    last_pk = 0
+    while True:
+        rows = list(pending.filter(pk__gt=last_pk).order_by('pk').values_list('pk', 'category')[:BATCH_SIZE])
+        if not rows:
+            break
+        by_category = {}
+        for pk, value in rows:
+            category_id = intern(value)
+            if category_id:
+                by_category.setdefault(category_id, []).append(pk)
+        for category_id, pks in by_category.items():
+            Transaction.objects.filter(pk__in=pks).update(category_ref_id=category_id)
+        last_pk = rows[-1][0]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_category'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_categories, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,49 @@
+from django.db import migrations
+
+from core.services.merchants import normalize_merchant_name
+
+BATCH_SIZE = 2000
+
+
+def backfill_merchants(apps, schema_editor):
+    Merchant = apps.get_model('core', 'Merchant')
+    Transaction = apps.get_model('core', 'Transaction')
+    merchant_ids = {}
+
+    def intern(raw_name, display_name):
+        key = normalize_merchant_name(raw_name)
+        if not key:
+            return None
+        if key not in merchant_ids:
+            merchant_ids[key] = Merchant.objects.get_or_create(
+                normalized_name=key,
+                defaults={'name': (display_name or key.title())[:255]}
+            )[0].id
+        return merchant_ids[key]
+
+    # walk the table in primary key batches so large tables never load at once
+    pending = Transaction.objects.filter(merchant__isnull=True)
+    last_pk = 0
+    while True:
+        rows = list(pending.filter(pk__gt=last_pk).order_by('pk').values_list('pk', 'merchant_name', 'description')[:BATCH_SIZE])
+        if not rows:
+            break
+        by_merchant = {}
+        for pk, merchant_name, description in rows:
+            merchant_id = intern(merchant_name or description, merchant_name)
+            if merchant_id:
+                by_merchant.setdefault(merchant_id, []).append(pk)
+        for merchant_id, pks in by_merchant.items():
+            Transaction.objects.filter(pk__in=pks).update(merchant_id=merchant_id)
+        last_pk = rows[-1][0]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_merchant'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_merchants, migrations.RunPython.noop),
+    ]
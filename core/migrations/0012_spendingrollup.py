@@ -0,0 +1,34 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:21
+
+import django.db.models.deletion
+from decimal import Decimal
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_backfill_transaction_merchant'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SpendingRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField()),
+                ('dimension', models.CharField(choices=[('total', 'Total'), ('category', 'Category'), ('merchant', 'Merchant')], max_length=10)),
+                ('key', models.PositiveIntegerField(default=0)),
+                ('income', models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=14)),
+                ('spend', models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=14)),
+                ('transaction_count', models.IntegerField(default=0)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='spending_rollups', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-month', 'dimension', '-spend'],
+                'constraints': [models.UniqueConstraint(fields=('user', 'month', 'dimension', 'key'), name='unique_spending_rollup')],
+            },
+        ),
+    ]
@@ -0,0 +1,49 @@
+from decimal import Decimal
+from django.db import migrations
+from django.db.models import Count, DecimalField, Q, Sum, Value
+from django.db.models.functions import Coalesce, TruncMonth
+
+ZERO = Decimal('0.00')
+
+
+def backfill_rollups(apps, schema_editor):
+    SpendingRollup = apps.get_model('core', 'SpendingRollup')
+    Transaction = apps.get_model('core', 'Transaction')
+    money = DecimalField(max_digits=14, decimal_places=2)
+
+    # one grouped query per dimension covers every user at once
+    monthly = Transaction.objects.annotate(month=TruncMonth('date'))
+    for dimension, field in (('total', None), ('category', 'category_ref_id'), ('merchant', 'merchant_id')):
+        columns = ['account__user_id', 'month'] + ([field] if field else [])
+        rows = [
+            SpendingRollup(
+                user_id=row['account__user_id'],
+                month=row['month'],
+                dimension=dimension,
+                key=(row[field] or 0) if field else 0,
+                income=row['income'],
+                spend=row['spend'],
+                transaction_count=row['transaction_count'],
+            )
+            for row in monthly.values(*columns).annotate(
+                income=Coalesce(Sum('amount', filter=Q(amount__gt=0)), Value(ZERO), output_field=money),
+                spend=Coalesce(-Sum('amount', filter=Q(amount__lt=0)), Value(ZERO), output_field=money),
+                transaction_count=Count('id'),
+            ).order_by()
+        ]
+        SpendingRollup.objects.bulk_create(rows, batch_size=2000)
+
+
+def clear_rollups(apps, schema_editor):
+    apps.get_model('core', 'SpendingRollup').objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0012_spendingrollup'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_rollups, clear_rollups),
+    ]
@@ -0,0 +1,38 @@
+from django.db import migrations
+from django.db.models import Case, CharField, Count, IntegerField, OuterRef, Subquery, Value, When
+from django.db.models.functions import Coalesce, Concat, Length, Substr
+
+
+def backfill_counters(apps, schema_editor):
+    Conversation = apps.get_model('core', 'Conversation')
+    Message = apps.get_model('core', 'Message')
+
+    # correlated subqueries fill every conversation in one update
+    messages = Message.objects.filter(conversation=OuterRef('pk'))
+    latest = messages.order_by('-timestamp', '-id')
+    preview = Case(
+        When(length__gt=100, then=Concat(Substr('content', 1, 100), Value('...'))),
+        default='content',
+        output_field=CharField(),
+    )
+    Conversation.objects.update(
+        message_count=Coalesce(
+            Subquery(messages.order_by().values('conversation').annotate(total=Count('id')).values('total')),
+            Value(0),
+            output_field=IntegerField(),
+        ),
+        last_message_preview=Coalesce(Subquery(latest.annotate(length=Length('content'), preview=preview).values('preview')[:1]), Value('')),
+        last_message_role=Coalesce(Subquery(latest.values('role')[:1]), Value('')),
+        last_message_at=Subquery(latest.values('timestamp')[:1]),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0016_conversation_message_counters'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,31 @@
+from django.db import migrations
+from django.db.models import Count, OuterRef, Subquery
+
+
+def link_accounts(apps, schema_editor):
+    Account = apps.get_model('core', 'Account')
+    PlaidToken = apps.get_model('core', 'PlaidToken')
+
+    # before 0005 a user had at most one plaid token, so their plaid accounts all belong to it;
+    # users who have since linked more banks were linked as each item synced
+    single_item_users = (
+        PlaidToken.objects.values('user_id').annotate(items=Count('id')).filter(items=1).values('user_id')
+    )
+    Account.objects.filter(
+        plaid_item__isnull=True,
+        plaid_account_id__isnull=False,
+        user_id__in=single_item_users,
+    ).update(
+        plaid_item=Subquery(PlaidToken.objects.filter(user_id=OuterRef('user_id')).values('pk')[:1])
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0017_backfill_conversation_counters'),
+    ]
+
+    operations = [
+        migrations.RunPython(link_accounts, migrations.RunPython.noop),
+    ]
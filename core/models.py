@@ -1,20 +1,43 @@
 # django imports for database models and user authentication
 from django.db import models
 from django.contrib.auth.models import User
+from django.conf import settings
+from django.utils import timezone
+from datetime import timedelta
 from decimal import Decimal
 
 
-# stores plaid access tokens for each user
+# stores plaid access tokens - one per linked institution (plaid item)
 class PlaidToken(models.Model):
-    user = models.OneToOneField(User, on_delete=models.CASCADE)  # link to django user
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='plaid_tokens')  # a user can link several banks
     access_token = models.CharField(max_length=128)  # plaid access token
-    item_id = models.CharField(max_length=128, blank=True, null=True)  # plaid item id
+    item_id = models.CharField(max_length=128, blank=True, null=True, unique=True)  # plaid item id
+    institution_id = models.CharField(max_length=64, blank=True, null=True)  # bank behind the item, for per-institution rate limits
     cursor = models.CharField(max_length=255, blank=True, null=True)  # sync cursor for incremental updates
+    balances_refreshed_at = models.DateTimeField(blank=True, null=True)  # last real-time balance pull
+    balance_ttl_seconds = models.PositiveIntegerField(blank=True, null=True)  # per-item override of PLAID_BALANCE_TTL_SECONDS
+    next_sync_at = models.DateTimeField(blank=True, null=True, db_index=True)  # when the scheduler should refresh this item next
+    last_synced_at = models.DateTimeField(blank=True, null=True)  # last successful background sync
+    sync_failures = models.PositiveIntegerField(default=0)  # consecutive failed syncs, drives backoff
+    last_sync_error = models.TextField(blank=True, default='')  # most recent sync failure
     created_at = models.DateTimeField(auto_now_add=True)  # when token was created
     updated_at = models.DateTimeField(auto_now=True)  # when token was last updated
 
     def __str__(self):
-        return f"Plaid Token for {self.user.username}"
+        return f"Plaid Token for {self.user.username} ({self.item_id})"
+
+    @property
+    def balances_are_fresh(self):
+        # stored balances are served until the item's ttl runs out
+        if not self.balances_refreshed_at:
+            return False
+        ttl = self.balance_ttl_seconds if self.balance_ttl_seconds is not None else settings.PLAID_BALANCE_TTL_SECONDS
+        return timezone.now() - self.balances_refreshed_at < timedelta(seconds=ttl)
+
+    @property
+    def sync_key(self):
+        # identifies the item for sync locks; tokens saved before item_id was stored fall back to pk
+        return self.item_id or f'token-{self.pk}'
 
 
 # represents bank accounts - can be manual or from plaid
@@ -38,6 +61,7 @@ class Account(models.Model):
     
     # plaid specific fields (optional for manual accounts)
     plaid_account_id = models.CharField(max_length=255, blank=True, null=True, unique=True)  # plaid account identifier
+    plaid_item = models.ForeignKey(PlaidToken, on_delete=models.SET_NULL, null=True, blank=True, related_name='accounts')  # institution the account came from
     
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
@@ -53,14 +77,42 @@ class Account(models.Model):
         return bool(self.plaid_account_id)
 
 
+# spending category hierarchy from plaid, e.g. Food and Drink > Restaurants > Coffee Shop
+class Category(models.Model):
+    name = models.CharField(max_length=100)  # this level's label
+    parent = models.ForeignKey('self', on_delete=models.PROTECT, null=True, blank=True, related_name='children')  # broader category
+    path = models.CharField(max_length=255, unique=True)  # full hierarchy joined with ', ' (the legacy string form)
+
+    class Meta:
+        ordering = ['path']
+        verbose_name_plural = 'categories'
+
+    def __str__(self):
+        return self.path
+
+
+# canonical merchant that raw plaid merchant strings normalize to
+class Merchant(models.Model):
+    name = models.CharField(max_length=255)  # display name, first spelling we saw
+    normalized_name = models.CharField(max_length=255, unique=True)  # case-folded, store numbers and processor prefixes removed
+
+    class Meta:
+        ordering = ['name']
+
+    def __str__(self):
+        return self.name
+
+
 # individual financial transactions
 class Transaction(models.Model):
     account = models.ForeignKey(Account, on_delete=models.CASCADE)  # which account this transaction belongs to
     amount = models.DecimalField(max_digits=12, decimal_places=2)  # transaction amount (negative for expenses)
     description = models.CharField(max_length=500)  # what the transaction was for
     date = models.DateField()  # when transaction occurred
-    category = models.CharField(max_length=255, blank=True, null=True)  # spending category
+    category = models.CharField(max_length=255, blank=True, null=True)  # spending category as display text
+    category_ref = models.ForeignKey(Category, on_delete=models.SET_NULL, null=True, blank=True, related_name='transactions')  # normalized category for grouping
     merchant_name = models.CharField(max_length=255, blank=True, null=True)  # store or merchant name
+    merchant = models.ForeignKey(Merchant, on_delete=models.SET_NULL, null=True, blank=True, related_name='transactions')  # normalized merchant for grouping
     
     # plaid specific fields (optional for manual transactions)
     plaid_transaction_id = models.CharField(max_length=255, blank=True, null=True, unique=True)  # plaid transaction identifier
@@ -79,10 +131,99 @@ class Transaction(models.Model):
         return bool(self.plaid_transaction_id)
 
 
+# per-user monthly income and spend, kept in step with transaction writes for compact llm context
+class SpendingRollup(models.Model):
+    TOTAL = 'total'
+    CATEGORY = 'category'
+    MERCHANT = 'merchant'
+    DIMENSION_CHOICES = [
+        (TOTAL, 'Total'),
+        (CATEGORY, 'Category'),
+        (MERCHANT, 'Merchant'),
+    ]
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='spending_rollups')  # whose transactions these are
+    month = models.DateField()  # first day of the month
+    dimension = models.CharField(max_length=10, choices=DIMENSION_CHOICES)  # what the row is grouped by
+    key = models.PositiveIntegerField(default=0)  # category or merchant id, 0 for the monthly total or ungrouped rows
+    income = models.DecimalField(max_digits=14, decimal_places=2, default=Decimal('0.00'))  # sum of positive amounts
+    spend = models.DecimalField(max_digits=14, decimal_places=2, default=Decimal('0.00'))  # sum of expenses as a positive number
+    transaction_count = models.IntegerField(default=0)  # transactions folded into this row
+
+    class Meta:
+        ordering = ['-month', 'dimension', '-spend']
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'month', 'dimension', 'key'], name='unique_spending_rollup'),
+        ]
+
+    def __str__(self):
+        return f"{self.user.username} {self.month:%Y-%m} {self.dimension}:{self.key}"
+
+
+# one row per claude call, so spend can be audited per user
+class LLMUsageRecord(models.Model):
+    CHAT = 'chat'
+    SUMMARY = 'summary'
+    KIND_CHOICES = [
+        (CHAT, 'Chat reply'),
+        (SUMMARY, 'Conversation summary'),
+    ]
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='llm_usage_records')  # who the call was made for
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES, default=CHAT)  # what the call was for
+    model = models.CharField(max_length=100)  # claude model used
+    input_tokens = models.PositiveIntegerField(default=0)  # uncached prompt tokens
+    output_tokens = models.PositiveIntegerField(default=0)  # generated tokens
+    cache_creation_input_tokens = models.PositiveIntegerField(default=0)  # prompt tokens written to the prompt cache
+    cache_read_input_tokens = models.PositiveIntegerField(default=0)  # prompt tokens served from the prompt cache
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return f"{self.user.username} {self.kind} {self.created_at:%Y-%m-%d %H:%M}"
+
+
+# per-user daily totals that quotas are checked against
+class LLMDailyUsage(models.Model):
+    CACHE_READ_WEIGHT = Decimal('0.1')  # cache reads bill at a tenth of normal input
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='llm_daily_usage')
+    day = models.DateField()  # local date the calls were made
+    requests = models.PositiveIntegerField(default=0)  # chat replies made; summaries only add tokens
+    input_tokens = models.PositiveIntegerField(default=0)
+    output_tokens = models.PositiveIntegerField(default=0)
+    cache_creation_input_tokens = models.PositiveIntegerField(default=0)
+    cache_read_input_tokens = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        ordering = ['-day']
+        verbose_name_plural = 'LLM daily usage'
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'day'], name='unique_llm_daily_usage'),
+        ]
+
+    def __str__(self):
+        return f"{self.user.username} {self.day}"
+
+    @property
+    def billable_tokens(self):
+        # what the daily token quota is measured in
+        cached = int(self.cache_read_input_tokens * self.CACHE_READ_WEIGHT)
+        return self.input_tokens + self.cache_creation_input_tokens + self.output_tokens + cached
+
+
 # conversation containers for organizing chat history
 class Conversation(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)  # conversation owner
     title = models.CharField(max_length=200)  # conversation title
+    summary = models.TextField(blank=True, default='')  # rolling summary of turns older than the history window
+    summarized_through = models.ForeignKey('Message', on_delete=models.SET_NULL, null=True, blank=True, related_name='+')  # last message folded into the summary
+    message_count = models.PositiveIntegerField(default=0)  # kept in step as messages are saved, so lists don't count rows
+    last_message_preview = models.CharField(max_length=103, blank=True, default='')  # first 100 characters of the newest message
+    last_message_role = models.CharField(max_length=10, blank=True, default='')  # who sent the newest message
+    last_message_at = models.DateTimeField(null=True, blank=True)  # when the newest message was sent
     created_at = models.DateTimeField(auto_now_add=True)  # when conversation started
     updated_at = models.DateTimeField(auto_now=True)  # when last message was sent
 
@@ -4,4 +4,5 @@ from . import consumers
 
 websocket_urlpatterns = [
     re_path(r'ws/chat/(?P<conversation_id>\w+)/$', consumers.ChatConsumer.as_asgi()),
+    re_path(r'ws/sync/$', consumers.SyncProgressConsumer.as_asgi()),
 ]
\ No newline at end of file
@@ -14,36 +14,28 @@ class MessageSerializer(serializers.ModelSerializer):
 # serializer for conversation objects with nested messages
 class ConversationSerializer(serializers.ModelSerializer):
     messages = MessageSerializer(many=True, read_only=True)
-    message_count = serializers.SerializerMethodField()
     
     class Meta:
         model = Conversation
         fields = ['id', 'title', 'created_at', 'updated_at', 'messages', 'message_count']
-        read_only_fields = ['id', 'created_at', 'updated_at']
-    
-    def get_message_count(self, obj):
-        return obj.messages.count()
+        read_only_fields = ['id', 'created_at', 'updated_at', 'message_count']
 
 
 # simple serializer for conversation list view
 class ConversationListSerializer(serializers.ModelSerializer):
-    message_count = serializers.SerializerMethodField()
     last_message = serializers.SerializerMethodField()
     
     class Meta:
         model = Conversation
         fields = ['id', 'title', 'created_at', 'updated_at', 'message_count', 'last_message']
     
-    def get_message_count(self, obj):
-        return obj.messages.count()
-    
+    # read from the denormalized columns so a page of conversations is a single query
     def get_last_message(self, obj):
-        last_msg = obj.messages.last()
-        if last_msg:
+        if obj.last_message_at:
             return {
-                'content': last_msg.content[:100] + '...' if len(last_msg.content) > 100 else last_msg.content,
-                'role': last_msg.role,
-                'timestamp': last_msg.timestamp
+                'content': obj.last_message_preview,
+                'role': obj.last_message_role,
+                'timestamp': obj.last_message_at
             }
         return None
 
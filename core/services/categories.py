@@ -0,0 +1,51 @@
+# interning of plaid category hierarchies into the Category table
+from django.db import transaction
+import threading
+
+# path -> category id for every category this process has already resolved
+_category_ids = {}
+_category_lock = threading.Lock()
+
+
+# normalizes plaid's list (or a legacy comma-joined string) into hierarchy levels
+def category_parts(categories):
+    if not categories:
+        return []
+    if isinstance(categories, str):
+        categories = categories.split(',')
+    return [str(part).strip()[:100] for part in categories if str(part).strip()]
+
+
+# returns the id of the leaf category for a hierarchy, creating missing levels once
+def intern_category(categories):
+    from core.models import Category
+
+    parts = category_parts(categories)
+    if not parts:
+        return None
+    path = ', '.join(parts)
+    category_id = _category_ids.get(path)
+    if category_id is not None:
+        return category_id
+
+    with _category_lock:
+        parent_id = None
+        for depth in range(1, len(parts) + 1):
+            level_path = ', '.join(parts[:depth])
+            level_id = _category_ids.get(level_path)
+            if level_id is None:
+                category = Category.objects.get_or_create(
+                    path=level_path[:255],
+                    defaults={'name': parts[depth - 1], 'parent_id': parent_id}
+                )[0]
+                level_id = category.id
+                # only remember rows once they're committed, a rollback would leave a dangling id
+                transaction.on_commit(lambda key=level_path, value=level_id: _category_ids.setdefault(key, value))
+            parent_id = level_id
+    return parent_id
+
+
+# forgets interned ids (used in tests, where the table is rolled back between cases)
+def clear_category_cache():
+    with _category_lock:
+        _category_ids.clear()
@@ -0,0 +1,65 @@
+# bookkeeping for chat generations handed off to celery workers
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+import uuid
+
+# extra slot lifetime past the task's own deadlines, in case a worker dies mid-generation
+SLOT_TIMEOUT_MARGIN_SECONDS = 30
+
+
+# raised when a conversation already has the maximum number of generations queued or running
+class ConversationBusy(Exception):
+    def __init__(self, conversation_id, retry_after):
+        super().__init__("Still working on your earlier messages. Please wait a moment and try again.")
+        self.conversation_id = conversation_id
+        self.retry_after = retry_after
+
+
+def _current_key(conversation_id):
+    return f'chat:generation:{conversation_id}'
+
+
+def _slot_keys(conversation_id):
+    return [f'chat:queued:{conversation_id}:{index}' for index in range(settings.LLM_CONVERSATION_MAX_QUEUED)]
+
+
+# a queued generation holds its slot until the task finishes, expires, or the worker is gone
+def _slot_timeout():
+    return int(
+        settings.LLM_CHAT_TASK_EXPIRES + settings.LLM_ADMISSION_WAIT_SECONDS
+        + settings.ANTHROPIC_TIMEOUT + SLOT_TIMEOUT_MARGIN_SECONDS
+    )
+
+
+def _busy(conversation_id):
+    return ConversationBusy(conversation_id, retry_after=int(settings.ANTHROPIC_TIMEOUT // 4) or 1)
+
+
+# takes a queue slot for a new generation and makes it the conversation's current one
+def start_generation(conversation_id):
+    generation_id = uuid.uuid4().hex
+    for key in _slot_keys(conversation_id):
+        if cache.add(key, generation_id, timeout=_slot_timeout()):
+            break
+    else:
+        raise _busy(conversation_id)
+    # anything generated for an older message is now stale
+    cache.set(_current_key(conversation_id), generation_id, timeout=_slot_timeout())
+    return generation_id
+
+
+# cache calls stay off the event loop and off the shared sync thread the consumers' orm calls use
+astart_generation = sync_to_async(start_generation, thread_sensitive=False)
+
+
+# false once a newer message has been sent to the conversation; with no marker to compare, the reply goes ahead
+def is_current_generation(conversation_id, generation_id):
+    current = cache.get(_current_key(conversation_id))
+    return current is None or current == generation_id
+
+
+# frees the generation's queue slot; the current marker is left for the next message to replace
+def finish_generation(conversation_id, generation_id):
+    held = cache.get_many(_slot_keys(conversation_id))
+    cache.delete_many([key for key, owner in held.items() if owner == generation_id])
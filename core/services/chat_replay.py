@@ -0,0 +1,120 @@
+# short replay buffer so reconnecting chat sockets only fetch the messages they missed
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.cache.backends.redis import RedisCache
+import json
+import threading
+
+from core.models import Message
+
+# adds an event and trims the buffer in one atomic step, so writers never wait on each other.
+# the floor key holds the id below which the buffer may be incomplete; it starts just under the
+# first buffered message and rises as the oldest events are trimmed
+REMEMBER_SCRIPT = """
+local seq = tonumber(ARGV[1])
+local floor = tonumber(redis.call('GET', KEYS[2]) or (seq - 1))
+if seq <= floor then
+    return 0
+end
+redis.call('ZADD', KEYS[1], seq, ARGV[2])
+local overflow = redis.call('ZCARD', KEYS[1]) - tonumber(ARGV[3])
+if overflow > 0 then
+    local trimmed = redis.call('ZRANGE', KEYS[1], 0, overflow - 1, 'WITHSCORES')
+    floor = math.max(floor, tonumber(trimmed[#trimmed]))
+    redis.call('ZREMRANGEBYRANK', KEYS[1], 0, overflow - 1)
+end
+redis.call('SET', KEYS[2], floor, 'EX', ARGV[4])
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+return 1
+"""
+
+# caches other than redis are per process here (locmem in dev and tests), so a process lock is enough
+_local_lock = threading.Lock()
+
+
+def _buffer_key(conversation_id):
+    return f'chat:replay:{conversation_id}'
+
+
+def _floor_key(conversation_id):
+    return f'chat:replay-floor:{conversation_id}'
+
+
+# raw redis client and the backend's versioned key names, or None for other cache backends
+def _redis(conversation_id):
+    backend = caches['default']
+    if not isinstance(backend, RedisCache):
+        return None
+    key = backend.make_key(_buffer_key(conversation_id))
+    return backend._cache.get_client(key, write=True), key, backend.make_key(_floor_key(conversation_id))
+
+
+# message ids only grow, so they double as the conversation's event sequence
+def message_event(message):
+    return {
+        'seq': message.id,
+        'message_id': message.id,
+        'role': message.role,
+        'message': message.content,
+        'timestamp': message.timestamp.isoformat(),
+    }
+
+
+# appends a saved message; call it before broadcasting so a reconnect sees it either live or replayed
+def remember_message(message):
+    redis = _redis(message.conversation_id)
+    if redis:
+        client, key, floor_key = redis
+        client.register_script(REMEMBER_SCRIPT)(
+            keys=[key, floor_key],
+            args=[message.id, json.dumps(message_event(message)), settings.CHAT_REPLAY_BUFFER_SIZE, settings.CHAT_REPLAY_BUFFER_SECONDS],
+        )
+        return
+
+    key = _buffer_key(message.conversation_id)
+    with _local_lock:
+        # floor: every message of the conversation with a higher id is in the buffer
+        buffered = cache.get(key) or {'floor': message.id - 1, 'events': []}
+        if message.id <= buffered['floor']:
+            return
+        events = sorted(buffered['events'] + [message_event(message)], key=lambda event: event['seq'])
+        floor = buffered['floor']
+        if len(events) > settings.CHAT_REPLAY_BUFFER_SIZE:
+            floor = events[-settings.CHAT_REPLAY_BUFFER_SIZE - 1]['seq']
+            events = events[-settings.CHAT_REPLAY_BUFFER_SIZE:]
+        cache.set(key, {'floor': floor, 'events': events}, timeout=settings.CHAT_REPLAY_BUFFER_SECONDS)
+
+
+# buffered events after last_seen, or None when the buffer doesn't reach back that far
+def _buffered_since(conversation_id, last_seen):
+    redis = _redis(conversation_id)
+    if redis:
+        client, key, floor_key = redis
+        with client.pipeline() as pipe:
+            pipe.get(floor_key)
+            pipe.zrangebyscore(key, f'({last_seen}', '+inf')
+            floor, events = pipe.execute()
+        if floor is None or int(floor) > last_seen:
+            return None
+        return [json.loads(event) for event in events]
+
+    buffered = cache.get(_buffer_key(conversation_id))
+    if buffered and buffered['floor'] <= last_seen:
+        return [event for event in buffered['events'] if event['seq'] > last_seen]
+    return None
+
+
+# messages after last_seen, from the buffer when it reaches back far enough; None when too many were missed
+def missed_messages(conversation_id, last_seen):
+    buffered = _buffered_since(conversation_id, last_seen)
+    if buffered is not None:
+        return buffered
+
+    limit = settings.CHAT_REPLAY_MAX_MESSAGES
+    missed = list(
+        Message.objects.filter(conversation_id=conversation_id, id__gt=last_seen)
+        .order_by('id')[:limit + 1]
+    )
+    if len(missed) > limit:
+        return None  # cheaper for the client to reload the conversation
+    return [message_event(message) for message in missed]
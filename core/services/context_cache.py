@@ -0,0 +1,61 @@
+# per-user cache of the serialized llm financial context, invalidated by a version stamp
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+import time
+
+
+def _version_key(user_id):
+    return f'llm:context-version:{user_id}'
+
+
+def _context_key(user_id, version):
+    return f'llm:context:{user_id}:{version}'
+
+
+# current version stamp for a user's financial data
+def get_context_version(user_id):
+    version = cache.get(_version_key(user_id))
+    if version is None:
+        # nanosecond stamps never repeat, so a lost version key can't resurrect stale context
+        cache.add(_version_key(user_id), time.time_ns(), timeout=None)
+        version = cache.get(_version_key(user_id))
+    return version
+
+
+# moves the user to a new version; old context entries simply expire
+def bump_context_version(user_id):
+    cache.set(_version_key(user_id), time.time_ns(), timeout=None)
+
+
+# bumps after commit so readers never cache pre-commit data under the new version
+def invalidate_user_context(user_id):
+    transaction.on_commit(lambda: bump_context_version(user_id))
+
+
+# returns (version, context), building and storing the context on a miss
+def get_or_build_context(user_id, build):
+    version = get_context_version(user_id)
+    key = _context_key(user_id, version)
+    context = cache.get(key)
+    if context is None:
+        context = build()
+        cache.set(key, context, timeout=settings.LLM_CONTEXT_CACHE_SECONDS)
+    return version, context
+
+
+# django's cache backends only fake async by hopping onto the shared sync thread, so these
+# lookups run on the thread pool instead of queueing behind every consumer's orm calls
+aget_context_version = sync_to_async(get_context_version, thread_sensitive=False)
+
+
+# async twin of get_or_build_context; build is a coroutine function
+async def aget_or_build_context(user_id, build):
+    version = await aget_context_version(user_id)
+    key = _context_key(user_id, version)
+    context = await sync_to_async(cache.get, thread_sensitive=False)(key)
+    if context is None:
+        context = await build()
+        await sync_to_async(cache.set, thread_sensitive=False)(key, context, timeout=settings.LLM_CONTEXT_CACHE_SECONDS)
+    return version, context
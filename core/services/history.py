@@ -0,0 +1,166 @@
+# token-budgeted conversation history with a rolling summary of older turns
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import F
+
+# rough chars-per-token ratio for english text; good enough to size a budget without an api call
+CHARS_PER_TOKEN = 4
+# newest messages scanned when filling the window, so one query stays bounded
+HISTORY_SCAN_LIMIT = 200
+# older messages folded into the summary per llm call
+SUMMARY_BATCH_SIZE = 40
+# seconds a pending summary refresh suppresses further requests for the conversation
+SUMMARY_DEBOUNCE_SECONDS = 120
+# characters of the newest message shown in the conversation list
+PREVIEW_LENGTH = 100
+
+
+def message_preview(content):
+    return content[:PREVIEW_LENGTH] + '...' if len(content) > PREVIEW_LENGTH else content
+
+
+# one update keeps the conversation's counters and preview in step with a newly saved message
+def record_message(message):
+    from core.models import Conversation
+
+    Conversation.objects.filter(id=message.conversation_id).update(
+        updated_at=message.timestamp,
+        message_count=F('message_count') + 1,
+        last_message_preview=message_preview(message.content),
+        last_message_role=message.role,
+        last_message_at=message.timestamp,
+    )
+
+
+def estimate_tokens(text):
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+# anthropic wants alternating turns that start with the user and, before the new question, end with the assistant
+def _normalize_turns(turns):
+    merged = []
+    for turn in turns:
+        if merged and merged[-1]['role'] == turn['role']:
+            merged[-1]['content'] += f"\n\n{turn['content']}"
+        else:
+            merged.append(dict(turn))
+    while merged and merged[0]['role'] != 'user':
+        merged.pop(0)
+    while merged and merged[-1]['role'] != 'assistant':
+        merged.pop()
+    return merged
+
+
+def _unsummarized_messages(conversation):
+    from core.models import Message
+
+    messages = Message.objects.filter(conversation_id=conversation.pk)
+    if conversation.summarized_through_id:
+        messages = messages.filter(id__gt=conversation.summarized_through_id)
+    return messages
+
+
+def _window_query(conversation, before=None):
+    messages = _unsummarized_messages(conversation)
+    if before is not None:
+        messages = messages.filter(id__lt=before)
+    return messages.order_by('-id').values('id', 'role', 'content')[:HISTORY_SCAN_LIMIT + 1]
+
+
+# keeps newest-first rows until the budget runs out; returns them oldest first plus whether any were left out
+def _take_within_budget(rows, budget=None):
+    budget = settings.LLM_HISTORY_TOKEN_BUDGET if budget is None else budget
+    turns = []
+    used = 0
+    overflow = False
+    for message in rows:
+        cost = estimate_tokens(message['content'])
+        if used + cost > budget or len(turns) == HISTORY_SCAN_LIMIT:
+            overflow = True
+            break
+        used += cost
+        turns.append(message)
+    turns.reverse()
+    return turns, overflow
+
+
+# newest turns that fit the budget, ignoring messages already folded into the summary
+def _fill_window(conversation, before=None, budget=None):
+    return _take_within_budget(_window_query(conversation, before), budget)
+
+
+def _window(conversation, turns):
+    return {
+        'summary': conversation.summary,
+        'turns': _normalize_turns({'role': turn['role'], 'content': turn['content']} for turn in turns),
+    }
+
+
+# summary plus recent turns to send ahead of a question; schedules a summary refresh when turns fall out
+def conversation_window(conversation_id, before=None, budget=None):
+    from core.models import Conversation
+
+    conversation = Conversation.objects.only('summary', 'summarized_through_id').get(pk=conversation_id)
+    turns, overflow = _fill_window(conversation, before, budget)
+    if overflow:
+        request_summary_refresh(conversation_id)
+    return _window(conversation, turns)
+
+
+async def aconversation_window(conversation_id, before=None, budget=None):
+    from core.models import Conversation
+
+    conversation = await Conversation.objects.only('summary', 'summarized_through_id').aget(pk=conversation_id)
+    rows = [row async for row in _window_query(conversation, before)]
+    turns, overflow = _take_within_budget(rows, budget)
+    if overflow:
+        # publishing to the broker blocks, so keep it off the event loop and the shared sync thread
+        await sync_to_async(request_summary_refresh, thread_sensitive=False)(conversation_id)
+    return _window(conversation, turns)
+
+
+def _summary_key(conversation_id):
+    return f'llm:summary-pending:{conversation_id}'
+
+
+# queues one background summary refresh per conversation at a time
+def request_summary_refresh(conversation_id):
+    from core.tasks import summarize_conversation_task
+
+    if cache.add(_summary_key(conversation_id), True, timeout=SUMMARY_DEBOUNCE_SECONDS):
+        summarize_conversation_task.delay(conversation_id)
+        return True
+    return False
+
+
+# folds turns that no longer fit the window into the stored summary, a batch at a time
+def summarize_older_turns(conversation_id, llm_service=None):
+    from core.models import Conversation
+    from core.services.llm import LLMService
+
+    cache.delete(_summary_key(conversation_id))
+    llm_service = llm_service or LLMService()
+    folded = 0
+    while True:
+        conversation = Conversation.objects.only('user_id', 'summary', 'summarized_through_id').get(pk=conversation_id)
+        window, overflow = _fill_window(conversation)
+        if not overflow:
+            return folded
+        older = _unsummarized_messages(conversation).order_by('id').values('id', 'role', 'content')
+        if window:
+            older = older.filter(id__lt=window[0]['id'])
+        batch = list(older[:SUMMARY_BATCH_SIZE])
+        if not batch:
+            return folded
+
+        summary = llm_service.summarize_conversation(conversation.summary, batch, user_id=conversation.user_id)
+        if summary is None:
+            return folded
+        # compare-and-set so two workers never fold the same turns twice
+        updated = Conversation.objects.filter(
+            pk=conversation_id, summarized_through_id=conversation.summarized_through_id
+        ).update(summary=summary, summarized_through_id=batch[-1]['id'])
+        if not updated:
+            return folded
+        folded += len(batch)
@@ -1,82 +1,392 @@
 # anthropic claude api integration
 import anthropic
+import asyncio
+import httpx
+import weakref
 from django.conf import settings
-from datetime import datetime, timedelta
+from core.services.context_cache import get_or_build_context, aget_or_build_context
+from core.services.rollups import monthly_cash_flow, top_spending, amonthly_cash_flow, atop_spending
+from core.services.response_cache import response_key, get_cached_response, cache_response
+from core.services.llm_quota import (
+    llm_admission, allm_admission, record_usage, arecord_usage, QuotaExceeded, AdmissionRejected,
+)
+from datetime import date, datetime, timedelta
 from decimal import Decimal
 import logging
 import json
 
 logger = logging.getLogger(__name__)
 
+# one AsyncAnthropic client per event loop (a single one per daphne process) so connections are reused
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def get_async_client():
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = anthropic.AsyncAnthropic(
+            api_key=settings.ANTHROPIC_API_KEY,
+            timeout=settings.ANTHROPIC_TIMEOUT,
+            http_client=anthropic.DefaultAsyncHttpxClient(
+                limits=httpx.Limits(
+                    max_connections=settings.ANTHROPIC_MAX_CONNECTIONS,
+                    max_keepalive_connections=settings.ANTHROPIC_MAX_CONNECTIONS,
+                ),
+            ),
+        )
+        _async_clients[loop] = client
+    return client
+
 
 # service class for claude ai financial assistant integration
 class LLMService:
+    MODEL = "claude-3-5-haiku-20241022"  # use haiku model for faster/cheaper responses
+    MAX_TOKENS = 600  # increased for better responses
+    TEMPERATURE = 0.7  # slight creativity for natural responses
+    SYSTEM_PROMPT = "You are bal.ai, a personal finance assistant. Use the provided JSON context to answer questions precisely. Be helpful, concise, and practical."
+    ERROR_REPLY = "I'm sorry, I'm having trouble processing your request right now. Please try again later."
+    SUMMARY_PROMPT = "Update the running summary of a conversation between a user and bal.ai, a personal finance assistant. Keep the user's goals, decisions, figures and open questions. Reply with the updated summary only."
+    CONTEXT_MONTHS = 12  # months of income, spend and balance history in the context
+    CONTEXT_TOP_N = 8  # categories and merchants listed per period
+    CONTEXT_RECENT_TRANSACTIONS = 10  # raw rows kept for "what did I just buy" questions
+
     def __init__(self):
         # initialize claude client with api key from settings
         self.client = anthropic.Anthropic(api_key=settings.ANTHROPIC_API_KEY)
+        self.last_usage = None  # token counts from the most recent call
+        self.context_version = None  # version stamp of the context used by the last request
 
-    # builds context-aware prompt with user's financial data
+    # builds context-aware prompt with user's financial data, reused until the data changes
     def build_financial_context(self, user):
-        from core.models import Account, Transaction
-        
-        # get user's account balances for context
-        accounts = Account.objects.filter(user=user).values('name', 'balance', 'account_type')
-        
-        # get recent transactions (limit to 50 for token efficiency)
-        recent_transactions = Transaction.objects.filter(
+        self.context_version, context = get_or_build_context(user.id, lambda: self._serialize_financial_context(user))
+        return context
+
+    def _accounts_query(self, user):
+        from core.models import Account
+
+        return Account.objects.filter(user=user).values('name', 'balance', 'account_type')
+
+    def _recent_transactions_query(self, user):
+        from core.models import Transaction
+
+        return Transaction.objects.filter(
             account__user=user
-        ).order_by('-date')[:50].values('date', 'description', 'amount', 'category')
-        
-        # build structured context as json for claude
+        ).order_by('-date')[:self.CONTEXT_RECENT_TRANSACTIONS].values('date', 'description', 'amount', 'category')
+
+    # reporting periods for the category and merchant breakdowns
+    def _spending_periods(self, today):
+        return {'this_month': today, 'this_year': today.replace(month=1)}
+
+    # build structured context as json for claude
+    def _dump_context(self, today, accounts, total_balance, cash_flow, categories, merchants, recent_transactions):
         context_data = {
-            'balances': list(accounts),
-            'recent_transactions': list(recent_transactions),
-            'total_balance': sum(acc['balance'] for acc in accounts)
+            'today': today,
+            'balances': accounts,
+            'total_balance': total_balance,
+            'monthly_cash_flow': cash_flow,
+            'spending_by_category': categories,
+            'top_merchants': merchants,
+            'recent_transactions': recent_transactions,
         }
-        
-        return json.dumps(context_data, default=str)
+        return json.dumps(context_data, default=str, separators=(',', ':'))
 
-    # builds complete message array for claude api
-    def build_messages(self, user, question):
-        # get financial context as json
-        context_json = self.build_financial_context(user)
+    def _serialize_financial_context(self, user):
+        from core.models import SpendingRollup
         
+        # get user's account balances for context, evaluated once for both list and total
+        accounts = list(self._accounts_query(user))
+        total_balance = sum(acc['balance'] for acc in accounts)
+        today = date.today()
+        periods = self._spending_periods(today)
+        
+        # precomputed rollups stand in for raw history; only a short tail of rows is sent
+        return self._dump_context(
+            today,
+            accounts,
+            total_balance,
+            monthly_cash_flow(user.id, total_balance, months=self.CONTEXT_MONTHS),
+            {period: top_spending(user.id, SpendingRollup.CATEGORY, since, self.CONTEXT_TOP_N) for period, since in periods.items()},
+            {period: top_spending(user.id, SpendingRollup.MERCHANT, since, self.CONTEXT_TOP_N) for period, since in periods.items()},
+            list(self._recent_transactions_query(user)),
+        )
+
+    # builds the system blocks; the cache breakpoint after the context makes prompt + context a reusable prefix
+    def build_system(self, user):
+        # get financial context as json, byte-identical until the user's data changes
+        return self._system_blocks(self.build_financial_context(user))
+
+    def _system_blocks(self, context_json):
         return [
+            {"type": "text", "text": self.SYSTEM_PROMPT},
             {
-                "role": "user",
-                "content": f"USER_CONTEXT:\n{context_json}\n\nQUESTION: {question}"
-            }
+                "type": "text",
+                "text": f"USER_CONTEXT:\n{context_json}",
+                "cache_control": {"type": "ephemeral"},
+            },
         ]
+
+    # builds complete message array for claude api; recent turns first, the question last
+    def build_messages(self, user, question, history=None):
+        messages = [dict(turn) for turn in (history or {}).get('turns', [])]
+        if messages:
+            # second breakpoint so the next question also reuses the history prefix
+            messages[-1]['content'] = [
+                {"type": "text", "text": messages[-1]['content'], "cache_control": {"type": "ephemeral"}}
+            ]
+        messages.append({
+            "role": "user",
+            "content": f"QUESTION: {question}"
+        })
+        return messages
     
     # main method to get financial advice from claude
     def get_response(self, message, user):
         return self.get_financial_advice(message, user)
     
-    def get_financial_advice(self, user_question, user):
+    # true when no real api key is configured
+    def _missing_api_key(self):
+        return not settings.ANTHROPIC_API_KEY or settings.ANTHROPIC_API_KEY == 'your-anthropic-api-key-here'
+
+    def _missing_key_reply(self, user_question):
+        return f"Hi! I'm bal.ai, your financial assistant. I'd love to help with your question: '{user_question}'\n\nHowever, I need an Anthropic API key to provide personalized advice. Please set up your API key at https://console.anthropic.com/account/keys and add it to your .env file.\n\nOnce configured, I'll be able to analyze your financial data and provide tailored recommendations!"
+
+    # shared request parameters for the blocking and streaming calls
+    def build_request(self, user, user_question, history=None):
+        return self._request(user, self.build_system(user), user_question, history)
+
+    def _request(self, user, system, user_question, history=None):
+        if history and history.get('summary'):
+            system.append({"type": "text", "text": f"CONVERSATION_SUMMARY:\n{history['summary']}"})
+        return {
+            'model': self.MODEL,
+            'max_tokens': self.MAX_TOKENS,
+            'temperature': self.TEMPERATURE,
+            'system': system,
+            'messages': self.build_messages(user, user_question, history),
+            # add user metadata for tracking and security
+            'metadata': {"user_id": str(user.id)},
+        }
+
+    # records token usage, including prompt cache writes and reads, for cost tracking
+    def log_usage(self, response):
+        usage = getattr(response, 'usage', None)
+        if usage is None:
+            return None
+        self.last_usage = {
+            'input_tokens': usage.input_tokens,
+            'output_tokens': usage.output_tokens,
+            'cache_creation_input_tokens': getattr(usage, 'cache_creation_input_tokens', None) or 0,
+            'cache_read_input_tokens': getattr(usage, 'cache_read_input_tokens', None) or 0,
+        }
+        logger.info(
+            f"Claude API usage - Input tokens: {usage.input_tokens}, Output tokens: {usage.output_tokens}, "
+            f"Cache write tokens: {self.last_usage['cache_creation_input_tokens']}, "
+            f"Cache read tokens: {self.last_usage['cache_read_input_tokens']}"
+        )
+        return self.last_usage
+
+    # ledger failures are logged, never surfaced to the chat
+    def record_call(self, user_id, response, kind='chat'):
+        try:
+            record_usage(user_id, self.log_usage(response), kind=kind, model=self.MODEL)
+        except Exception as e:
+            logger.error(f"Error recording Claude usage for user {user_id}: {e}")
+
+    async def arecord_call(self, user_id, response, kind='chat'):
+        try:
+            await arecord_usage(user_id, self.log_usage(response), kind=kind, model=self.MODEL)
+        except Exception as e:
+            logger.error(f"Error recording Claude usage for user {user_id}: {e}")
+
+    # usage so far from the stream's snapshot: input tokens from message_start plus the output
+    # streamed before it finished or was stopped
+    def record_stream(self, user_id, stream):
+        try:
+            snapshot = stream.current_message_snapshot
+        except Exception:
+            return  # no message_start yet, so nothing was generated
+        self.record_call(user_id, snapshot)
+
+    async def arecord_stream(self, user_id, stream):
+        try:
+            snapshot = stream.current_message_snapshot
+        except Exception:
+            return
+        await self.arecord_call(user_id, snapshot)
+
+    # raises QuotaExceeded or AdmissionRejected when the user is over quota or no slot frees up
+    def get_financial_advice(self, user_question, user, history=None):
         # check if api key is properly configured
-        if not settings.ANTHROPIC_API_KEY or settings.ANTHROPIC_API_KEY == 'your-anthropic-api-key-here':
-            return f"Hi! I'm bal.ai, your financial assistant. I'd love to help with your question: '{user_question}'\n\nHowever, I need an Anthropic API key to provide personalized advice. Please set up your API key at https://console.anthropic.com/account/keys and add it to your .env file.\n\nOnce configured, I'll be able to analyze your financial data and provide tailored recommendations!"
+        if self._missing_api_key():
+            return self._missing_key_reply(user_question)
         
         try:
-            # build messages with financial context
-            messages = self.build_messages(user, user_question)
-            
-            # call claude api with structured messages
+            request = self.build_request(user, user_question, history)
+            # same question against unchanged data and history is answered from the cache,
+            # without spending quota or waiting for a slot
+            key = response_key(user.id, self.context_version, user_question, history)
+            cached = get_cached_response(key)
+            if cached is not None:
+                return cached
+
+            with llm_admission(user.id):
+                # call claude api with structured messages
+                response = self.client.messages.create(**request)
+                self.record_call(user.id, response)
+            reply = response.content[0].text
+            cache_response(key, reply)
+            return reply
+        except (QuotaExceeded, AdmissionRejected):
+            raise
+        except Exception as e:
+            logger.error(f"Error getting financial advice: {e}")
+            return self.ERROR_REPLY
+
+    # yields text deltas as claude generates them so the ui can render tokens immediately
+    def stream_financial_advice(self, user_question, user, history=None):
+        if self._missing_api_key():
+            yield self._missing_key_reply(user_question)
+            return
+
+        streamed = False
+        try:
+            request = self.build_request(user, user_question, history)
+            key = response_key(user.id, self.context_version, user_question, history)
+            cached = get_cached_response(key)
+            if cached is not None:
+                yield cached
+                return
+
+            parts = []
+            with llm_admission(user.id), self.client.messages.stream(**request) as stream:
+                try:
+                    for text in stream.text_stream:
+                        streamed = True
+                        parts.append(text)
+                        yield text
+                finally:
+                    # superseded, disconnected and failed streams were still billed for what ran
+                    self.record_stream(user.id, stream)
+            cache_response(key, ''.join(parts))
+        except (QuotaExceeded, AdmissionRejected):
+            raise
+        except Exception as e:
+            logger.error(f"Error streaming financial advice: {e}")
+            # keep whatever was already shown and append the apology after it
+            yield f"\n\n{self.ERROR_REPLY}" if streamed else self.ERROR_REPLY
+
+    # folds older turns into the running summary; returns None when the call fails
+    def summarize_conversation(self, summary, turns, user_id=None):
+        if self._missing_api_key():
+            return None
+
+        transcript = "\n".join(f"{turn['role'].upper()}: {turn['content']}" for turn in turns)
+        try:
             response = self.client.messages.create(
-                model="claude-3-5-haiku-20241022",  # use haiku model for faster/cheaper responses
-                max_tokens=600,  # increased for better responses
-                temperature=0.7,  # slight creativity for natural responses
-                system="You are bal.ai, a personal finance assistant. Use the provided JSON context to answer questions precisely. Be helpful, concise, and practical.",
-                messages=messages,
-                # add user metadata for tracking and security
-                metadata={"user_id": str(user.id)}
+                model=self.MODEL,
+                max_tokens=settings.LLM_SUMMARY_MAX_TOKENS,
+                temperature=0,
+                system=self.SUMMARY_PROMPT,
+                messages=[{
+                    "role": "user",
+                    "content": f"CURRENT_SUMMARY:\n{summary or '(none)'}\n\nNEW_TURNS:\n{transcript}"
+                }],
             )
-            
-            # log token usage for cost tracking
-            if hasattr(response, 'usage'):
-                logger.info(f"Claude API usage - Input tokens: {response.usage.input_tokens}, Output tokens: {response.usage.output_tokens}")
-            
+            if user_id:
+                self.record_call(user_id, response, kind='summary')
+            else:
+                self.log_usage(response)
             return response.content[0].text
+        except Exception as e:
+            logger.error(f"Error summarizing conversation: {e}")
+            return None
+
+
+# async twin of LLMService for websocket consumers: awaits the api and the orm instead of holding a thread
+class AsyncLLMService(LLMService):
+    def __init__(self):
+        # shared client, must be created inside the running event loop
+        self.client = get_async_client()
+        self.last_usage = None
+        self.context_version = None
+
+    async def abuild_financial_context(self, user):
+        self.context_version, context = await aget_or_build_context(user.id, lambda: self._aserialize_financial_context(user))
+        return context
+
+    async def _aserialize_financial_context(self, user):
+        from core.models import SpendingRollup
+
+        accounts = [account async for account in self._accounts_query(user)]
+        total_balance = sum(acc['balance'] for acc in accounts)
+        today = date.today()
+        periods = self._spending_periods(today)
+
+        return self._dump_context(
+            today,
+            accounts,
+            total_balance,
+            await amonthly_cash_flow(user.id, total_balance, months=self.CONTEXT_MONTHS),
+            {period: await atop_spending(user.id, SpendingRollup.CATEGORY, since, self.CONTEXT_TOP_N) for period, since in periods.items()},
+            {period: await atop_spending(user.id, SpendingRollup.MERCHANT, since, self.CONTEXT_TOP_N) for period, since in periods.items()},
+            [transaction async for transaction in self._recent_transactions_query(user)],
+        )
+
+    async def abuild_request(self, user, user_question, history=None):
+        system = self._system_blocks(await self.abuild_financial_context(user))
+        return self._request(user, system, user_question, history)
+
+    async def aget_financial_advice(self, user_question, user, history=None):
+        if self._missing_api_key():
+            return self._missing_key_reply(user_question)
+
+        try:
+            request = await self.abuild_request(user, user_question, history)
+            key = response_key(user.id, self.context_version, user_question, history)
+            cached = get_cached_response(key)
+            if cached is not None:
+                return cached
+
+            async with allm_admission(user.id):
+                response = await self.client.messages.create(**request)
+                await self.arecord_call(user.id, response)
+            reply = response.content[0].text
+            cache_response(key, reply)
+            return reply
+        except (QuotaExceeded, AdmissionRejected):
+            raise
         except Exception as e:
             logger.error(f"Error getting financial advice: {e}")
-            return "I'm sorry, I'm having trouble processing your request right now. Please try again later."
\ No newline at end of file
+            return self.ERROR_REPLY
+
+    # yields text deltas as claude generates them without tying up a worker thread
+    async def astream_financial_advice(self, user_question, user, history=None):
+        if self._missing_api_key():
+            yield self._missing_key_reply(user_question)
+            return
+
+        streamed = False
+        try:
+            request = await self.abuild_request(user, user_question, history)
+            key = response_key(user.id, self.context_version, user_question, history)
+            cached = get_cached_response(key)
+            if cached is not None:
+                yield cached
+                return
+
+            parts = []
+            async with allm_admission(user.id), self.client.messages.stream(**request) as stream:
+                try:
+                    async for text in stream.text_stream:
+                        streamed = True
+                        parts.append(text)
+                        yield text
+                finally:
+                    await self.arecord_stream(user.id, stream)
+            cache_response(key, ''.join(parts))
+        except (QuotaExceeded, AdmissionRejected):
+            raise
+        except Exception as e:
+            logger.error(f"Error streaming financial advice: {e}")
+            yield f"\n\n{self.ERROR_REPLY}" if streamed else self.ERROR_REPLY
@@ -0,0 +1,186 @@
+# per-user claude usage ledger, daily quotas and admission control
+from asgiref.sync import sync_to_async
+from channels.db import database_sync_to_async
+from contextlib import asynccontextmanager, contextmanager
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+from datetime import datetime, time as day_time, timedelta
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# seconds between attempts to grab a generation slot while queued
+ADMISSION_POLL_SECONDS = 0.25
+# a slot outlives the longest claude call, so a crashed worker's slot frees itself
+SLOT_TIMEOUT_MARGIN_SECONDS = 30
+
+
+# raised when a user has used up today's token or request quota
+class QuotaExceeded(Exception):
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+# raised when no generation slot frees up within the admission wait
+class AdmissionRejected(Exception):
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def _seconds_until_tomorrow():
+    now = timezone.localtime()
+    tomorrow = timezone.make_aware(datetime.combine(now.date() + timedelta(days=1), day_time.min))
+    return int((tomorrow - now).total_seconds()) + 1
+
+
+def _daily_usage_query(user_id):
+    from core.models import LLMDailyUsage
+
+    return LLMDailyUsage.objects.filter(user_id=user_id, day=timezone.localdate())
+
+
+def _raise_if_over_quota(usage):
+    if usage is None:
+        return
+    if usage.requests >= settings.LLM_DAILY_REQUEST_LIMIT:
+        raise QuotaExceeded("You've reached today's limit of questions. It resets at midnight.", _seconds_until_tomorrow())
+    if usage.billable_tokens >= settings.LLM_DAILY_TOKEN_LIMIT:
+        raise QuotaExceeded("You've used today's AI allowance. It resets at midnight.", _seconds_until_tomorrow())
+
+
+def check_quota(user_id):
+    _raise_if_over_quota(_daily_usage_query(user_id).first())
+
+
+async def acheck_quota(user_id):
+    _raise_if_over_quota(await _daily_usage_query(user_id).afirst())
+
+
+# the per-user cap comes first so one user can never queue for every global slot
+def _slots(user_id):
+    return [
+        (f'llm:slot:user:{user_id}', settings.LLM_USER_MAX_IN_FLIGHT),
+        ('llm:slot:global', settings.LLM_MAX_IN_FLIGHT),
+    ]
+
+
+def _slot_timeout():
+    return int(settings.ANTHROPIC_TIMEOUT) + SLOT_TIMEOUT_MARGIN_SECONDS
+
+
+# generations are counted per epoch of _slot_timeout() seconds: anything still running started in
+# this epoch or the last one, so a crashed worker's count ages out instead of holding capacity forever
+def _counter_keys(name):
+    epoch = int(time.time() // _slot_timeout())
+    return f'{name}:{epoch}', f'{name}:{epoch - 1}'
+
+
+# one atomic increment instead of probing a key per slot; backs out when the cap is already reached
+def _try_acquire(name, limit):
+    key, previous = _counter_keys(name)
+    # outlives the epoch after its own, so every generation counted here can still decrement it
+    cache.add(key, 0, timeout=_slot_timeout() * 2)
+    try:
+        count = cache.incr(key)
+    except ValueError:
+        return None  # expired between add and incr; the next poll starts a fresh counter
+    if count + (cache.get(previous) or 0) > limit:
+        _release([key])
+        return None
+    return key
+
+
+def _release(keys):
+    for key in keys:
+        try:
+            cache.decr(key)
+        except ValueError:
+            pass  # already aged out
+
+
+def _rejected():
+    return AdmissionRejected("bal.ai is busy answering your other questions. Please try again in a moment.", 5)
+
+
+# checks the quota, then queues up to LLM_ADMISSION_WAIT_SECONDS for a user and a global slot
+@contextmanager
+def llm_admission(user_id):
+    check_quota(user_id)
+    deadline = time.monotonic() + settings.LLM_ADMISSION_WAIT_SECONDS
+    held = []
+    try:
+        for name, limit in _slots(user_id):
+            while True:
+                key = _try_acquire(name, limit)
+                if key:
+                    held.append(key)
+                    break
+                if time.monotonic() >= deadline:
+                    raise _rejected()
+                time.sleep(ADMISSION_POLL_SECONDS)
+        yield
+    finally:
+        _release(held)
+
+
+# django's cache has no native async api (its a* methods run on the shared sync thread), so queued
+# chats poll from the thread pool and never starve the consumers' database calls
+_atry_acquire = sync_to_async(_try_acquire, thread_sensitive=False)
+_arelease = sync_to_async(_release, thread_sensitive=False)
+
+
+@asynccontextmanager
+async def allm_admission(user_id):
+    await acheck_quota(user_id)
+    deadline = time.monotonic() + settings.LLM_ADMISSION_WAIT_SECONDS
+    held = []
+    try:
+        for name, limit in _slots(user_id):
+            while True:
+                key = await _atry_acquire(name, limit)
+                if key:
+                    held.append(key)
+                    break
+                if time.monotonic() >= deadline:
+                    raise _rejected()
+                await asyncio.sleep(ADMISSION_POLL_SECONDS)
+        yield
+    finally:
+        await _arelease(held)
+
+
+# writes the per-call ledger row and folds it into the user's daily totals
+def record_usage(user_id, usage, kind='chat', model=''):
+    from core.models import LLMDailyUsage, LLMUsageRecord
+
+    if not user_id or not usage:
+        return None
+    tokens = {
+        field: int(usage.get(field) or 0)
+        for field in ('input_tokens', 'output_tokens', 'cache_creation_input_tokens', 'cache_read_input_tokens')
+    }
+    # background summaries spend tokens but aren't questions the user asked
+    questions = int(kind == LLMUsageRecord.CHAT)
+    day = timezone.localdate()
+    with transaction.atomic():
+        record = LLMUsageRecord.objects.create(user_id=user_id, kind=kind, model=model, **tokens)
+        increments = {field: F(field) + value for field, value in tokens.items()}
+        if not LLMDailyUsage.objects.filter(user_id=user_id, day=day).update(requests=F('requests') + questions, **increments):
+            try:
+                # savepoint so a concurrent first call of the day doesn't poison the outer transaction
+                with transaction.atomic():
+                    LLMDailyUsage.objects.create(user_id=user_id, day=day, requests=questions, **tokens)
+            except IntegrityError:
+                LLMDailyUsage.objects.filter(user_id=user_id, day=day).update(requests=F('requests') + questions, **increments)
+    return record
+
+
+# off the shared sync thread, so usage writes don't queue behind every other sync call in the process
+arecord_usage = database_sync_to_async(record_usage, thread_sensitive=False)
@@ -0,0 +1,75 @@
+# merchant name normalization and interning into the Merchant table
+from collections import OrderedDict
+from django.db import transaction
+import re
+import threading
+
+# most merchants a process keeps resolved ids for
+MERCHANT_CACHE_SIZE = 5000
+
+# card processors and pos systems that prefix the real merchant, e.g. "SQ *BLUE BOTTLE"
+_PROCESSOR_PREFIX = re.compile(r'^(?:sq|tst|sp|pp|paypal|pypl|goog|google|apl|in|py|dd|ckcd)\s*\*\s*', re.IGNORECASE)
+# bank wording in front of card purchases
+_BANK_PREFIX = re.compile(
+    r'^(?:pos (?:purchase|debit)|debit card purchase|checkcard(?: \d+)?|recurring payment|purchase authorized on \d{1,2}/\d{1,2})\s+',
+    re.IGNORECASE
+)
+# store numbers like "#1234", "store 88", "no. 12", "T-1234" or a run of digits
+_STORE_NUMBER = re.compile(r'#\s*\d+|\bstore\s*\d+|\bno\.?\s*\d+|\b[a-z]{1,2}-?\d{3,}\b|\s\d{2,}\b', re.IGNORECASE)
+# web domains, so "Amazon.com" groups with "Amazon"
+_DOMAIN = re.compile(r'\.(?:com|net|org|co)\b', re.IGNORECASE)
+_PUNCTUATION = re.compile(r"[^\w&' ]+")
+_SPACES = re.compile(r'\s+')
+
+# normalized name -> merchant id, least recently used first
+_merchant_ids = OrderedDict()
+_merchant_lock = threading.Lock()
+
+
+# reduces a raw plaid merchant or description string to a grouping key
+def normalize_merchant_name(raw_name):
+    if not raw_name:
+        return ''
+    name = _SPACES.sub(' ', str(raw_name)).strip()
+    name = _BANK_PREFIX.sub('', name)
+    name = _PROCESSOR_PREFIX.sub('', name)
+    name = _STORE_NUMBER.sub(' ', name)
+    name = _DOMAIN.sub('', name)
+    name = _PUNCTUATION.sub(' ', name)
+    return _SPACES.sub(' ', name).strip().casefold()[:255]
+
+
+def _remember(key, merchant_id):
+    with _merchant_lock:
+        _merchant_ids[key] = merchant_id
+        _merchant_ids.move_to_end(key)
+        while len(_merchant_ids) > MERCHANT_CACHE_SIZE:
+            _merchant_ids.popitem(last=False)
+
+
+# returns the merchant id for a raw name, creating the merchant the first time it's seen
+def intern_merchant(raw_name, display_name=None):
+    from core.models import Merchant
+
+    key = normalize_merchant_name(raw_name)
+    if not key:
+        return None
+    with _merchant_lock:
+        merchant_id = _merchant_ids.get(key)
+        if merchant_id is not None:
+            _merchant_ids.move_to_end(key)
+            return merchant_id
+
+    merchant = Merchant.objects.get_or_create(
+        normalized_name=key,
+        defaults={'name': (display_name or key.title())[:255]}
+    )[0]
+    # only cache committed rows, a rollback would leave a dangling id
+    transaction.on_commit(lambda: _remember(key, merchant.id))
+    return merchant.id
+
+
+# forgets interned ids (used in tests, where the table is rolled back between cases)
+def clear_merchant_cache():
+    with _merchant_lock:
+        _merchant_ids.clear()
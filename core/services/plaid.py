@@ -1,56 +1,176 @@
 # plaid api imports for banking integration
 from plaid.api import plaid_api
 from plaid.model.transactions_get_request import TransactionsGetRequest
+from plaid.model.transactions_get_request_options import TransactionsGetRequestOptions
 from plaid.model.transactions_sync_request import TransactionsSyncRequest
 from plaid.model.accounts_get_request import AccountsGetRequest
 from plaid.model.accounts_balance_get_request import AccountsBalanceGetRequest
 from plaid.model.item_public_token_exchange_request import ItemPublicTokenExchangeRequest
 from plaid.model.link_token_create_request import LinkTokenCreateRequest
 from plaid.model.link_token_create_request_user import LinkTokenCreateRequestUser
+from plaid.model.link_token_transactions import LinkTokenTransactions
 from plaid.model.country_code import CountryCode
 from plaid.model.products import Products
 from plaid.configuration import Configuration, Environment
 from plaid.api_client import ApiClient
+from plaid.exceptions import ApiException
 # django and python imports
 from django.conf import settings
-from datetime import datetime, timedelta
+from django.db import connection, transaction as db_transaction
+from django.utils import timezone
+from datetime import date, datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from decimal import Decimal
 import logging
+import json
+import os
+import queue
+import threading
+
+# sync coordination and category/merchant interning
+from core.services.sync_queue import SyncInProgress, item_sync_lock
+from core.services.context_cache import invalidate_user_context
+from core.services.rollups import rollup_batch
+from core.services.categories import intern_category
+from core.services.merchants import intern_merchant, normalize_merchant_name
 
 logger = logging.getLogger(__name__)
 
+# map environment names to plaid api urls
+PLAID_HOSTS = {
+    'sandbox': 'https://sandbox.plaid.com',
+    'development': 'https://development.plaid.com', 
+    'production': 'https://production.plaid.com',
+}
+
+# process-wide plaid clients keyed by (host, client id) so connections stay alive between requests
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+# api client that applies our default timeouts to every plaid call
+class PooledApiClient(ApiClient):
+    def __init__(self, configuration, request_timeout=None):
+        super().__init__(configuration)
+        self.request_timeout = request_timeout  # (connect, read) seconds
+
+    def call_api(self, *args, **kwargs):
+        if kwargs.get('_request_timeout') is None:
+            kwargs['_request_timeout'] = self.request_timeout
+        return super().call_api(*args, **kwargs)
+
+
+# returns the shared plaid api client for this process, building it on first use
+def get_plaid_client():
+    host = PLAID_HOSTS.get(settings.PLAID_ENV, PLAID_HOSTS['sandbox'])  # default to sandbox
+    if settings.PLAID_ENV == 'local':
+        host = 'local'  # offline stand-in, see core.services.plaid_standin
+    key = (host, settings.PLAID_CLIENT_ID)
+
+    client = _clients.get(key)
+    if client is not None:
+        return client
+
+    with _clients_lock:
+        if key not in _clients and host == 'local':
+            from core.services.plaid_standin import FakePlaidClient
+            _clients[key] = FakePlaidClient()
+        if key not in _clients:
+            # configure plaid client with credentials
+            configuration = Configuration(
+                host=host,
+                api_key={
+                    'clientId': settings.PLAID_CLIENT_ID,
+                    'secret': settings.PLAID_SECRET,
+                }
+            )
+            configuration.connection_pool_maxsize = settings.PLAID_POOL_MAXSIZE  # parallel keep-alive connections
+            api_client = PooledApiClient(
+                configuration,
+                request_timeout=(settings.PLAID_CONNECT_TIMEOUT, settings.PLAID_READ_TIMEOUT)
+            )
+            _clients[key] = plaid_api.PlaidApi(api_client)
+            logger.info(f"Created pooled Plaid client for {host} (maxsize {settings.PLAID_POOL_MAXSIZE})")
+        return _clients[key]
+
+
+# drops all cached clients (used after fork and in tests)
+def reset_plaid_clients():
+    with _clients_lock:
+        _clients.clear()
+
+
+# connection reuse metrics across every pooled plaid client in this process
+def plaid_connection_stats():
+    stats = {'requests': 0, 'new_connections': 0, 'reused_connections': 0}
+    with _clients_lock:
+        clients = list(_clients.values())
+    for client in clients:
+        if not hasattr(client, 'api_client'):
+            continue  # local stand-in has no connections
+        pools = client.api_client.rest_client.pool_manager.pools
+        for pool_key in list(pools.keys()):
+            pool = pools.get(pool_key)
+            if pool is None:
+                continue  # evicted since we listed the keys
+            stats['requests'] += pool.num_requests
+            stats['new_connections'] += pool.num_connections
+    stats['reused_connections'] = max(stats['requests'] - stats['new_connections'], 0)
+    return stats
+
+
+# pulls plaid's error_code out of an api exception body
+def plaid_error_code(error):
+    try:
+        return json.loads(error.body).get('error_code')
+    except (TypeError, ValueError, AttributeError):
+        return None
+
+
+# forked celery workers must not share sockets with their parent
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_clients.clear)
+
 
 # main service class for plaid banking integration
 class PlaidService:
-    def __init__(self):
-        # map environment names to plaid api urls
-        env_mapping = {
-            'sandbox': 'https://sandbox.plaid.com',
-            'development': 'https://development.plaid.com', 
-            'production': 'https://production.plaid.com',
-        }
-        host = env_mapping.get(settings.PLAID_ENV, 'https://sandbox.plaid.com')  # default to sandbox
-        
-        # configure plaid client with credentials
-        configuration = Configuration(
-            host=host,
-            api_key={
-                'clientId': settings.PLAID_CLIENT_ID,
-                'secret': settings.PLAID_SECRET,
-            }
-        )
-        api_client = ApiClient(configuration)
-        self.client = plaid_api.PlaidApi(api_client)  # main plaid api client
+    # number of transactions converted and written per bulk_create call
+    TRANSACTION_BATCH_SIZE = 500
+    # columns refreshed when a plaid transaction already exists
+    TRANSACTION_UPDATE_FIELDS = ['account', 'amount', 'date', 'description', 'merchant_name', 'merchant', 'category', 'category_ref', 'updated_at']
+    # transactions requested per /transactions/sync page (plaid max is 500)
+    SYNC_PAGE_SIZE = 500
+    # how many times a sync run restarts from the committed cursor after a mutation error
+    SYNC_MAX_RESTARTS = 3
+    # transactions requested per /transactions/get page (plaid max is 500)
+    TRANSACTIONS_PAGE_SIZE = 500
+    # history loaded for a new item and how it is split for parallel fetching
+    BACKFILL_MONTHS = 24
+    BACKFILL_WINDOW_DAYS = 90
+    BACKFILL_MAX_WORKERS = 4
+    # history plaid prepares for /transactions/sync when the item is linked (plaid max is 730)
+    LINK_DAYS_REQUESTED = 730
+    # stages sync_user_items runs for each linked item
+    ITEM_SYNC_STAGES = ('accounts', 'transactions', 'balances')
+
+    def __init__(self, client=None):
+        # reuse the process-wide pooled client instead of opening new connections per request
+        self.client = client or get_plaid_client()
 
     # creates a link token for plaid link initialization
     def create_link_token(self, user_id):
         # build request with required parameters
+        options = {}
+        if settings.PLAID_WEBHOOK_URL:
+            options['webhook'] = settings.PLAID_WEBHOOK_URL  # tells us when the item's history is ready
         request = LinkTokenCreateRequest(
             products=[Products('transactions')],  # we want transaction data
             client_name="Balai Budget App",  # app name shown to user
             country_codes=[CountryCode('US')],  # us banks only
             language='en',  # english interface
             user=LinkTokenCreateRequestUser(client_user_id=str(user_id)),  # unique user identifier
+            transactions=LinkTokenTransactions(days_requested=self.LINK_DAYS_REQUESTED),  # full history, not plaid's 90 day default
+            **options
         )
         try:
             response = self.client.link_token_create(request)
@@ -64,7 +184,10 @@ class PlaidService:
         request = ItemPublicTokenExchangeRequest(public_token=public_token)  # token from frontend
         try:
             response = self.client.item_public_token_exchange(request)
-            return response['access_token']  # permanent access token for api calls
+            return {
+                'access_token': response['access_token'],  # permanent access token for api calls
+                'item_id': response['item_id'],  # identifies the item in webhooks
+            }
         except Exception as e:
             logger.error(f"Error exchanging public token: {e}")
             raise
@@ -87,22 +210,108 @@ class PlaidService:
         if not end_date:
             end_date = datetime.now()
         
-        request = TransactionsGetRequest(
-            access_token=access_token,
-            start_date=start_date.date(),  # convert to date object
-            end_date=end_date.date()
-        )
-        try:
-            response = self.client.transactions_get(request)
-            transactions = response['transactions']
-            logger.info(f"Fetched {len(transactions)} transactions from Plaid")
-            return transactions  # list of transaction objects
-        except Exception as e:
-            logger.error(f"Error fetching transactions: {e}")
-            raise
+        transactions = []
+        for page in self.iter_transaction_pages(access_token, start_date.date(), end_date.date()):
+            transactions.extend(page)
+        logger.info(f"Fetched {len(transactions)} transactions from Plaid")
+        return transactions  # list of transaction objects
+
+    # yields pages of transactions for a date range using count/offset pagination
+    def iter_transaction_pages(self, access_token, start_date, end_date):
+        offset = 0
+        while True:
+            request = TransactionsGetRequest(
+                access_token=access_token,
+                start_date=start_date,
+                end_date=end_date,
+                options=TransactionsGetRequestOptions(count=self.TRANSACTIONS_PAGE_SIZE, offset=offset)
+            )
+            try:
+                response = self.client.transactions_get(request)
+            except Exception as e:
+                logger.error(f"Error fetching transactions: {e}")
+                raise
+
+            page = response['transactions']
+            if page:
+                yield page
+            offset += len(page)
+            # total_transactions covers the whole range, not just this page
+            if not page or offset >= response['total_transactions']:
+                return
+
+    # splits a date range into consecutive windows of at most `days` days
+    def _date_windows(self, start_date, end_date, days):
+        window_start = start_date
+        while window_start <= end_date:
+            window_end = min(window_start + timedelta(days=days - 1), end_date)
+            yield window_start, window_end
+            window_start = window_end + timedelta(days=1)
+
+    # loads up to BACKFILL_MONTHS of history, fetching date windows in parallel; the sync cursor is
+    # left untouched, so new items are onboarded with run_incremental_sync instead
+    def backfill_transactions(self, user, access_token, months=None):
+        months = min(months or self.BACKFILL_MONTHS, self.BACKFILL_MONTHS)
+        end_date = date.today()
+        start_date = end_date - timedelta(days=round(months * 365 / 12))
+        windows = list(self._date_windows(start_date, end_date, self.BACKFILL_WINDOW_DAYS))
+
+        # bounded so fetchers wait for the writer instead of buffering the whole history
+        pages = queue.Queue(maxsize=self.BACKFILL_MAX_WORKERS * 2)
+        stop = threading.Event()
+        window_done = object()
+
+        def fetch_window(window):
+            try:
+                if stop.is_set():
+                    return  # another window already failed; don't spend a plaid call on this one
+                for page in self.iter_transaction_pages(access_token, *window):
+                    if stop.is_set():
+                        break
+                    pages.put(page)
+            except Exception as e:
+                stop.set()  # before the writer sees it, so queued windows skip their first call
+                pages.put(e)
+            finally:
+                pages.put(window_done)
+
+        summary = {'inserted': 0, 'updated': 0, 'skipped': 0, 'windows': len(windows), 'pages': 0}
+        error = None
+        remaining = len(windows)
+
+        with ThreadPoolExecutor(max_workers=self.BACKFILL_MAX_WORKERS, thread_name_prefix='plaid-backfill') as executor:
+            for window in windows:
+                executor.submit(fetch_window, window)
+
+            # database writes stay on this thread; workers only talk to plaid
+            while remaining:
+                item = pages.get()
+                if item is window_done:
+                    remaining -= 1
+                elif isinstance(item, Exception):
+                    error = error or item
+                    stop.set()  # let the other windows wind down
+                elif error is None:
+                    try:
+                        page_summary = self.upsert_transactions(user, item)
+                    except Exception as e:
+                        # keep draining so fetchers blocked on the full queue can finish
+                        error = e
+                        stop.set()
+                        continue
+                    summary['pages'] += 1
+                    for key in ('inserted', 'updated', 'skipped'):
+                        summary[key] += page_summary[key]
+
+        if error is not None:
+            logger.error(f"Error backfilling transactions: {error}")
+            raise error
+
+        logger.info(f"Backfilled {months} months of transactions for user {user.id}: {summary}")
+        return summary
 
     # syncs plaid accounts to our database
-    def sync_accounts(self, user, access_token):
+    def sync_accounts(self, user, access_token, plaid_item=None):
         from core.models import Account
         
         try:
@@ -115,6 +324,7 @@ class PlaidService:
                     plaid_account_id=account_data['account_id'],  # unique plaid identifier
                     defaults={
                         'user': user,  # link to our user
+                        'plaid_item': plaid_item,  # institution this account belongs to
                         'name': account_data['name'],  # bank account name
                         'account_type': self._map_account_type(account_data['type']),  # convert plaid type
                         'balance': Decimal(str(account_data['balances']['current'] or 0)),  # current balance
@@ -131,43 +341,113 @@ class PlaidService:
 
     # syncs plaid transactions to our database
     def sync_transactions(self, user, access_token):
-        from core.models import Transaction, Account
-        
         try:
-            transactions = self.get_transactions(access_token)  # fetch from plaid
-            created_transactions = []
-            
-            # create or update each transaction in our database
-            for transaction_data in transactions:
-                try:
-                    # find the account this transaction belongs to
-                    account = Account.objects.get(
-                        plaid_account_id=transaction_data['account_id'],
-                        user=user
-                    )
-                    
-                    # create or update transaction
-                    transaction, created = Transaction.objects.update_or_create(
-                        plaid_transaction_id=transaction_data['transaction_id'],  # unique plaid identifier
-                        defaults={
-                            'account': account,  # link to our account
-                            'amount': -Decimal(str(transaction_data['amount'])),  # plaid amounts are positive for debits, so negate them
-                            'date': transaction_data['date'],  # transaction date
-                            'description': transaction_data['name'],  # transaction description
-                            'merchant_name': transaction_data.get('merchant_name'),  # merchant if available
-                            'category': self._safe_join_categories(transaction_data.get('category')),  # join categories safely
-                        }
-                    )
-                    created_transactions.append(transaction)
-                except Account.DoesNotExist:
-                    logger.warning(f"Account not found for transaction {transaction_data['transaction_id']}")
-                    continue  # skip this transaction
-            
-            return created_transactions
+            summary = {'inserted': 0, 'updated': 0, 'skipped': 0}
+            start_date = date.today() - timedelta(days=30)
+            # write each page as it arrives rather than collecting the whole range
+            for page in self.iter_transaction_pages(access_token, start_date, date.today()):
+                page_summary = self.upsert_transactions(user, page)  # batched write
+                for key in summary:
+                    summary[key] += page_summary[key]
+            return summary
         except Exception as e:
             logger.error(f"Error syncing transactions: {e}")
             raise
 
+    # bulk upserts plaid transaction payloads, returns inserted/updated/skipped counts
+    def upsert_transactions(self, user, transactions_data):
+        from core.models import Transaction, Account
+
+        # load the user's plaid account map once instead of one lookup per row
+        account_map = dict(
+            Account.objects.filter(user=user, plaid_account_id__isnull=False)
+            .values_list('plaid_account_id', 'id')
+        )
+        summary = {'inserted': 0, 'updated': 0, 'skipped': 0}
+        lookups = {}  # categories and merchants resolved during this call
+
+        with db_transaction.atomic(), rollup_batch() as rollups:
+            for chunk in self._chunked(transactions_data, self.TRANSACTION_BATCH_SIZE):
+                rows = {}  # keyed by plaid id so duplicates in a chunk collapse to the last one
+                for transaction_data in chunk:
+                    account_id = account_map.get(transaction_data['account_id'])
+                    if account_id is None:
+                        logger.warning(f"Account not found for transaction {transaction_data['transaction_id']}")
+                        summary['skipped'] += 1
+                        continue
+                    rows[transaction_data['transaction_id']] = self._build_transaction(account_id, transaction_data, lookups)
+
+                if not rows:
+                    continue
+
+                # one query per chunk splits inserts from updates and gives the old rows' rollup values
+                existing = Transaction.objects.filter(plaid_transaction_id__in=rows.keys()).values_list(
+                    'plaid_transaction_id', 'amount', 'date', 'category_ref_id', 'merchant_id'
+                ).order_by()
+                existing = {row[0]: row[1:] for row in existing}
+                for plaid_transaction_id, row in rows.items():
+                    if plaid_transaction_id in existing:
+                        rollups.remove(user.id, *existing[plaid_transaction_id])
+                    rollups.add(user.id, row.amount, row.date, row.category_ref_id, row.merchant_id)
+                Transaction.objects.bulk_create(
+                    rows.values(),
+                    update_conflicts=True,
+                    unique_fields=['plaid_transaction_id'],
+                    update_fields=self.TRANSACTION_UPDATE_FIELDS,
+                )
+                summary['inserted'] += len(rows) - len(existing)
+                summary['updated'] += len(existing)
+
+            # bulk writes skip model signals, so drop the cached llm context explicitly
+            if summary['inserted'] or summary['updated']:
+                invalidate_user_context(user.id)
+
+        logger.info(
+            f"Upserted transactions for user {user.id} - inserted: {summary['inserted']}, "
+            f"updated: {summary['updated']}, skipped: {summary['skipped']}"
+        )
+        return summary
+
+    # converts a plaid transaction payload into an unsaved Transaction row
+    def _build_transaction(self, account_id, transaction_data, lookups=None):
+        from core.models import Transaction
+
+        # lookups memoizes interned ids for the current batch, before they're committed
+        lookups = {} if lookups is None else lookups
+        categories = transaction_data.get('category')
+        category_key = self._safe_join_categories(categories)
+        if ('category', category_key) not in lookups:
+            lookups['category', category_key] = intern_category(categories)
+
+        merchant_name = transaction_data.get('merchant_name')
+        raw_merchant = merchant_name or transaction_data['name']  # fall back to the raw description
+        merchant_key = normalize_merchant_name(raw_merchant)
+        if ('merchant', merchant_key) not in lookups:
+            lookups['merchant', merchant_key] = intern_merchant(raw_merchant, merchant_name)
+
+        return Transaction(
+            account_id=account_id,  # link to our account
+            plaid_transaction_id=transaction_data['transaction_id'],  # unique plaid identifier
+            amount=-Decimal(str(transaction_data['amount'])),  # plaid amounts are positive for debits, so negate them
+            date=transaction_data['date'],  # transaction date
+            description=transaction_data['name'],  # transaction description
+            merchant_name=merchant_name,  # merchant if available
+            merchant_id=lookups['merchant', merchant_key],  # normalized merchant for grouping
+            category=category_key,  # join categories safely
+            category_ref_id=lookups['category', category_key],  # integer key for grouping
+        )
+
+    # yields successive fixed-size lists from any iterable
+    def _chunked(self, iterable, size):
+        chunk = []
+        for item in iterable:
+            chunk.append(item)
+            if len(chunk) >= size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
     # gets real-time account balances (more current than regular accounts endpoint)
     def get_real_time_balances(self, access_token):
         request = AccountsBalanceGetRequest(access_token=access_token)  # use stored access token
@@ -180,54 +460,183 @@ class PlaidService:
 
     # incremental sync only fetches new/changed transactions since last sync
     def sync_transactions_incremental(self, access_token, cursor=None):
-        request = TransactionsSyncRequest(access_token=access_token)  # use stored access token
+        request = TransactionsSyncRequest(access_token=access_token, count=self.SYNC_PAGE_SIZE)  # use stored access token
         if cursor:
             request.cursor = cursor  # resume from where we left off
             
         try:
             response = self.client.transactions_sync(request)
+            update_status = response.get('transactions_update_status')
             return {
                 'added': response.get('added', []),  # new transactions
                 'modified': response.get('modified', []),  # changed transactions
                 'removed': response.get('removed', []),  # deleted transactions
                 'next_cursor': response.get('next_cursor'),  # bookmark for next sync
-                'has_more': response.get('has_more', False)  # more data available
+                'has_more': response.get('has_more', False),  # more data available
+                # NOT_READY means plaid is still pulling the item's history and the page is empty
+                'transactions_update_status': str(update_status) if update_status else None
             }
         except Exception as e:
             logger.error(f"Error in incremental transaction sync: {e}")
             raise
 
+    # drains /transactions/sync for a plaid token, committing each page with its cursor
+    def run_incremental_sync(self, plaid_token):
+        from core.models import PlaidToken
+
+        summary = {'inserted': 0, 'updated': 0, 'skipped': 0, 'removed': 0, 'pages': 0, 'update_status': None}
+        restarts = 0
+        has_more = True
+        loop_start_cursor = plaid_token.cursor
+
+        while has_more:
+            try:
+                page = self.sync_transactions_incremental(plaid_token.access_token, plaid_token.cursor)
+            except ApiException as e:
+                # plaid requires restarting from the cursor the loop began with, not a mid-pagination
+                # one; upserts and deletes are idempotent so reapplying those pages is safe
+                if plaid_error_code(e) != 'TRANSACTIONS_SYNC_MUTATION_DURING_PAGINATION' or restarts >= self.SYNC_MAX_RESTARTS:
+                    raise
+                restarts += 1
+                logger.warning(f"Transactions changed during sync for item {plaid_token.item_id}, restarting from the loop's first cursor")
+                PlaidToken.objects.filter(pk=plaid_token.pk).update(cursor=loop_start_cursor)
+                plaid_token.cursor = loop_start_cursor
+                continue
+
+            # data and cursor land together so a crash never skips or double-applies a page
+            with db_transaction.atomic():
+                page_summary = self.upsert_transactions(plaid_token.user, page['added'] + page['modified'])
+                removed = self.remove_transactions(plaid_token.user, page['removed'])
+                PlaidToken.objects.filter(pk=plaid_token.pk).update(cursor=page['next_cursor'])
+
+            plaid_token.cursor = page['next_cursor']
+            has_more = page['has_more']
+            summary['update_status'] = page.get('transactions_update_status')
+            summary['pages'] += 1
+            summary['removed'] += removed
+            for key in ('inserted', 'updated', 'skipped'):
+                summary[key] += page_summary[key]
+
+        logger.info(f"Incremental sync for item {plaid_token.item_id} finished: {summary}")
+        return summary
+
+    # deletes transactions plaid reported as removed, returns the number of rows deleted
+    def remove_transactions(self, user, removed_data):
+        from core.models import Transaction
+
+        removed_ids = [removed['transaction_id'] for removed in removed_data]
+        deleted = 0
+        # delete signals update the rollups; batch them into one write per touched row
+        with db_transaction.atomic(), rollup_batch():
+            for chunk in self._chunked(removed_ids, self.TRANSACTION_BATCH_SIZE):
+                deleted += Transaction.objects.filter(
+                    account__user=user,
+                    plaid_transaction_id__in=chunk
+                ).delete()[0]
+        return deleted
+
     # updates our stored account balances with real-time data from plaid
     def update_account_balances(self, user, access_token):
         from core.models import Account
         
         try:
             accounts_data = self.get_real_time_balances(access_token)  # fetch latest balances
+            
+            # load every affected account in one query instead of one get per account
+            accounts = Account.objects.filter(
+                user=user,
+                plaid_account_id__in=[account_data['account_id'] for account_data in accounts_data]
+            ).in_bulk(field_name='plaid_account_id')
             updated_accounts = []
             
-            # update each account's balance in our database
             for account_data in accounts_data:
-                try:
-                    # find the account in our database
-                    account = Account.objects.get(
-                        plaid_account_id=account_data['account_id'],
-                        user=user
-                    )
-                    # update balance fields
-                    account.balance = Decimal(str(account_data['balances']['current'] or 0))
-                    if account_data['balances']['available']:
-                        account.available_balance = Decimal(str(account_data['balances']['available']))
-                    account.save()  # save to database
-                    updated_accounts.append(account)
-                except Account.DoesNotExist:
+                account = accounts.get(account_data['account_id'])
+                if account is None:
                     logger.warning(f"Account not found for balance update: {account_data['account_id']}")
                     continue  # skip this account
+                # update balance fields
+                account.balance = Decimal(str(account_data['balances']['current'] or 0))
+                if account_data['balances']['available']:
+                    account.available_balance = Decimal(str(account_data['balances']['available']))
+                updated_accounts.append(account)
             
+            # single write for all accounts, touching only the balance columns
+            Account.objects.bulk_update(updated_accounts, ['balance', 'available_balance'])
+            if updated_accounts:
+                invalidate_user_context(user.id)
             return updated_accounts
         except Exception as e:
             logger.error(f"Error updating account balances: {e}")
             raise
 
+    # refreshes an item's balances unless the stored ones are still within its ttl
+    def refresh_item_balances(self, plaid_token, force=False):
+        from core.models import Account, PlaidToken
+
+        if not force and plaid_token.balances_are_fresh:
+            stored = Account.objects.filter(plaid_item=plaid_token).count()
+            return {'accounts': stored, 'cached': True}
+
+        accounts = self.update_account_balances(plaid_token.user, plaid_token.access_token)
+        plaid_token.balances_refreshed_at = timezone.now()
+        PlaidToken.objects.filter(pk=plaid_token.pk).update(balances_refreshed_at=plaid_token.balances_refreshed_at)
+        return {'accounts': len(accounts), 'cached': False}
+
+    # syncs every linked item of a user concurrently and merges the results
+    def sync_user_items(self, user, stages=ITEM_SYNC_STAGES, max_workers=None):
+        from core.models import PlaidToken
+
+        plaid_tokens = list(PlaidToken.objects.filter(user=user).select_related('user'))
+        summary = {
+            'items': len(plaid_tokens), 'accounts': 0, 'balances': 0, 'balances_cached': 0,
+            'inserted': 0, 'updated': 0, 'skipped': 0, 'removed': 0,
+            'busy': [], 'errors': {},
+        }
+        if not plaid_tokens:
+            return summary
+
+        # bounded per user so one user with many banks can't monopolise plaid connections
+        workers = min(max_workers or settings.PLAID_USER_SYNC_CONCURRENCY, len(plaid_tokens))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='plaid-item') as executor:
+            futures = {executor.submit(self._sync_item, plaid_token, stages): plaid_token for plaid_token in plaid_tokens}
+            for future in as_completed(futures):
+                plaid_token = futures[future]
+                try:
+                    item_summary = future.result()
+                except SyncInProgress:
+                    summary['busy'].append(plaid_token.sync_key)  # another worker is on it
+                    continue
+                except Exception as e:
+                    # one failing institution shouldn't hide the others' results
+                    logger.error(f"Error syncing item {plaid_token.sync_key}: {e}")
+                    summary['errors'][plaid_token.sync_key] = str(e)
+                    continue
+                for key, value in item_summary.items():
+                    summary[key] += value
+
+        logger.info(f"Synced {summary['items']} items for user {user.id}: {summary}")
+        return summary
+
+    # runs the requested sync stages for one item under its single-flight lock
+    def _sync_item(self, plaid_token, stages):
+        item_summary = {}
+        try:
+            with item_sync_lock(plaid_token.sync_key):
+                if 'accounts' in stages:
+                    accounts = self.sync_accounts(plaid_token.user, plaid_token.access_token, plaid_item=plaid_token)
+                    item_summary['accounts'] = len(accounts)
+                if 'transactions' in stages:
+                    result = self.run_incremental_sync(plaid_token)
+                    for key in ('inserted', 'updated', 'skipped', 'removed'):
+                        item_summary[key] = result[key]
+                if 'balances' in stages:
+                    result = self.refresh_item_balances(plaid_token)
+                    item_summary['balances'] = result['accounts']
+                    item_summary['balances_cached'] = int(result['cached'])
+        finally:
+            connection.close()  # worker threads open their own db connection
+        return item_summary
+
     # maps plaid account types to our internal account types
     def _map_account_type(self, plaid_type):
         # convert enum to string if needed
@@ -251,4 +660,4 @@ class PlaidService:
             return ''
         if isinstance(categories, list):
             return ', '.join(str(cat) for cat in categories)
-        return str(categories)
\ No newline at end of file
+        return str(categories)
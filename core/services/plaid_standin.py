@@ -0,0 +1,217 @@
+# offline stand-in for the plaid api so sync code can run without credentials or network
+from datetime import date, timedelta
+from collections import defaultdict, deque
+import json
+import random
+import time
+
+# simulated per-call latency as (mean, jitter) in milliseconds
+LATENCY_PROFILES = {
+    'none': (0, 0),
+    'fast': (40, 10),
+    'typical': (250, 80),
+    'slow': (1200, 400),
+}
+
+# plaid api methods the recorder captures and the replay client serves
+RECORDED_METHODS = (
+    'accounts_get',
+    'accounts_balance_get',
+    'transactions_get',
+    'transactions_sync',
+    'item_public_token_exchange',
+    'link_token_create',
+)
+
+MERCHANTS = [
+    ('Starbucks', ['Food and Drink', 'Restaurants', 'Coffee Shop']),
+    ('Whole Foods', ['Shops', 'Supermarkets and Groceries']),
+    ('Shell', ['Travel', 'Gas Stations']),
+    ('Uber', ['Travel', 'Taxi']),
+    ('Netflix', ['Service', 'Subscription']),
+    ('Amazon', ['Shops', 'Digital Purchase']),
+    ('Chipotle', ['Food and Drink', 'Restaurants']),
+    ('Con Edison', ['Service', 'Utilities']),
+]
+
+
+# reads a field from a plaid request model or a plain dict
+def _field(request, name, default=None):
+    try:
+        value = request[name]
+    except (KeyError, TypeError, AttributeError):
+        return default
+    return default if value is None else value
+
+
+# in-process fake of the plaid api client used by PlaidService
+class FakePlaidClient:
+    def __init__(self, accounts=3, transactions=500, days=730, latency='none', seed=0, item_id='item-local'):
+        self.random = random.Random(seed)
+        self.latency = LATENCY_PROFILES[latency] if isinstance(latency, str) else latency
+        self.item_id = item_id
+        self.calls = defaultdict(int)  # method name -> times called
+        self.accounts = [self._make_account(index) for index in range(accounts)]
+        self.transactions = {}  # transaction_id -> payload
+        self.events = []  # (kind, payload) log that transactions/sync cursors index into
+        self._next_id = 0
+        self.days = days
+        self.add_transactions(transactions)
+
+    # sleeps according to the latency profile to mimic a round-trip
+    def _wait(self, method):
+        self.calls[method] += 1
+        mean, jitter = self.latency
+        if mean or jitter:
+            time.sleep(max(self.random.gauss(mean, jitter), 0) / 1000)
+
+    def _make_account(self, index):
+        subtype = ['checking', 'savings', 'credit card'][index % 3]
+        current = round(self.random.uniform(100, 9000), 2)
+        return {
+            'account_id': f'acc-{index}',
+            'name': f'Local {subtype.title()} {index}',
+            'type': 'credit' if subtype == 'credit card' else 'depository',
+            'subtype': subtype,
+            'balances': {'current': current, 'available': current, 'iso_currency_code': 'USD'},
+        }
+
+    def _make_transaction(self, day=None):
+        merchant, category = self.random.choice(MERCHANTS)
+        self._next_id += 1
+        return {
+            'transaction_id': f'txn-{self._next_id}',
+            'account_id': self.random.choice(self.accounts)['account_id'],
+            'amount': round(self.random.uniform(1, 250), 2),
+            'date': day or date.today() - timedelta(days=self.random.randrange(self.days)),
+            'name': f'{merchant.upper()} #{self.random.randrange(1000, 9999)}',
+            'merchant_name': merchant,
+            'category': category,
+        }
+
+    # generates new transactions and logs them as sync additions
+    def add_transactions(self, count, day=None):
+        added = [self._make_transaction(day) for _ in range(count)]
+        for transaction in added:
+            self.transactions[transaction['transaction_id']] = transaction
+            self.events.append(('added', transaction))
+        return added
+
+    # changes the amount of existing transactions and logs them as sync modifications
+    def modify_transactions(self, count):
+        modified = []
+        for transaction_id in self.random.sample(sorted(self.transactions), min(count, len(self.transactions))):
+            transaction = dict(self.transactions[transaction_id], amount=round(self.random.uniform(1, 250), 2))
+            self.transactions[transaction_id] = transaction
+            self.events.append(('modified', transaction))
+            modified.append(transaction)
+        return modified
+
+    # deletes existing transactions and logs them as sync removals
+    def remove_transactions(self, count):
+        removed = self.random.sample(sorted(self.transactions), min(count, len(self.transactions)))
+        for transaction_id in removed:
+            del self.transactions[transaction_id]
+            self.events.append(('removed', {'transaction_id': transaction_id}))
+        return removed
+
+    def link_token_create(self, request):
+        self._wait('link_token_create')
+        return {'link_token': 'link-local-token'}
+
+    def item_public_token_exchange(self, request):
+        self._wait('item_public_token_exchange')
+        return {'access_token': f'access-local-{self.item_id}', 'item_id': self.item_id}
+
+    def accounts_get(self, request):
+        self._wait('accounts_get')
+        return {'accounts': [dict(account) for account in self.accounts]}
+
+    def accounts_balance_get(self, request):
+        self._wait('accounts_balance_get')
+        return {'accounts': [dict(account) for account in self.accounts]}
+
+    # date-filtered, newest-first, count/offset paginated like /transactions/get
+    def transactions_get(self, request):
+        self._wait('transactions_get')
+        start_date, end_date = request['start_date'], request['end_date']
+        options = _field(request, 'options', {})
+        count = _field(options, 'count', 100)
+        offset = _field(options, 'offset', 0)
+        matching = sorted(
+            (t for t in self.transactions.values() if start_date <= t['date'] <= end_date),
+            key=lambda t: (t['date'], t['transaction_id']),
+            reverse=True
+        )
+        return {
+            'accounts': [dict(account) for account in self.accounts],
+            'transactions': matching[offset:offset + count],
+            'total_transactions': len(matching),
+        }
+
+    # cursor is the position in the event log, so every call returns only the delta
+    def transactions_sync(self, request):
+        self._wait('transactions_sync')
+        position = int(_field(request, 'cursor', '') or 0)
+        count = _field(request, 'count', 100)
+        page = self.events[position:position + count]
+        next_position = position + len(page)
+        return {
+            'added': [payload for kind, payload in page if kind == 'added'],
+            'modified': [payload for kind, payload in page if kind == 'modified'],
+            'removed': [payload for kind, payload in page if kind == 'removed'],
+            'next_cursor': str(next_position),
+            'has_more': next_position < len(self.events),
+            'transactions_update_status': 'HISTORICAL_UPDATE_COMPLETE',
+        }
+
+
+# wraps a real plaid client and captures responses so they can be replayed offline
+class PlaidRecorder:
+    def __init__(self, client):
+        self.client = client
+        self.records = []
+
+    def __getattr__(self, name):
+        method = getattr(self.client, name)
+        if name not in RECORDED_METHODS:
+            return method
+
+        def record(request):
+            response = method(request)
+            payload = response.to_dict() if hasattr(response, 'to_dict') else response
+            self.records.append({'method': name, 'response': payload})
+            return response
+        return record
+
+    def save(self, path):
+        with open(path, 'w') as fixture:
+            json.dump(self.records, fixture, default=str, indent=2)
+
+
+# serves recorded plaid responses back in the order they were captured
+class ReplayPlaidClient:
+    def __init__(self, records, latency='none', seed=0):
+        self.random = random.Random(seed)
+        self.latency = LATENCY_PROFILES[latency] if isinstance(latency, str) else latency
+        self.responses = defaultdict(deque)
+        for record in records:
+            self.responses[record['method']].append(record['response'])
+
+    @classmethod
+    def from_fixture(cls, path, **kwargs):
+        with open(path) as fixture:
+            return cls(json.load(fixture), **kwargs)
+
+    def __getattr__(self, name):
+        if name not in RECORDED_METHODS:
+            raise AttributeError(name)
+
+        def replay(request):
+            mean, jitter = self.latency
+            if mean or jitter:
+                time.sleep(max(self.random.gauss(mean, jitter), 0) / 1000)
+            if not self.responses[name]:
+                raise LookupError(f"No recorded responses left for {name}")
+            return self.responses[name].popleft()
+        return replay
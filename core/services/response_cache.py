@@ -0,0 +1,82 @@
+# in-process cache of llm replies for repeated questions against unchanged financial data
+from collections import OrderedDict
+from django.conf import settings
+import hashlib
+import json
+import re
+import threading
+import time
+
+# leading pleasantries that don't change the answer
+_FILLER = re.compile(r"^(?:(?:hey|hi|hello|ok|okay|so|please|bal\.?ai)[\s,!.]+)+", re.IGNORECASE)
+_APOSTROPHES = re.compile(r"['’]")
+# keep digits, dollar amounts and percentages; everything else is just punctuation
+_PUNCTUATION = re.compile(r"[^\w\s$%.]|(?<!\d)\.|\.(?!\d)")
+_SPACES = re.compile(r'\s+')
+
+# cache key -> (expires_at, reply), least recently used first
+_entries = OrderedDict()
+_lock = threading.Lock()
+_stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0}
+
+
+# folds case, punctuation, contractions and greetings so near-identical prompts share a key
+def normalize_question(question):
+    text = _SPACES.sub(' ', str(question)).strip()
+    text = _FILLER.sub('', text)
+    text = _APOSTROPHES.sub('', text)
+    text = _PUNCTUATION.sub(' ', text)
+    return _SPACES.sub(' ', text).strip().casefold()
+
+
+# replies depend on the question, the user's data version and any earlier turns
+def response_key(user_id, context_version, question, history=None):
+    history = history or {}
+    fingerprint = ''
+    if history.get('turns') or history.get('summary'):
+        fingerprint = hashlib.sha1(
+            json.dumps([history.get('summary', ''), history.get('turns', [])], sort_keys=True).encode()
+        ).hexdigest()
+    return (user_id, context_version, normalize_question(question), fingerprint)
+
+
+def get_cached_response(key):
+    now = time.monotonic()
+    with _lock:
+        entry = _entries.get(key)
+        if entry is None:
+            _stats['misses'] += 1
+            return None
+        expires_at, reply = entry
+        if expires_at <= now:
+            del _entries[key]
+            _stats['expirations'] += 1
+            _stats['misses'] += 1
+            return None
+        _entries.move_to_end(key)
+        _stats['hits'] += 1
+        return reply
+
+
+def cache_response(key, reply):
+    expires_at = time.monotonic() + settings.LLM_RESPONSE_CACHE_SECONDS
+    with _lock:
+        _entries[key] = (expires_at, reply)
+        _entries.move_to_end(key)
+        while len(_entries) > settings.LLM_RESPONSE_CACHE_SIZE:
+            _entries.popitem(last=False)
+            _stats['evictions'] += 1
+
+
+# hit/miss counters plus current size, for logs and admin checks
+def response_cache_stats():
+    with _lock:
+        lookups = _stats['hits'] + _stats['misses']
+        return dict(_stats, size=len(_entries), hit_rate=_stats['hits'] / lookups if lookups else 0.0)
+
+
+def clear_response_cache():
+    with _lock:
+        _entries.clear()
+        for name in _stats:
+            _stats[name] = 0
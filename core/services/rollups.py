@@ -0,0 +1,254 @@
+# monthly spending rollups maintained incrementally from transaction writes
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Q, Sum, Value, DecimalField
+from django.db.models.functions import Coalesce, TruncMonth
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import date
+from decimal import Decimal
+import threading
+
+ZERO = Decimal('0.00')
+
+# active batches for the current thread; the innermost one collects deltas
+_batches = threading.local()
+
+
+def month_start(day):
+    # replayed plaid payloads carry iso strings rather than dates
+    if isinstance(day, str):
+        day = date.fromisoformat(day)
+    return day.replace(day=1)
+
+
+# accumulates rollup changes so a bulk write costs one update per touched row
+class RollupDelta:
+    def __init__(self):
+        # (user_id, month, dimension, key) -> [income, spend, count]
+        self.changes = defaultdict(lambda: [ZERO, ZERO, 0])
+
+    # folds one transaction in (sign=1) or out (sign=-1) of its month's rows
+    def add(self, user_id, amount, day, category_id, merchant_id, sign=1):
+        from core.models import SpendingRollup
+
+        amount = Decimal(str(amount))
+        income = amount if amount > 0 else ZERO
+        spend = -amount if amount < 0 else ZERO
+        month = month_start(day)
+        for dimension, key in (
+            (SpendingRollup.TOTAL, 0),
+            (SpendingRollup.CATEGORY, category_id or 0),
+            (SpendingRollup.MERCHANT, merchant_id or 0),
+        ):
+            change = self.changes[user_id, month, dimension, key]
+            change[0] += sign * income
+            change[1] += sign * spend
+            change[2] += sign
+
+    def remove(self, user_id, amount, day, category_id, merchant_id):
+        self.add(user_id, amount, day, category_id, merchant_id, sign=-1)
+
+    def merge(self, other):
+        for row_key, (income, spend, count) in other.changes.items():
+            change = self.changes[row_key]
+            change[0] += income
+            change[1] += spend
+            change[2] += count
+
+    def apply(self):
+        from core.models import SpendingRollup
+
+        changes = {row_key: change for row_key, change in self.changes.items() if any(change)}
+        self.changes.clear()
+        if not changes:
+            return
+        user_ids = {row_key[0] for row_key in changes}
+        months = {row_key[1] for row_key in changes}
+
+        # one read tells which rows need an increment and which are new
+        existing = set(SpendingRollup.objects.filter(user_id__in=user_ids, month__in=months).values_list(
+            'user_id', 'month', 'dimension', 'key'
+        ).order_by())
+        created = []
+        for row_key, (income, spend, count) in changes.items():
+            if row_key in existing:
+                _increment(row_key, income, spend, count)
+            elif count > 0:
+                created.append((row_key, (income, spend, count)))
+
+        if created:
+            try:
+                # savepoint so a concurrent insert of the same row doesn't poison the outer transaction
+                with transaction.atomic():
+                    SpendingRollup.objects.bulk_create([
+                        SpendingRollup(
+                            user_id=user_id, month=month, dimension=dimension, key=key,
+                            income=income, spend=spend, transaction_count=count,
+                        )
+                        for (user_id, month, dimension, key), (income, spend, count) in created
+                    ])
+            except IntegrityError:
+                for row_key, (income, spend, count) in created:
+                    if not _increment(row_key, income, spend, count):
+                        SpendingRollup.objects.create(
+                            user_id=row_key[0], month=row_key[1], dimension=row_key[2], key=row_key[3],
+                            income=income, spend=spend, transaction_count=count,
+                        )
+
+        # drop rows whose last transaction moved out
+        if any(count < 0 for _, _, count in changes.values()):
+            SpendingRollup.objects.filter(user_id__in=user_ids, transaction_count__lte=0).delete()
+
+
+def _increment(row_key, income, spend, count):
+    from core.models import SpendingRollup
+
+    user_id, month, dimension, key = row_key
+    return SpendingRollup.objects.filter(user_id=user_id, month=month, dimension=dimension, key=key).update(
+        income=F('income') + income,
+        spend=F('spend') + spend,
+        transaction_count=F('transaction_count') + count,
+    )
+
+
+# collects rollup changes for the block and applies them once when it finishes
+@contextmanager
+def rollup_batch():
+    stack = getattr(_batches, 'stack', None)
+    if stack is None:
+        stack = _batches.stack = []
+    delta = RollupDelta()
+    stack.append(delta)
+    try:
+        yield delta
+    finally:
+        stack.pop()
+    # only reached without an exception; nested batches hand their changes to the outer one
+    if stack:
+        stack[-1].merge(delta)
+    else:
+        delta.apply()
+
+
+# records a single transaction change, deferring to the active batch if there is one
+def record_transaction(user_id, amount, day, category_id, merchant_id, sign=1):
+    stack = getattr(_batches, 'stack', None)
+    if stack:
+        stack[-1].add(user_id, amount, day, category_id, merchant_id, sign)
+        return
+    delta = RollupDelta()
+    delta.add(user_id, amount, day, category_id, merchant_id, sign)
+    delta.apply()
+
+
+# recomputes every rollup row for a user from the transactions table
+def rebuild_user_rollups(user_id):
+    from core.models import SpendingRollup, Transaction
+
+    money = DecimalField(max_digits=14, decimal_places=2)
+    rows = []
+    with transaction.atomic():
+        SpendingRollup.objects.filter(user_id=user_id).delete()
+        monthly = Transaction.objects.filter(account__user_id=user_id).annotate(month=TruncMonth('date'))
+        for dimension, field in (
+            (SpendingRollup.TOTAL, None),
+            (SpendingRollup.CATEGORY, 'category_ref_id'),
+            (SpendingRollup.MERCHANT, 'merchant_id'),
+        ):
+            grouped = monthly.values('month', field) if field else monthly.values('month')
+            for row in grouped.annotate(
+                income=Coalesce(Sum('amount', filter=Q(amount__gt=0)), Value(ZERO), output_field=money),
+                spend=Coalesce(-Sum('amount', filter=Q(amount__lt=0)), Value(ZERO), output_field=money),
+                transaction_count=Count('id'),
+            ).order_by():
+                rows.append(SpendingRollup(
+                    user_id=user_id,
+                    month=row['month'],
+                    dimension=dimension,
+                    key=(row[field] or 0) if field else 0,
+                    income=row['income'],
+                    spend=row['spend'],
+                    transaction_count=row['transaction_count'],
+                ))
+        SpendingRollup.objects.bulk_create(rows)
+    return len(rows)
+
+
+def _cash_flow_query(user_id, months):
+    from core.models import SpendingRollup
+
+    return SpendingRollup.objects.filter(
+        user_id=user_id, dimension=SpendingRollup.TOTAL
+    ).order_by('-month').values('month', 'income', 'spend')[:months]
+
+
+# walks backwards from today's balance, undoing each later month's net flow
+def _cash_flow(totals, current_balance):
+    balance = Decimal(str(current_balance))
+    flow = []
+    for row in totals:
+        net = row['income'] - row['spend']
+        flow.append({
+            'month': row['month'].strftime('%Y-%m'),
+            'income': row['income'],
+            'spend': row['spend'],
+            'net': net,
+            'end_balance': balance,
+        })
+        balance -= net
+    return flow
+
+
+# income, spend, net and end-of-month balance for the latest months, newest first
+def monthly_cash_flow(user_id, current_balance, months=12):
+    return _cash_flow(_cash_flow_query(user_id, months), current_balance)
+
+
+async def amonthly_cash_flow(user_id, current_balance, months=12):
+    return _cash_flow([row async for row in _cash_flow_query(user_id, months)], current_balance)
+
+
+def _spend_query(user_id, dimension, since):
+    from core.models import SpendingRollup
+
+    return SpendingRollup.objects.filter(
+        user_id=user_id, dimension=dimension, month__gte=month_start(since), spend__gt=0
+    ).values('key').annotate(total=Sum('spend')).values_list('key', 'total')
+
+
+# categories roll up to their top level; merchants use their display name
+def _names_query(dimension, keys):
+    from core.models import Category, Merchant, SpendingRollup
+
+    if dimension == SpendingRollup.CATEGORY:
+        return Category.objects.filter(pk__in=keys).values_list('pk', 'path')
+    return Merchant.objects.filter(pk__in=keys).values_list('pk', 'name')
+
+
+def _rank(dimension, spend_by_key, names, limit):
+    from core.models import SpendingRollup
+
+    if dimension == SpendingRollup.CATEGORY:
+        names = {pk: path.split(', ')[0] for pk, path in names}
+        fallback = 'Uncategorized'
+    else:
+        names = dict(names)
+        fallback = 'Unknown merchant'
+
+    totals = defaultdict(lambda: ZERO)
+    for key, spend in spend_by_key.items():
+        totals[names.get(key, fallback)] += spend
+    ranked = sorted(totals.items(), key=lambda item: item[1], reverse=True)[:limit]
+    return [{'name': name, 'spend': spend} for name, spend in ranked]
+
+
+# largest spend per category (rolled up to top level) or merchant since a given month
+def top_spending(user_id, dimension, since, limit=10):
+    spend_by_key = dict(_spend_query(user_id, dimension, since))
+    return _rank(dimension, spend_by_key, list(_names_query(dimension, spend_by_key)), limit)
+
+
+async def atop_spending(user_id, dimension, since, limit=10):
+    spend_by_key = {key: total async for key, total in _spend_query(user_id, dimension, since)}
+    names = [row async for row in _names_query(dimension, list(spend_by_key))]
+    return _rank(dimension, spend_by_key, names, limit)
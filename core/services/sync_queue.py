@@ -0,0 +1,76 @@
+# coordination helpers for plaid item syncs shared by webhooks, views and celery
+from django.conf import settings
+from django.core.cache import cache
+from contextlib import contextmanager
+import uuid
+
+
+# raised when every slot of a concurrency cap is taken
+class NoSlotAvailable(Exception):
+    pass
+
+
+# raised when another worker already holds the sync lock for an item
+class SyncInProgress(Exception):
+    def __init__(self, item_id):
+        super().__init__(f"Sync already in progress for item {item_id}")
+        self.item_id = item_id
+
+
+def _lock_key(item_id):
+    return f'plaid:sync-lock:{item_id}'
+
+
+def _pending_key(item_id):
+    return f'plaid:sync-pending:{item_id}'
+
+
+# single-flight lock so an item is never synced by two workers at once
+@contextmanager
+def item_sync_lock(item_id):
+    key = _lock_key(item_id)
+    owner = uuid.uuid4().hex
+    # cache.add is atomic on shared backends, and the timeout frees the lock if a worker dies
+    if not cache.add(key, owner, timeout=settings.PLAID_SYNC_LOCK_TIMEOUT):
+        raise SyncInProgress(item_id)
+    try:
+        yield
+    finally:
+        if cache.get(key) == owner:
+            cache.delete(key)
+
+
+# returns true when an item was idle, false when a sync is already scheduled
+def mark_item_pending(item_id):
+    timeout = settings.PLAID_WEBHOOK_DEBOUNCE_SECONDS + settings.PLAID_SYNC_LOCK_TIMEOUT
+    return cache.add(_pending_key(item_id), True, timeout=timeout)
+
+
+# lets the next event for the item schedule a fresh run
+def clear_item_pending(item_id):
+    cache.delete(_pending_key(item_id))
+
+
+# counting semaphore made of `limit` expiring slot keys, so a crashed worker's slot frees itself
+@contextmanager
+def concurrency_slot(name, limit):
+    owner = uuid.uuid4().hex
+    for index in range(limit):
+        key = f'plaid:slot:{name}:{index}'
+        if cache.add(key, owner, timeout=settings.PLAID_SYNC_LOCK_TIMEOUT):
+            break
+    else:
+        raise NoSlotAvailable(name)
+    try:
+        yield
+    finally:
+        if cache.get(key) == owner:
+            cache.delete(key)
+
+
+# holds a global and a per-institution slot for the duration of a background sync
+@contextmanager
+def plaid_sync_slots(institution_id):
+    with concurrency_slot('global', settings.PLAID_MAX_CONCURRENT_SYNCS):
+        with concurrency_slot(f'institution:{institution_id or "unknown"}', settings.PLAID_MAX_CONCURRENT_SYNCS_PER_INSTITUTION):
+            yield
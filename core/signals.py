@@ -0,0 +1,63 @@
+# keeps cached llm context and spending rollups in step with account and transaction writes
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
+from .models import Account, Transaction
+from .services.context_cache import invalidate_user_context
+from .services.rollups import record_transaction
+
+# account id -> owner, so transaction signals don't query once per row during bulk deletes
+_account_owners = {}
+
+
+def _account_owner(account_id):
+    user_id = _account_owners.get(account_id)
+    if user_id is None:
+        user_id = Account.objects.filter(pk=account_id).values_list('user_id', flat=True).first()
+        if user_id is not None:
+            _account_owners[account_id] = user_id
+    return user_id
+
+
+@receiver(post_save, sender=Account)
+def account_saved(sender, instance, **kwargs):
+    _account_owners[instance.pk] = instance.user_id
+    invalidate_user_context(instance.user_id)
+
+
+@receiver(post_delete, sender=Account)
+def account_deleted(sender, instance, **kwargs):
+    _account_owners.pop(instance.pk, None)
+    invalidate_user_context(instance.user_id)
+
+
+# remembers the stored row so an edit can move its amount out of the old rollups
+@receiver(pre_save, sender=Transaction)
+def transaction_saving(sender, instance, raw=False, **kwargs):
+    instance._rollup_previous = None
+    if instance.pk and not raw:
+        instance._rollup_previous = Transaction.objects.filter(pk=instance.pk).values(
+            'account_id', 'amount', 'date', 'category_ref_id', 'merchant_id'
+        ).first()
+
+
+@receiver(post_save, sender=Transaction)
+def transaction_saved(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    previous = getattr(instance, '_rollup_previous', None)
+    if previous:
+        previous_owner = _account_owner(previous['account_id'])
+        if previous_owner is not None:
+            record_transaction(previous_owner, previous['amount'], previous['date'], previous['category_ref_id'], previous['merchant_id'], sign=-1)
+    user_id = _account_owner(instance.account_id)
+    if user_id is not None:
+        record_transaction(user_id, instance.amount, instance.date, instance.category_ref_id, instance.merchant_id)
+        invalidate_user_context(user_id)
+
+
+@receiver(post_delete, sender=Transaction)
+def transaction_deleted(sender, instance, **kwargs):
+    user_id = _account_owner(instance.account_id)
+    if user_id is not None:
+        record_transaction(user_id, instance.amount, instance.date, instance.category_ref_id, instance.merchant_id, sign=-1)
+        invalidate_user_context(user_id)
@@ -1,70 +1,132 @@
 # celery tasks for background processing
-from celery import shared_task
+from celery import shared_task, chain
+from celery.signals import task_revoked
 from channels.layers import get_channel_layer
 from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.db.models import F, Q
+from django.utils import timezone
+from plaid.exceptions import ApiException
+from datetime import datetime, timedelta
+import hashlib
 import json
+import logging
+import random
+import uuid
 
-from .models import Conversation, Message, User
+from .models import Conversation, Message, User, PlaidToken
 from .services.llm import LLMService
+from .services.history import conversation_window, record_message, summarize_older_turns
+from .services.chat_dispatch import finish_generation, is_current_generation
+from .services.chat_replay import remember_message
+from .services.llm_quota import QuotaExceeded, AdmissionRejected
+from .services.plaid import PlaidService, plaid_connection_stats, plaid_error_code
+from .services.sync_queue import (
+    NoSlotAvailable,
+    SyncInProgress,
+    clear_item_pending,
+    item_sync_lock,
+    mark_item_pending,
+    plaid_sync_slots,
+)
+
+logger = logging.getLogger(__name__)
+
+# backfill retries while plaid is still preparing the item's transactions
+BACKFILL_MAX_RETRIES = 6
+BACKFILL_RETRY_BASE_SECONDS = 5
+BACKFILL_RETRY_MAX_SECONDS = 300
+# scheduled syncs waiting for a free slot give up well inside the scheduler's lease
+SCHEDULED_SYNC_MAX_RETRIES = 5
 
 
 @shared_task
-def process_chat_message_async(conversation_id, user_id, message_content):
+def process_chat_message_async(conversation_id, user_id, user_message_id, generation_id, stream_id):
     """
-    background task to process chat messages and stream responses
+    generates the reply to a saved user message and streams it back over the channel layer
     """
+    channel_layer = get_channel_layer()
+    room_group_name = f'chat_{conversation_id}'
     try:
-        # get conversation and user
-        conversation = Conversation.objects.get(id=conversation_id)
+        if not is_current_generation(conversation_id, generation_id):
+            # the user sent another message while this one waited in the queue
+            return {'success': False, 'cancelled': True}
+
         user = User.objects.get(id=user_id)
-        
-        # save user message
-        user_message = Message.objects.create(
-            conversation=conversation,
-            role='user',
-            content=message_content
-        )
-        
-        # get ai response
-        llm_service = LLMService()
-        ai_response = llm_service.get_response(
-            message=message_content,
-            user=user
-        )
-        
+        user_message = Message.objects.get(id=user_message_id, conversation_id=conversation_id)
+        history = conversation_window(conversation_id, before=user_message.id)
+
+        parts = []
+        replies = LLMService().stream_financial_advice(user_message.content, user, history=history)
+        try:
+            for delta in replies:
+                if not is_current_generation(conversation_id, generation_id):
+                    # closing the generator closes the claude stream, so generation stops here
+                    async_to_sync(channel_layer.group_send)(
+                        room_group_name,
+                        {'type': 'chat_cancelled', 'stream_id': stream_id}
+                    )
+                    logger.info(f"Cancelled stale generation {generation_id} for conversation {conversation_id}")
+                    return {'success': False, 'cancelled': True}
+                parts.append(delta)
+                async_to_sync(channel_layer.group_send)(
+                    room_group_name,
+                    {
+                        'type': 'chat_delta',
+                        'stream_id': stream_id,
+                        'delta': delta,
+                        'role': 'assistant'
+                    }
+                )
+        finally:
+            replies.close()
+
         # save ai response
+        ai_response = ''.join(parts)
         ai_message = Message.objects.create(
-            conversation=conversation,
+            conversation_id=conversation_id,
             role='assistant',
             content=ai_response
         )
-        
-        # send response via websocket
-        channel_layer = get_channel_layer()
-        room_group_name = f'chat_{conversation_id}'
-        
+        record_message(ai_message)
+        remember_message(ai_message)
+
+        # send final message so clients can replace the streamed draft
         async_to_sync(channel_layer.group_send)(
             room_group_name,
             {
-                'type': 'chat_message',
+                'type': 'chat_done',
+                'stream_id': stream_id,
                 'message': ai_response,
                 'role': 'assistant',
+                'seq': ai_message.id,
                 'message_id': ai_message.id,
                 'timestamp': ai_message.timestamp.isoformat()
             }
         )
-        
+
         return {
             'success': True,
             'user_message_id': user_message.id,
             'ai_message_id': ai_message.id
         }
-        
+
+    except (QuotaExceeded, AdmissionRejected) as e:
+        # over quota or no free generation slot: tell the user when to retry
+        async_to_sync(channel_layer.group_send)(
+            room_group_name,
+            {
+                'type': 'chat_message',
+                'message': str(e),
+                'role': 'assistant',
+                'error': True,
+                'retry_after': e.retry_after
+            }
+        )
+        return {'success': False, 'error': str(e)}
+
     except Exception as e:
         # send error message via websocket
-        channel_layer = get_channel_layer()
-        room_group_name = f'chat_{conversation_id}'
-        
         async_to_sync(channel_layer.group_send)(
             room_group_name,
             {
@@ -78,4 +140,294 @@ def process_chat_message_async(conversation_id, user_id, message_content):
         return {
             'success': False,
             'error': str(e)
-        }
\ No newline at end of file
+        }
+
+    finally:
+        finish_generation(conversation_id, generation_id)
+
+
+# a chat task revoked before it ran (usually by its expires deadline) never reaches its finally,
+# so free its queue slot here and tell the conversation the message went unanswered
+@task_revoked.connect
+def chat_task_revoked(sender=None, request=None, terminated=False, expired=False, **kwargs):
+    if getattr(sender, 'name', None) != process_chat_message_async.name:
+        return
+    conversation_id, _, _, generation_id, stream_id = request.args
+    finish_generation(conversation_id, generation_id)
+    logger.warning(f"Chat generation {generation_id} for conversation {conversation_id} was revoked (expired={expired})")
+    channel_layer = get_channel_layer()
+    if terminated:
+        # killed mid-stream: drop the partial draft
+        async_to_sync(channel_layer.group_send)(
+            f'chat_{conversation_id}',
+            {'type': 'chat_cancelled', 'stream_id': stream_id}
+        )
+    async_to_sync(channel_layer.group_send)(
+        f'chat_{conversation_id}',
+        {
+            'type': 'chat_message',
+            'message': 'Sorry, I couldn\'t get to your message in time. Please send it again.',
+            'role': 'assistant',
+            'error': True
+        }
+    )
+
+
+# channel group that receives sync progress for one user's dashboard
+def sync_progress_group(user_id):
+    return f'sync_{user_id}'
+
+
+# pushes a sync stage update to the user's dashboard over the channel layer
+def send_sync_progress(user_id, job_id, stage, status, **extra):
+    channel_layer = get_channel_layer()
+    async_to_sync(channel_layer.group_send)(
+        sync_progress_group(user_id),
+        {
+            'type': 'sync_progress',
+            'job_id': job_id,
+            'stage': stage,  # exchange, accounts, transactions
+            'status': status,  # started, done, retrying, failed
+            **extra
+        }
+    )
+
+
+# queues the plaid onboarding pipeline and returns its job id right away
+def start_plaid_onboarding(user_id, public_token, institution_id=None):
+    job_id = uuid.uuid4().hex
+    chain(
+        plaid_exchange_token_task.si(job_id, user_id, public_token, institution_id),
+        # each stage hands the new item_id to the next
+        plaid_sync_accounts_task.s(job_id, user_id),
+        plaid_backfill_transactions_task.s(job_id, user_id),
+    ).apply_async()
+    return job_id
+
+
+@shared_task
+def plaid_exchange_token_task(job_id, user_id, public_token, institution_id=None):
+    """
+    exchanges the public token from plaid link and stores the item
+    """
+    send_sync_progress(user_id, job_id, 'exchange', 'started')
+    try:
+        exchange = PlaidService().exchange_public_token(public_token)
+        # each linked institution is its own item, so earlier banks are kept
+        PlaidToken.objects.update_or_create(
+            item_id=exchange['item_id'],
+            defaults={
+                'user_id': user_id,
+                'access_token': exchange['access_token'],
+                'institution_id': institution_id,
+                'cursor': None,  # new item, start sync from scratch
+            }
+        )
+    except Exception as e:
+        send_sync_progress(user_id, job_id, 'exchange', 'failed', error=str(e))
+        raise
+    send_sync_progress(user_id, job_id, 'exchange', 'done')
+    return exchange['item_id']
+
+
+@shared_task
+def plaid_sync_accounts_task(item_id, job_id, user_id):
+    """
+    pulls the new item's accounts into our database
+    """
+    send_sync_progress(user_id, job_id, 'accounts', 'started')
+    try:
+        plaid_token = PlaidToken.objects.select_related('user').get(item_id=item_id)
+        accounts = PlaidService().sync_accounts(plaid_token.user, plaid_token.access_token, plaid_item=plaid_token)
+    except Exception as e:
+        send_sync_progress(user_id, job_id, 'accounts', 'failed', error=str(e))
+        raise
+    send_sync_progress(user_id, job_id, 'accounts', 'done', count=len(accounts))
+    return item_id
+
+
+@shared_task(bind=True, max_retries=BACKFILL_MAX_RETRIES)
+def plaid_backfill_transactions_task(self, item_id, job_id, user_id):
+    """
+    loads the item's transaction history, backing off while plaid prepares it
+    """
+    if self.request.retries == 0:
+        send_sync_progress(user_id, job_id, 'transactions', 'started')
+    try:
+        plaid_token = PlaidToken.objects.select_related('user').get(item_id=item_id)
+        with item_sync_lock(plaid_token.sync_key):
+            # drain /transactions/sync so the item leaves onboarding with a cursor; otherwise the
+            # first webhook or manual sync would download the whole history a second time
+            summary = PlaidService().run_incremental_sync(plaid_token)
+    except SyncInProgress as e:
+        # a webhook sync got to the new item first; back off until it finishes
+        raise _retry_backfill(self, job_id, user_id, exc=e)
+    except ApiException as e:
+        if plaid_error_code(e) == 'PRODUCT_NOT_READY' and self.request.retries < self.max_retries:
+            raise _retry_backfill(self, job_id, user_id, exc=e)
+        send_sync_progress(user_id, job_id, 'transactions', 'failed', error=str(e))
+        raise
+    except Exception as e:
+        send_sync_progress(user_id, job_id, 'transactions', 'failed', error=str(e))
+        raise
+
+    # /transactions/sync answers an empty page until plaid has pulled the first batch,
+    # which usually takes a few seconds to minutes after linking
+    if summary['update_status'] == 'NOT_READY':
+        if self.request.retries < self.max_retries:
+            raise _retry_backfill(self, job_id, user_id)
+        # the webhook plaid sends once the item is ready (or the next scheduled sync) picks it up
+        logger.warning(f"Transactions for item {item_id} still not ready after {self.request.retries} retries")
+    send_sync_progress(user_id, job_id, 'transactions', 'done', **summary)
+    return summary
+
+
+# reports the wait and schedules the next backfill attempt with exponential backoff
+def _retry_backfill(task, job_id, user_id, exc=None):
+    countdown = min(BACKFILL_RETRY_BASE_SECONDS * 2 ** task.request.retries, BACKFILL_RETRY_MAX_SECONDS)
+    send_sync_progress(user_id, job_id, 'transactions', 'retrying', retry_in=countdown)
+    return task.retry(exc=exc, countdown=countdown)
+
+
+@shared_task
+def summarize_conversation_task(conversation_id):
+    """
+    folds conversation turns that fell out of the history window into the rolling summary
+    """
+    try:
+        folded = summarize_older_turns(conversation_id)
+    except Conversation.DoesNotExist:
+        return 0
+    if folded:
+        logger.info(f"Summarized {folded} messages for conversation {conversation_id}")
+    return folded
+
+
+# collapses bursts of webhook events for an item into one debounced sync run
+def enqueue_item_sync(item_id):
+    if mark_item_pending(item_id):
+        sync_plaid_item_task.apply_async(args=[item_id], countdown=settings.PLAID_WEBHOOK_DEBOUNCE_SECONDS)
+        return True
+    return False  # already scheduled, this event rides along
+
+
+@shared_task
+def sync_plaid_item_task(item_id):
+    """
+    applies pending transaction updates and refreshes balances for one plaid item
+    """
+    # events that arrive while we sync schedule a follow-up run
+    clear_item_pending(item_id)
+    try:
+        plaid_token = PlaidToken.objects.select_related('user').get(item_id=item_id)
+    except PlaidToken.DoesNotExist:
+        logger.warning(f"Ignoring sync for unknown Plaid item {item_id}")
+        return None
+
+    try:
+        summary = _run_item_sync(plaid_token)
+    except (SyncInProgress, NoSlotAvailable):
+        # someone else is syncing this item or plaid capacity is full; fold into a later run
+        enqueue_item_sync(item_id)
+        return None
+    except Exception as e:
+        _record_sync_failure(plaid_token, e)
+        raise
+    return summary
+
+
+# stable per-item offset so items spread across the jitter window instead of firing together
+def item_jitter(item_id):
+    if not settings.PLAID_SYNC_JITTER_SECONDS:
+        return 0
+    digest = hashlib.sha1(str(item_id).encode()).hexdigest()
+    return int(digest, 16) % settings.PLAID_SYNC_JITTER_SECONDS
+
+
+# transaction delta + balances under the item lock and the global/institution caps
+def _run_item_sync(plaid_token):
+    with plaid_sync_slots(plaid_token.institution_id):
+        with item_sync_lock(plaid_token.sync_key):
+            plaid_service = PlaidService()
+            summary = plaid_service.run_incremental_sync(plaid_token)
+            plaid_service.refresh_item_balances(plaid_token)  # skipped while balances are fresh
+    _record_sync_success(plaid_token)
+    # process-wide totals; new_connections climbing with requests means keep-alive isn't holding
+    logger.info(f"Synced Plaid item {plaid_token.item_id}: {summary}; connections {plaid_connection_stats()}")
+    return summary
+
+
+def _record_sync_success(plaid_token):
+    now = timezone.now()
+    jitter = random.uniform(0, settings.PLAID_SYNC_JITTER_SECONDS)
+    PlaidToken.objects.filter(pk=plaid_token.pk).update(
+        last_synced_at=now,
+        next_sync_at=now + timedelta(seconds=settings.PLAID_SCHEDULED_SYNC_INTERVAL + jitter),
+        sync_failures=0,
+        last_sync_error='',
+    )
+
+
+# exponential backoff so a broken item doesn't get retried every cycle
+def _record_sync_failure(plaid_token, error):
+    failures = plaid_token.sync_failures + 1
+    backoff = min(settings.PLAID_SCHEDULED_SYNC_INTERVAL * 2 ** (failures - 1), settings.PLAID_SYNC_MAX_BACKOFF_SECONDS)
+    jitter = random.uniform(0, settings.PLAID_SYNC_JITTER_SECONDS)
+    logger.error(f"Sync failed for item {plaid_token.sync_key} ({failures} in a row): {error}")
+    PlaidToken.objects.filter(pk=plaid_token.pk).update(
+        next_sync_at=timezone.now() + timedelta(seconds=backoff + jitter),
+        sync_failures=failures,
+        last_sync_error=str(error)[:1000],
+    )
+
+
+@shared_task
+def schedule_plaid_syncs():
+    """
+    dispatches background refreshes for every linked item that is due
+    """
+    now = timezone.now()
+    due = list(
+        PlaidToken.objects.filter(item_id__isnull=False)
+        .filter(Q(next_sync_at__isnull=True) | Q(next_sync_at__lte=now))
+        .order_by(F('next_sync_at').asc(nulls_first=True))
+        .values_list('pk', 'item_id')[:settings.PLAID_SCHEDULER_BATCH_SIZE]
+    )
+    if not due:
+        return 0
+
+    # lease the items so the next tick doesn't dispatch them again while they wait in the queue
+    lease = now + timedelta(seconds=settings.PLAID_SYNC_JITTER_SECONDS + settings.PLAID_SYNC_LOCK_TIMEOUT)
+    PlaidToken.objects.filter(pk__in=[pk for pk, _ in due]).update(next_sync_at=lease)
+    for _, item_id in due:
+        scheduled_sync_item_task.apply_async(args=[item_id, lease.isoformat()], countdown=item_jitter(item_id))
+    logger.info(f"Dispatched {len(due)} scheduled Plaid syncs")
+    return len(due)
+
+
+@shared_task(bind=True, max_retries=SCHEDULED_SYNC_MAX_RETRIES)
+def scheduled_sync_item_task(self, item_id, lease=None):
+    """
+    periodic refresh of one plaid item, respecting the concurrency caps
+    """
+    try:
+        plaid_token = PlaidToken.objects.select_related('user').get(item_id=item_id)
+    except PlaidToken.DoesNotExist:
+        return None
+
+    # a sync already ran or a later tick re-leased the item, so this dispatch is stale
+    if lease is not None and plaid_token.next_sync_at != datetime.fromisoformat(lease):
+        return None
+
+    try:
+        return _run_item_sync(plaid_token)
+    except NoSlotAvailable as e:
+        if self.request.retries >= self.max_retries:
+            return None  # the lease runs out and the scheduler dispatches the item again
+        # capacity is full right now; try again shortly without counting it as a failure
+        raise self.retry(exc=e, countdown=random.uniform(10, 60))
+    except SyncInProgress:
+        return None  # a webhook or manual sync is already refreshing it
+    except Exception as e:
+        _record_sync_failure(plaid_token, e)
+        return None
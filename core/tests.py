@@ -1,41 +1,76 @@
-from django.test import TestCase, Client
+from django.test import TestCase, TransactionTestCase, Client, override_settings
 from django.contrib.auth.models import User
 from django.urls import reverse
+from django.core.cache import cache
+from django.utils import timezone
+from django.apps import apps as django_apps
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.conf import settings
+from django.db.models import Sum
 from decimal import Decimal
-from unittest.mock import patch, MagicMock
+from datetime import date, timedelta
+from unittest.mock import patch, MagicMock, AsyncMock
+import asyncio
+import http.server
+import importlib
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import unittest
+from asgiref.sync import async_to_sync, sync_to_async
+from celery.signals import task_revoked
+from channels.testing import WebsocketCommunicator
 
-from .models import UserProfile, Account, Transaction, Goal
-from .services.llm import LLMService
+from plaid.exceptions import ApiException
 
+from .models import Account, Transaction, PlaidToken, Category, Merchant, SpendingRollup, LLMUsageRecord, LLMDailyUsage, Conversation, Message
+from .consumers import ChatConsumer
+from .services.llm import LLMService, AsyncLLMService
+from .services.context_cache import get_context_version
+from .services.rollups import rebuild_user_rollups
+from .services.history import conversation_window, summarize_older_turns, record_message
+from .services.response_cache import normalize_question, response_cache_stats, clear_response_cache
+from .services.llm_quota import llm_admission, check_quota, record_usage, QuotaExceeded, AdmissionRejected
+from .services.chat_replay import remember_message, missed_messages
+from .services.chat_dispatch import start_generation, finish_generation, is_current_generation, ConversationBusy
+from .tasks import process_chat_message_async
+from .services.plaid import PlaidService, get_plaid_client, reset_plaid_clients, plaid_connection_stats
+from .services.sync_queue import item_sync_lock, plaid_sync_slots, NoSlotAvailable
+from .services.categories import intern_category, clear_category_cache
+from .services.merchants import intern_merchant, normalize_merchant_name, clear_merchant_cache
+from .services import merchants
+from .services.plaid_standin import FakePlaidClient, PlaidRecorder, ReplayPlaidClient
 
+
+@override_settings(ANTHROPIC_API_KEY='test-key')
 class LLMServiceTest(TestCase):
     def setUp(self):
+        cache.clear()
+        clear_response_cache()
         self.user = User.objects.create_user(username='testuser', password='testpass')
-        self.user_profile = UserProfile.objects.create(user=self.user, monthly_income=Decimal('5000.00'))
-        
         self.account = Account.objects.create(
             user=self.user,
             plaid_account_id='test_account_id',
             name='Test Checking',
             account_type='checking',
-            current_balance=Decimal('1500.00')
-        )
-        
-        self.goal = Goal.objects.create(
-            user=self.user,
-            title='Emergency Fund',
-            goal_type='emergency',
-            target_amount=Decimal('5000.00'),
-            current_amount=Decimal('1000.00')
+            balance=Decimal('1500.00')
         )
 
-    def test_build_prompt(self):
-        llm_service = LLMService()
-        prompt = llm_service.build_prompt("Can I afford a $500 vacation?", self.user)
-        
-        self.assertIn("Can I afford a $500 vacation?", prompt)
-        self.assertIn("Test Checking: $1,500.00", prompt)
-        self.assertIn("Emergency Fund", prompt)
+    def tearDown(self):
+        cache.clear()
+        clear_response_cache()
+
+    def test_build_request(self):
+        request = LLMService().build_request(self.user, "Can I afford a $500 vacation?")
+
+        self.assertIn("Can I afford a $500 vacation?", request['messages'][-1]['content'])
+        context = request['system'][-1]['text']
+        self.assertIn("Test Checking", context)
+        self.assertIn("1500.00", context)
 
     @patch('anthropic.Anthropic')
     def test_get_financial_advice(self, mock_anthropic):
@@ -58,10 +93,15 @@ class ViewsTest(TestCase):
         self.client = Client()
         self.user = User.objects.create_user(username='testuser', password='testpass')
 
+    def test_home_requires_login(self):
+        response = self.client.get(reverse('home'))
+        self.assertEqual(response.status_code, 302)  # Redirect to login
+
     def test_home_view(self):
+        self.client.login(username='testuser', password='testpass')
         response = self.client.get(reverse('home'))
         self.assertEqual(response.status_code, 200)
-        self.assertContains(response, 'Welcome to Balai')
+        self.assertTemplateUsed(response, 'core/chat_v2.html')
 
     def test_dashboard_requires_login(self):
         response = self.client.get(reverse('dashboard'))
@@ -74,6 +114,7 @@ class ViewsTest(TestCase):
 
     def test_chat_post_integration(self):
         self.client.login(username='testuser', password='testpass')
+        conversation = Conversation.objects.create(user=self.user, title='Budget')
         
         # Create some test data
         Account.objects.create(
@@ -81,54 +122,1708 @@ class ViewsTest(TestCase):
             plaid_account_id='test_account',
             name='Test Account',
             account_type='checking',
-            current_balance=Decimal('1000.00')
+            balance=Decimal('1000.00')
         )
         
         with patch('core.services.llm.LLMService.get_financial_advice') as mock_advice:
             mock_advice.return_value = "You have $1000 in your checking account."
             
-            response = self.client.post(reverse('chat'), {
-                'message': 'What is my balance?'
+            response = self.client.post(reverse('send_message', args=[conversation.id]), {
+                'content': 'What is my balance?'
             })
             
             self.assertEqual(response.status_code, 200)
             self.assertContains(response, 'What is my balance?')
             self.assertContains(response, 'You have $1000 in your checking account.')
 
+    @patch('core.services.llm.LLMService.get_financial_advice', return_value='About $200.')
+    def test_rest_follow_up_sends_earlier_turns(self, mock_advice):
+        self.client.login(username='testuser', password='testpass')
+        conversation = Conversation.objects.create(user=self.user, title='Budget')
+        Message.objects.create(conversation=conversation, role='user', content='How much did I spend on food?')
+        Message.objects.create(conversation=conversation, role='assistant', content='$450 last month.')
+
+        self.client.post(reverse('send_message', args=[conversation.id]), {'content': 'And on coffee?'})
+
+        question, user = mock_advice.call_args.args
+        self.assertEqual(question, 'And on coffee?')
+        turns = mock_advice.call_args.kwargs['history']['turns']
+        self.assertEqual([turn['content'] for turn in turns], ['How much did I spend on food?', '$450 last month.'])
+
 
 class ModelsTest(TestCase):
     def setUp(self):
         self.user = User.objects.create_user(username='testuser', password='testpass')
 
-    def test_goal_progress_percentage(self):
-        goal = Goal.objects.create(
+    def test_account_str_method(self):
+        account = Account.objects.create(
             user=self.user,
-            title='Test Goal',
-            goal_type='savings',
-            target_amount=Decimal('1000.00'),
-            current_amount=Decimal('250.00')
+            plaid_account_id='test_account',
+            name='Test Checking',
+            account_type='checking',
+            balance=Decimal('1000.00')
         )
         
-        self.assertEqual(goal.progress_percentage, 25.0)
+        self.assertEqual(str(account), 'Test Checking: $1000.00')
 
-    def test_goal_remaining_amount(self):
-        goal = Goal.objects.create(
-            user=self.user,
-            title='Test Goal',
-            goal_type='savings',
-            target_amount=Decimal('1000.00'),
-            current_amount=Decimal('250.00')
-        )
-        
-        self.assertEqual(goal.remaining_amount, Decimal('750.00'))
 
-    def test_account_str_method(self):
-        account = Account.objects.create(
+class PlaidServiceSyncTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='testpass')
+        self.account = Account.objects.create(
             user=self.user,
-            plaid_account_id='test_account',
+            plaid_account_id='acc_1',
             name='Test Checking',
             account_type='checking',
-            current_balance=Decimal('1000.00')
+            balance=Decimal('1000.00')
         )
-        
-        self.assertEqual(str(account), 'Test Checking (Checking)')
+
+    def _payload(self, transaction_id, amount='12.50', account_id='acc_1', name='Coffee'):
+        return {
+            'transaction_id': transaction_id,
+            'account_id': account_id,
+            'amount': amount,
+            'date': date(2025, 7, 1),
+            'name': name,
+            'merchant_name': 'Cafe',
+            'category': ['Food and Drink', 'Coffee Shop'],
+        }
+
+    def test_upsert_transactions_reports_inserted_updated_skipped(self):
+        service = PlaidService()
+        service.upsert_transactions(self.user, [self._payload('txn_1')])
+
+        summary = service.upsert_transactions(self.user, [
+            self._payload('txn_1', amount='20.00'),
+            self._payload('txn_2'),
+            self._payload('txn_3', account_id='unknown'),
+        ])
+
+        self.assertEqual(summary, {'inserted': 1, 'updated': 1, 'skipped': 1})
+        self.assertEqual(Transaction.objects.count(), 2)
+        self.assertEqual(Transaction.objects.get(plaid_transaction_id='txn_1').amount, Decimal('-20.00'))
+
+    def test_upsert_transactions_batches_queries(self):
+        service = PlaidService()
+        service.TRANSACTION_BATCH_SIZE = 2
+        payload = [self._payload(f'txn_{i}') for i in range(5)]
+
+        # account map + one get_or_create per category level and merchant for the whole call
+        # + (existing rows + bulk insert) per chunk, plus savepoint overhead
+        # + one rollup read and one savepointed bulk insert of new rollup rows
+        with self.assertNumQueries(1 + 3 * 4 + 3 * 2 + 2 + 4):
+            summary = service.upsert_transactions(self.user, payload)
+
+        self.assertEqual(summary['inserted'], 5)
+
+
+
+class PlaidIncrementalSyncTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='testpass')
+        Account.objects.create(user=self.user, plaid_account_id='acc_1', name='Test Checking')
+        self.token = PlaidToken.objects.create(user=self.user, access_token='access', item_id='item_1')
+
+    def _txn(self, transaction_id, amount='5.00'):
+        return {
+            'transaction_id': transaction_id,
+            'account_id': 'acc_1',
+            'amount': amount,
+            'date': date(2025, 7, 1),
+            'name': 'Groceries',
+            'category': ['Shops'],
+        }
+
+    def _page(self, cursor, has_more, added=(), modified=(), removed=()):
+        return {
+            'added': list(added),
+            'modified': list(modified),
+            'removed': [{'transaction_id': tid} for tid in removed],
+            'next_cursor': cursor,
+            'has_more': has_more,
+        }
+
+    def test_run_incremental_sync_applies_all_pages(self):
+        pages = [
+            self._page('c1', True, added=[self._txn('t1'), self._txn('t2')]),
+            self._page('c2', False, modified=[self._txn('t1', amount='9.00')], removed=['t2']),
+        ]
+        service = PlaidService()
+        with patch.object(service, 'sync_transactions_incremental', side_effect=pages) as mock_sync:
+            summary = service.run_incremental_sync(self.token)
+
+        self.assertEqual(mock_sync.call_args_list[1].args, ('access', 'c1'))
+        self.assertEqual(summary['pages'], 2)
+        self.assertEqual(summary['removed'], 1)
+        self.assertEqual(list(Transaction.objects.values_list('plaid_transaction_id', flat=True)), ['t1'])
+        self.assertEqual(Transaction.objects.get().amount, Decimal('-9.00'))
+        self.token.refresh_from_db()
+        self.assertEqual(self.token.cursor, 'c2')
+
+    def test_run_incremental_sync_keeps_committed_cursor_on_failure(self):
+        pages = [self._page('c1', True, added=[self._txn('t1')]), RuntimeError('plaid down')]
+        service = PlaidService()
+        with patch.object(service, 'sync_transactions_incremental', side_effect=pages):
+            with self.assertRaises(RuntimeError):
+                service.run_incremental_sync(self.token)
+
+        self.token.refresh_from_db()
+        self.assertEqual(self.token.cursor, 'c1')
+        self.assertEqual(Transaction.objects.count(), 1)
+
+    def test_mutation_during_pagination_restarts_from_loop_start_cursor(self):
+        self.token.cursor = 'c0'
+        self.token.save()
+        mutation = ApiException(status=400)
+        mutation.body = json.dumps({'error_code': 'TRANSACTIONS_SYNC_MUTATION_DURING_PAGINATION'})
+        pages = [
+            self._page('c1', True, added=[self._txn('t1')]),
+            mutation,
+            self._page('c1', True, added=[self._txn('t1')]),
+            self._page('c2', False, added=[self._txn('t2')]),
+        ]
+        service = PlaidService()
+        with patch.object(service, 'sync_transactions_incremental', side_effect=pages) as mock_sync:
+            service.run_incremental_sync(self.token)
+
+        self.assertEqual([call.args[1] for call in mock_sync.call_args_list], ['c0', 'c1', 'c0', 'c1'])
+        self.assertEqual(Transaction.objects.count(), 2)
+        self.token.refresh_from_db()
+        self.assertEqual(self.token.cursor, 'c2')
+
+
+class PlaidClientPoolTest(TestCase):
+    def setUp(self):
+        reset_plaid_clients()
+
+    def tearDown(self):
+        reset_plaid_clients()
+
+    @override_settings(PLAID_POOL_MAXSIZE=3, PLAID_CONNECT_TIMEOUT=1.0, PLAID_READ_TIMEOUT=2.0)
+    def test_services_share_one_pooled_client(self):
+        first = PlaidService()
+        second = PlaidService()
+
+        self.assertIs(first.client, second.client)
+        self.assertIs(first.client, get_plaid_client())
+        self.assertEqual(first.client.api_client.configuration.connection_pool_maxsize, 3)
+        self.assertEqual(first.client.api_client.request_timeout, (1.0, 2.0))
+        self.assertEqual(plaid_connection_stats(), {'requests': 0, 'new_connections': 0, 'reused_connections': 0})
+
+    def test_stats_count_reused_connections(self):
+        server = KeepAliveServer(('127.0.0.1', 0), KeepAliveHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        host, port = server.server_address
+
+        # a burst of calls through the shared client's pool rides one keep-alive connection
+        pool_manager = get_plaid_client().api_client.rest_client.pool_manager
+        for _ in range(5):
+            pool_manager.request('POST', f'http://{host}:{port}/transactions/sync', body=b'{}')
+
+        self.assertEqual(plaid_connection_stats(), {'requests': 5, 'new_connections': 1, 'reused_connections': 4})
+
+    @patch('core.tasks.PlaidService')
+    def test_item_sync_logs_connection_stats(self, mock_service):
+        from .tasks import sync_plaid_item_task
+
+        user = User.objects.create_user(username='testuser', password='testpass')
+        PlaidToken.objects.create(user=user, access_token='access-1', item_id='item-1')
+        mock_service.return_value.run_incremental_sync.return_value = {'inserted': 1}
+
+        with self.assertLogs('core.tasks', level='INFO') as logs:
+            sync_plaid_item_task('item-1')
+
+        self.assertIn("'reused_connections': 0", logs.output[-1])
+
+
+class KeepAliveServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+
+# answers every request with a small json body over a persistent http/1.1 connection
+class KeepAliveHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        body = b'{}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class PlaidOnboardingTest(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.user = User.objects.create_user(username='testuser', password='testpass')
+        self.client.login(username='testuser', password='testpass')
+
+    @patch('core.views.start_plaid_onboarding', return_value='job123')
+    def test_exchange_token_returns_job_id_immediately(self, mock_start):
+        response = self.client.post(
+            reverse('plaid_exchange_token'),
+            data='{"public_token": "public-sandbox-1"}',
+            content_type='application/json'
+        )
+
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.json(), {'success': True, 'job_id': 'job123'})
+        mock_start.assert_called_once_with(self.user.id, 'public-sandbox-1', None)
+
+    @patch('core.tasks.send_sync_progress')
+    @patch('core.tasks.PlaidService')
+    def test_exchange_task_stores_item_and_reports_progress(self, mock_service, mock_progress):
+        from .tasks import plaid_exchange_token_task
+
+        mock_service.return_value.exchange_public_token.return_value = {
+            'access_token': 'access-1', 'item_id': 'item-1'
+        }
+        plaid_exchange_token_task('job123', self.user.id, 'public-sandbox-1')
+
+        token = PlaidToken.objects.get(user=self.user)
+        self.assertEqual((token.access_token, token.item_id), ('access-1', 'item-1'))
+        self.assertEqual(
+            [c.args[2:] for c in mock_progress.call_args_list],
+            [('exchange', 'started'), ('exchange', 'done')]
+        )
+
+    @patch('core.tasks.send_sync_progress')
+    def test_backfill_task_leaves_item_with_a_cursor(self, mock_progress):
+        from .tasks import plaid_backfill_transactions_task
+
+        client = FakePlaidClient(accounts=2, transactions=150)
+        token = PlaidToken.objects.create(user=self.user, access_token='access-local', item_id='item-1')
+        service = PlaidService(client=client)
+        service.sync_accounts(self.user, 'access-local', plaid_item=token)
+
+        with patch('core.tasks.PlaidService', return_value=service):
+            summary = plaid_backfill_transactions_task.apply(args=['item-1', 'job123', self.user.id]).get()
+
+        self.assertEqual(summary['inserted'], 150)
+        token.refresh_from_db()
+        self.assertIsNotNone(token.cursor)
+        # the first webhook-driven sync after onboarding has nothing left to download
+        self.assertEqual(service.run_incremental_sync(token)['updated'], 0)
+
+    @patch('core.tasks.send_sync_progress')
+    def test_backfill_task_waits_while_transactions_are_not_ready(self, mock_progress):
+        from .tasks import plaid_backfill_transactions_task
+
+        client = NotReadyPlaidClient(not_ready_calls=2, accounts=1, transactions=40)
+        token = PlaidToken.objects.create(user=self.user, access_token='access-local', item_id='item-1')
+        service = PlaidService(client=client)
+        service.sync_accounts(self.user, 'access-local', plaid_item=token)
+
+        with patch('core.tasks.PlaidService', return_value=service):
+            summary = plaid_backfill_transactions_task.apply(args=['item-1', 'job123', self.user.id]).get()
+
+        self.assertEqual(summary['inserted'], 40)
+        statuses = [c.args[3] for c in mock_progress.call_args_list]
+        self.assertEqual(statuses, ['started', 'retrying', 'retrying', 'done'])
+
+    def test_link_token_requests_full_history_and_webhook(self):
+        client = MagicMock()
+        client.link_token_create.return_value = {'link_token': 'link-1'}
+
+        with override_settings(PLAID_WEBHOOK_URL='https://budget.example/plaid/webhook/'):
+            PlaidService(client=client).create_link_token(self.user.id)
+
+        request = client.link_token_create.call_args.args[0]
+        self.assertEqual(request.transactions.days_requested, PlaidService.LINK_DAYS_REQUESTED)
+        self.assertEqual(request.webhook, 'https://budget.example/plaid/webhook/')
+
+
+# answers /transactions/sync with plaid's empty NOT_READY page until the item's history is prepared
+class NotReadyPlaidClient(FakePlaidClient):
+    def __init__(self, not_ready_calls, **kwargs):
+        super().__init__(**kwargs)
+        self.not_ready_calls = not_ready_calls
+
+    def transactions_sync(self, request):
+        if self.not_ready_calls:
+            self.not_ready_calls -= 1
+            return {'added': [], 'modified': [], 'removed': [], 'next_cursor': '', 'has_more': False, 'transactions_update_status': 'NOT_READY'}
+        return super().transactions_sync(request)
+
+
+class PlaidBackfillTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='testpass')
+        Account.objects.create(user=self.user, plaid_account_id='acc_1', name='Test Checking')
+
+    def _txn(self, transaction_id, day):
+        return {
+            'transaction_id': transaction_id,
+            'account_id': 'acc_1',
+            'amount': '1.00',
+            'date': day,
+            'name': 'Snack',
+        }
+
+    def test_iter_transaction_pages_follows_offset_until_total(self):
+        client = MagicMock()
+        client.transactions_get.side_effect = [
+            {'transactions': [self._txn('t1', date(2025, 1, 1)), self._txn('t2', date(2025, 1, 1))], 'total_transactions': 3},
+            {'transactions': [self._txn('t3', date(2025, 1, 2))], 'total_transactions': 3},
+        ]
+        service = PlaidService(client=client)
+        service.TRANSACTIONS_PAGE_SIZE = 2
+
+        pages = list(service.iter_transaction_pages('access', date(2025, 1, 1), date(2025, 1, 31)))
+
+        self.assertEqual([len(page) for page in pages], [2, 1])
+        offsets = [c.args[0]['options']['offset'] for c in client.transactions_get.call_args_list]
+        self.assertEqual(offsets, [0, 2])
+
+    def test_backfill_fetches_every_window_and_upserts_pages(self):
+        service = PlaidService(client=MagicMock())
+        service.BACKFILL_WINDOW_DAYS = 30
+
+        def fake_pages(access_token, start_date, end_date):
+            yield [self._txn(f'txn_{start_date.isoformat()}', start_date)]
+
+        with patch.object(service, 'iter_transaction_pages', side_effect=fake_pages) as mock_pages:
+            summary = service.backfill_transactions(self.user, 'access', months=6)
+
+        windows = [c.args[1:] for c in mock_pages.call_args_list]
+        self.assertEqual(summary['windows'], len(windows))
+        self.assertEqual(summary['inserted'], len(windows))
+        self.assertEqual(Transaction.objects.count(), len(windows))
+        self.assertEqual(min(w[0] for w in windows), date.today() - timedelta(days=182))
+        self.assertEqual(max(w[1] for w in windows), date.today())
+
+    def test_backfill_raises_first_window_error(self):
+        service = PlaidService(client=MagicMock())
+
+        with patch.object(service, 'iter_transaction_pages', side_effect=RuntimeError('plaid down')):
+            with self.assertRaises(RuntimeError):
+                service.backfill_transactions(self.user, 'access')
+
+    def test_windows_after_a_failure_are_not_fetched(self):
+        client = MagicMock()
+        client.transactions_get.side_effect = RuntimeError('plaid down')
+        service = PlaidService(client=client)
+        service.BACKFILL_MAX_WORKERS = 1  # windows run one after another
+
+        with self.assertRaises(RuntimeError):
+            service.backfill_transactions(self.user, 'access')
+
+        self.assertEqual(client.transactions_get.call_count, 1)
+
+    def test_backfill_write_error_does_not_strand_fetchers(self):
+        service = PlaidService(client=MagicMock())
+
+        # far more pages than the bounded queue holds, so fetchers block unless the writer keeps draining
+        def fake_pages(access_token, start_date, end_date):
+            for index in range(50):
+                yield [self._txn(f'txn_{start_date.isoformat()}_{index}', start_date)]
+
+        with patch.object(service, 'iter_transaction_pages', side_effect=fake_pages):
+            with patch.object(service, 'upsert_transactions', side_effect=RuntimeError('database is locked')):
+                with self.assertRaises(RuntimeError):
+                    service.backfill_transactions(self.user, 'access')
+
+
+class PlaidWebhookQueueTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = Client()
+        self.user = User.objects.create_user(username='testuser', password='testpass')
+        self.token = PlaidToken.objects.create(user=self.user, access_token='access', item_id='item_1')
+
+    def _webhook(self, code='SYNC_UPDATES_AVAILABLE'):
+        return self.client.post(
+            reverse('plaid_webhook'),
+            data=json.dumps({'webhook_type': 'TRANSACTIONS', 'webhook_code': code, 'item_id': 'item_1'}),
+            content_type='application/json'
+        )
+
+    @patch('core.tasks.sync_plaid_item_task.apply_async')
+    def test_webhook_burst_schedules_one_sync(self, mock_apply):
+        for code in ['SYNC_UPDATES_AVAILABLE', 'DEFAULT_UPDATE', 'SYNC_UPDATES_AVAILABLE']:
+            self.assertEqual(self._webhook(code).json(), {'acknowledged': True})
+
+        mock_apply.assert_called_once()
+        self.assertEqual(mock_apply.call_args.kwargs['args'], ['item_1'])
+
+    @patch('core.tasks.sync_plaid_item_task.apply_async')
+    @patch('core.tasks.PlaidService')
+    def test_sync_task_reschedules_when_item_locked(self, mock_service, mock_apply):
+        from .tasks import sync_plaid_item_task
+
+        with item_sync_lock('item_1'):
+            self.assertIsNone(sync_plaid_item_task('item_1'))
+
+        mock_service.return_value.run_incremental_sync.assert_not_called()
+        mock_apply.assert_called_once()
+
+    def test_manual_sync_conflicts_with_running_sync(self):
+        self.client.login(username='testuser', password='testpass')
+
+        with item_sync_lock('item_1'):
+            response = self.client.post(reverse('plaid_sync_transactions'))
+
+        self.assertEqual(response.status_code, 409)
+
+
+class PlaidMultiItemSyncTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='testuser', password='testpass')
+        for item_id in ['item_a', 'item_b', 'item_c']:
+            PlaidToken.objects.create(user=self.user, access_token=f'access-{item_id}', item_id=item_id)
+
+    def test_sync_user_items_merges_per_item_results(self):
+        def fake_sync_item(plaid_token, stages):
+            if plaid_token.item_id == 'item_c':
+                raise RuntimeError('institution down')
+            return {'accounts': 2, 'inserted': 5, 'updated': 1}
+
+        service = PlaidService(client=MagicMock())
+        with patch.object(service, '_sync_item', side_effect=fake_sync_item) as mock_sync_item:
+            summary = service.sync_user_items(self.user, max_workers=2)
+
+        self.assertEqual(mock_sync_item.call_count, 3)
+        self.assertEqual(summary['items'], 3)
+        self.assertEqual(summary['accounts'], 4)
+        self.assertEqual(summary['inserted'], 10)
+        self.assertEqual(summary['errors'], {'item_c': 'institution down'})
+
+    def test_sync_user_items_reports_busy_items(self):
+        service = PlaidService(client=MagicMock())
+
+        with item_sync_lock('item_b'):
+            with patch.object(service, 'run_incremental_sync', return_value={
+                'inserted': 0, 'updated': 0, 'skipped': 0, 'removed': 0
+            }):
+                summary = service.sync_user_items(self.user, stages=('transactions',))
+
+        self.assertEqual(summary['busy'], ['item_b'])
+
+
+class LegacyPlaidAccountLinkTest(TestCase):
+    def test_migration_links_single_item_users_accounts(self):
+        link = importlib.import_module('core.migrations.0018_link_legacy_plaid_accounts')
+        legacy = User.objects.create_user(username='legacy', password='testpass')
+        token = PlaidToken.objects.create(user=legacy, access_token='access-1', item_id='item-1')
+        linked = Account.objects.create(user=legacy, plaid_account_id='acc-1', name='Checking')
+        manual = Account.objects.create(user=legacy, name='Cash')
+        several = User.objects.create_user(username='several', password='testpass')
+        PlaidToken.objects.create(user=several, access_token='access-2', item_id='item-2')
+        PlaidToken.objects.create(user=several, access_token='access-3', item_id='item-3')
+        ambiguous = Account.objects.create(user=several, plaid_account_id='acc-2', name='Savings')
+
+        link.link_accounts(django_apps, None)
+
+        self.assertEqual(Account.objects.get(pk=linked.pk).plaid_item_id, token.pk)
+        self.assertIsNone(Account.objects.get(pk=manual.pk).plaid_item_id)
+        self.assertIsNone(Account.objects.get(pk=ambiguous.pk).plaid_item_id)
+
+
+class PlaidBalanceRefreshTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='testpass')
+        self.token = PlaidToken.objects.create(user=self.user, access_token='access', item_id='item_1')
+        for account_id in ['acc_1', 'acc_2']:
+            Account.objects.create(user=self.user, plaid_account_id=account_id, name=account_id, plaid_item=self.token)
+        self.client_mock = MagicMock()
+        self.client_mock.accounts_balance_get.return_value = {'accounts': [
+            {'account_id': 'acc_1', 'balances': {'current': 100, 'available': 90}},
+            {'account_id': 'acc_2', 'balances': {'current': 250.5, 'available': None}},
+        ]}
+
+    def test_refresh_writes_all_balances_in_one_update(self):
+        service = PlaidService(client=self.client_mock)
+
+        # account lookup + bulk update + refreshed_at stamp
+        with self.assertNumQueries(3):
+            result = service.refresh_item_balances(self.token)
+
+        self.assertEqual(result, {'accounts': 2, 'cached': False})
+        self.assertEqual(Account.objects.get(plaid_account_id='acc_2').balance, Decimal('250.50'))
+        self.token.refresh_from_db()
+        self.assertIsNotNone(self.token.balances_refreshed_at)
+
+    @override_settings(PLAID_BALANCE_TTL_SECONDS=600)
+    def test_refresh_within_ttl_skips_plaid(self):
+        service = PlaidService(client=self.client_mock)
+        service.refresh_item_balances(self.token)
+
+        result = service.refresh_item_balances(self.token)
+
+        self.assertEqual(result, {'accounts': 2, 'cached': True})
+        self.assertEqual(self.client_mock.accounts_balance_get.call_count, 1)
+
+    def test_item_ttl_override_and_force(self):
+        self.token.balance_ttl_seconds = 0
+        service = PlaidService(client=self.client_mock)
+        service.refresh_item_balances(self.token)
+        service.refresh_item_balances(self.token)
+
+        self.token.balance_ttl_seconds = 3600
+        service.refresh_item_balances(self.token, force=True)
+
+        self.assertEqual(self.client_mock.accounts_balance_get.call_count, 3)
+
+
+class PlaidStandinTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='testpass')
+        self.token = PlaidToken.objects.create(user=self.user, access_token='access-local', item_id='item-local')
+
+    def test_full_then_delta_sync_against_standin(self):
+        client = FakePlaidClient(accounts=2, transactions=120, days=90)
+        service = PlaidService(client=client)
+        service.SYNC_PAGE_SIZE = 50
+        service.sync_accounts(self.user, 'access-local', plaid_item=self.token)
+
+        first = service.run_incremental_sync(self.token)
+        client.add_transactions(3)
+        client.modify_transactions(2)
+        client.remove_transactions(1)
+        delta = service.run_incremental_sync(self.token)
+
+        self.assertEqual((first['inserted'], first['pages']), (120, 3))
+        self.assertEqual((delta['inserted'], delta['updated'], delta['removed']), (3, 2, 1))
+        self.assertEqual(Transaction.objects.count(), len(client.transactions))
+
+    def test_recorded_payloads_replay(self):
+        recorder = PlaidRecorder(FakePlaidClient(accounts=1, transactions=10))
+        PlaidService(client=recorder).sync_accounts(self.user, 'access-local')
+        PlaidService(client=recorder).run_incremental_sync(self.token)
+        records = json.loads(json.dumps(recorder.records, default=str))
+
+        Transaction.objects.all().delete()
+        PlaidToken.objects.filter(pk=self.token.pk).update(cursor=None)
+        self.token.refresh_from_db()
+        summary = PlaidService(client=ReplayPlaidClient(records)).run_incremental_sync(self.token)
+
+        self.assertEqual(summary['inserted'], 10)
+
+
+class PlaidSyncSchedulerTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='testuser', password='testpass')
+
+    def _token(self, item_id, **fields):
+        return PlaidToken.objects.create(user=self.user, access_token=f'access-{item_id}', item_id=item_id, **fields)
+
+    @patch('core.tasks.scheduled_sync_item_task.apply_async')
+    def test_scheduler_dispatches_only_due_items_with_jitter(self, mock_apply):
+        from .tasks import schedule_plaid_syncs, item_jitter
+
+        now = timezone.now()
+        self._token('due_new')
+        self._token('due_old', next_sync_at=now - timedelta(minutes=5))
+        self._token('later', next_sync_at=now + timedelta(hours=1))
+
+        self.assertEqual(schedule_plaid_syncs(), 2)
+        self.assertEqual(schedule_plaid_syncs(), 0)  # leased until they run
+
+        dispatched = {c.kwargs['args'][0]: c.kwargs['countdown'] for c in mock_apply.call_args_list}
+        self.assertEqual(dispatched, {'due_new': item_jitter('due_new'), 'due_old': item_jitter('due_old')})
+
+    @patch('core.tasks._run_item_sync')
+    def test_stale_dispatch_is_skipped(self, mock_sync):
+        from .tasks import scheduled_sync_item_task
+
+        lease = timezone.now() + timedelta(minutes=20)
+        self._token('busy', next_sync_at=lease)
+
+        # the scheduler re-leased the item after this task was queued
+        self.assertIsNone(scheduled_sync_item_task('busy', (lease - timedelta(minutes=20)).isoformat()))
+        mock_sync.assert_not_called()
+        scheduled_sync_item_task('busy', lease.isoformat())
+        mock_sync.assert_called_once()
+
+    @patch('core.tasks._run_item_sync', side_effect=NoSlotAvailable('global'))
+    def test_saturated_sync_stops_retrying(self, mock_sync):
+        from .tasks import scheduled_sync_item_task, SCHEDULED_SYNC_MAX_RETRIES
+
+        lease = timezone.now() + timedelta(minutes=20)
+        self._token('queued', next_sync_at=lease)
+
+        result = scheduled_sync_item_task.apply(args=['queued', lease.isoformat()])
+
+        self.assertIsNone(result.get())
+        self.assertEqual(mock_sync.call_count, SCHEDULED_SYNC_MAX_RETRIES + 1)
+
+    @override_settings(PLAID_SCHEDULED_SYNC_INTERVAL=100, PLAID_SYNC_JITTER_SECONDS=0, PLAID_SYNC_MAX_BACKOFF_SECONDS=250)
+    @patch('core.tasks.PlaidService')
+    def test_failing_item_backs_off_exponentially(self, mock_service):
+        from .tasks import scheduled_sync_item_task
+
+        mock_service.return_value.run_incremental_sync.side_effect = RuntimeError('ITEM_LOGIN_REQUIRED')
+        token = self._token('broken')
+
+        delays = []
+        for _ in range(3):
+            start = timezone.now()
+            scheduled_sync_item_task('broken')
+            token.refresh_from_db()
+            delays.append(round((token.next_sync_at - start).total_seconds()))
+
+        self.assertEqual(delays, [100, 200, 250])
+        self.assertEqual(token.sync_failures, 3)
+        self.assertIn('ITEM_LOGIN_REQUIRED', token.last_sync_error)
+
+    @override_settings(PLAID_MAX_CONCURRENT_SYNCS=2, PLAID_MAX_CONCURRENT_SYNCS_PER_INSTITUTION=1)
+    def test_concurrency_caps(self):
+        with plaid_sync_slots('ins_1'):
+            with self.assertRaises(NoSlotAvailable):
+                with plaid_sync_slots('ins_1'):
+                    pass
+            with plaid_sync_slots('ins_2'):
+                with self.assertRaises(NoSlotAvailable):
+                    with plaid_sync_slots('ins_3'):
+                        pass
+        with plaid_sync_slots('ins_1'):
+            pass  # slots were released
+
+
+class CategoryInternTest(TestCase):
+    def setUp(self):
+        clear_category_cache()
+        self.user = User.objects.create_user(username='testuser', password='testpass')
+
+    def tearDown(self):
+        clear_category_cache()
+
+    def test_intern_builds_hierarchy_and_caches_ids(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            leaf_id = intern_category(['Food and Drink', 'Restaurants', 'Coffee Shop'])
+
+        leaf = Category.objects.get(pk=leaf_id)
+        self.assertEqual(leaf.path, 'Food and Drink, Restaurants, Coffee Shop')
+        self.assertEqual(leaf.parent.parent.name, 'Food and Drink')
+        with self.assertNumQueries(0):
+            self.assertEqual(intern_category('Food and Drink, Restaurants, Coffee Shop'), leaf_id)
+        self.assertIsNone(intern_category([]))
+
+    def test_backfill_migration_links_existing_rows(self):
+        backfill = importlib.import_module('core.migrations.0009_backfill_transaction_category')
+        account = Account.objects.create(user=self.user, name='Checking')
+        for category in ['Shops, Supermarkets and Groceries', 'Shops', '']:
+            Transaction.objects.create(account=account, amount=Decimal('-1.00'), description='x', date=date(2025, 1, 1), category=category)
+
+        with patch.object(backfill, 'BATCH_SIZE', 1):
+            backfill.backfill_categories(django_apps, None)
+
+        linked = dict(Transaction.objects.values_list('category', 'category_ref__path'))
+        self.assertEqual(linked, {
+            'Shops, Supermarkets and Groceries': 'Shops, Supermarkets and Groceries',
+            'Shops': 'Shops',
+            '': None,
+        })
+        self.assertEqual(Category.objects.count(), 2)
+
+
+class MerchantNormalizationTest(TestCase):
+    def setUp(self):
+        clear_merchant_cache()
+        self.user = User.objects.create_user(username='testuser', password='testpass')
+        Account.objects.create(user=self.user, plaid_account_id='acc_1', name='Test Checking')
+
+    def tearDown(self):
+        clear_merchant_cache()
+
+    def test_normalize_strips_processor_prefixes_and_store_numbers(self):
+        self.assertEqual(normalize_merchant_name('STARBUCKS #1234'), 'starbucks')
+        self.assertEqual(normalize_merchant_name('SQ *BLUE BOTTLE COFFEE'), 'blue bottle coffee')
+        self.assertEqual(normalize_merchant_name('TST* Chipotle 0423'), 'chipotle')
+        self.assertEqual(normalize_merchant_name('POS PURCHASE Whole Foods Market Store 10234'), 'whole foods market')
+        self.assertEqual(normalize_merchant_name('Amazon.com'), 'amazon')
+        self.assertEqual(normalize_merchant_name(None), '')
+
+    def test_sync_groups_spellings_under_one_merchant(self):
+        payload = [
+            {'transaction_id': 't1', 'account_id': 'acc_1', 'amount': '4.50', 'date': date(2025, 7, 1), 'name': 'STARBUCKS #1234', 'merchant_name': 'Starbucks'},
+            {'transaction_id': 't2', 'account_id': 'acc_1', 'amount': '5.25', 'date': date(2025, 7, 2), 'name': 'STARBUCKS STORE 88', 'merchant_name': None},
+            {'transaction_id': 't3', 'account_id': 'acc_1', 'amount': '60.00', 'date': date(2025, 7, 3), 'name': 'SHELL OIL 57444', 'merchant_name': None},
+        ]
+        PlaidService(client=MagicMock()).upsert_transactions(self.user, payload)
+
+        self.assertEqual(Merchant.objects.count(), 2)
+        starbucks = Merchant.objects.get(normalized_name='starbucks')
+        self.assertEqual(starbucks.name, 'Starbucks')
+        self.assertEqual(starbucks.transactions.count(), 2)
+
+    def test_lru_cache_is_bounded(self):
+        with patch('core.services.merchants.MERCHANT_CACHE_SIZE', 2):
+            for name in ['Alpha', 'Beta', 'Gamma']:
+                with self.captureOnCommitCallbacks(execute=True):
+                    intern_merchant(name)
+
+        self.assertEqual(list(merchants._merchant_ids), ['beta', 'gamma'])
+
+
+# fake anthropic message stream yielding canned text deltas
+class FakeMessageStream:
+    def __init__(self, deltas):
+        self.text_stream = iter(deltas)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def get_final_message(self):
+        return MagicMock(usage=MagicMock(input_tokens=10, output_tokens=3))
+
+    @property
+    def current_message_snapshot(self):
+        return self.get_final_message()
+
+
+# async flavour of FakeMessageStream for AsyncAnthropic
+class FakeAsyncMessageStream(FakeMessageStream):
+    def __init__(self, deltas):
+        self.deltas = deltas
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    @property
+    async def text_stream(self):
+        for delta in self.deltas:
+            yield delta
+
+
+@override_settings(ANTHROPIC_API_KEY='test-key')
+class LLMStreamingTest(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='testpass')
+        self.conversation = Conversation.objects.create(user=self.user, title='Budget')
+
+    @patch('anthropic.Anthropic')
+    def test_stream_yields_text_deltas(self, mock_anthropic):
+        mock_anthropic.return_value.messages.stream.return_value = FakeMessageStream(['You ', 'can ', 'afford it.'])
+
+        deltas = list(LLMService().stream_financial_advice('Can I afford a $500 vacation?', self.user))
+
+        self.assertEqual(deltas, ['You ', 'can ', 'afford it.'])
+        request = mock_anthropic.return_value.messages.stream.call_args.kwargs
+        self.assertEqual(request['model'], LLMService.MODEL)
+        self.assertIn('Can I afford a $500 vacation?', request['messages'][-1]['content'])
+
+    @patch('core.services.llm.get_async_client')
+    def test_consumer_streams_deltas_then_persists_reply_once(self, get_async_client):
+        get_async_client.return_value.messages.stream.return_value = FakeAsyncMessageStream(['You ', 'can ', 'afford it.'])
+
+        async def converse():
+            communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), f'/ws/chat/{self.conversation.id}/')
+            communicator.scope['user'] = self.user
+            communicator.scope['url_route'] = {'kwargs': {'conversation_id': str(self.conversation.id)}}
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            await communicator.send_json_to({'message': 'Can I afford a $500 vacation?'})
+            events = [await communicator.receive_json_from() for _ in range(5)]
+            await communicator.disconnect()
+            return events
+
+        events = async_to_sync(converse)()
+
+        self.assertEqual(events[0]['role'], 'user')
+        self.assertEqual([event['delta'] for event in events[1:4]], ['You ', 'can ', 'afford it.'])
+        done = events[4]
+        self.assertEqual(done['type'], 'chat_done')
+        self.assertEqual(done['message'], 'You can afford it.')
+        self.assertEqual({event['stream_id'] for event in events[1:]}, {done['stream_id']})
+        assistant = Message.objects.get(conversation=self.conversation, role='assistant')
+        self.assertEqual(assistant.id, done['message_id'])
+        self.assertEqual(assistant.content, 'You can afford it.')
+
+    @patch('core.services.llm.get_async_client')
+    def test_first_delta_reaches_the_sender_before_generation_finishes(self, get_async_client):
+        stream = GatedAsyncMessageStream(['You ', 'can ', 'afford it.'])
+        get_async_client.return_value.messages.stream.return_value = stream
+
+        async def converse():
+            stream.release = asyncio.Event()
+            communicator = self.connect()
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            await communicator.send_json_to({'message': 'Can I afford a $500 vacation?'})
+            await communicator.receive_json_from()
+            first = await communicator.receive_json_from()
+            finished_early = stream.finished
+            stream.release.set()
+            rest = [await communicator.receive_json_from() for _ in range(3)]
+            await communicator.disconnect()
+            return first, finished_early, rest
+
+        first, finished_early, rest = async_to_sync(converse)()
+
+        self.assertEqual(first['delta'], 'You ')
+        self.assertFalse(finished_early)
+        self.assertEqual(rest[-1]['type'], 'chat_done')
+
+    @patch('core.services.llm.get_async_client')
+    def test_superseded_inline_reply_still_counts_its_usage(self, get_async_client):
+        stream = GatedAsyncMessageStream(['You ', 'can ', 'afford it.'])
+        get_async_client.return_value.messages.stream.side_effect = [stream, FakeAsyncMessageStream(['Yes.'])]
+
+        async def converse():
+            stream.release = asyncio.Event()
+            communicator = self.connect()
+            await communicator.connect()
+            await communicator.send_json_to({'message': 'Can I afford a $500 vacation?'})
+            await communicator.receive_json_from()
+            await communicator.receive_json_from()  # first delta, then the user moves on
+            await communicator.send_json_to({'message': 'What about $300?'})
+            events = []
+            while not events or events[-1].get('type') != 'chat_done':
+                events.append(await communicator.receive_json_from())
+            await communicator.disconnect()
+            return events
+
+        events = async_to_sync(converse)()
+
+        self.assertIn('chat_cancelled', [event.get('type') for event in events])
+        self.assertEqual(LLMDailyUsage.objects.get(user=self.user).requests, 2)
+
+    @patch('core.services.llm.get_async_client')
+    def test_long_reply_reaches_other_tabs_in_batches(self, get_async_client):
+        deltas = [f'{index} ' for index in range(300)]
+        get_async_client.return_value.messages.stream.return_value = FakeAsyncMessageStream(deltas)
+
+        async def converse():
+            sender, watcher = self.connect(), self.connect()
+            await sender.connect()
+            await watcher.connect()
+            await sender.send_json_to({'message': 'Walk me through my spending.'})
+            sent = [await sender.receive_json_from(timeout=5) for _ in range(302)]
+            watched = []
+            while not watched or watched[-1].get('type') != 'chat_done':
+                watched.append(await watcher.receive_json_from(timeout=5))
+            await sender.disconnect()
+            await watcher.disconnect()
+            return sent, watched
+
+        sent, watched = async_to_sync(converse)()
+
+        self.assertEqual(sent[-1]['type'], 'chat_done')
+        self.assertEqual(watched[0]['role'], 'user')
+        streamed = ''.join(event['delta'] for event in watched if event.get('type') == 'chat_delta')
+        self.assertEqual(streamed, ''.join(deltas))
+        self.assertEqual(watched[-1]['message'], ''.join(deltas))
+        self.assertLess(len(watched), 100)
+
+    def connect(self):
+        communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), f'/ws/chat/{self.conversation.id}/')
+        communicator.scope['user'] = self.user
+        communicator.scope['url_route'] = {'kwargs': {'conversation_id': str(self.conversation.id)}}
+        return communicator
+
+
+# holds the rest of the reply back until the test releases it
+class GatedAsyncMessageStream(FakeAsyncMessageStream):
+    release = None
+    finished = False
+
+    @property
+    async def text_stream(self):
+        first, *rest = self.deltas
+        yield first
+        await self.release.wait()
+        for delta in rest:
+            yield delta
+        self.finished = True
+
+
+class FinancialContextCacheTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='testuser', password='testpass')
+        self.account = Account.objects.create(user=self.user, plaid_account_id='acc_1', name='Test Checking', balance=Decimal('1500.00'))
+
+    def tearDown(self):
+        cache.clear()
+
+    def test_context_is_reused_until_data_changes(self):
+        service = LLMService()
+        first = service.build_financial_context(self.user)
+        with self.assertNumQueries(0):
+            self.assertEqual(service.build_financial_context(self.user), first)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.account.balance = Decimal('900.00')
+            self.account.save()
+
+        self.assertEqual(json.loads(service.build_financial_context(self.user))['total_balance'], '900.00')
+
+    def test_transaction_writes_bump_the_version(self):
+        version = get_context_version(self.user.id)
+        with self.captureOnCommitCallbacks(execute=True):
+            transaction = Transaction.objects.create(account=self.account, amount=Decimal('12.00'), date=date(2025, 7, 1), description='Coffee')
+        saved_version = get_context_version(self.user.id)
+        self.assertNotEqual(saved_version, version)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            transaction.delete()
+        self.assertNotEqual(get_context_version(self.user.id), saved_version)
+
+    def test_sync_upsert_bumps_the_version(self):
+        version = get_context_version(self.user.id)
+        payload = [{'transaction_id': 't1', 'account_id': 'acc_1', 'amount': '4.50', 'date': date(2025, 7, 1), 'name': 'STARBUCKS #1234', 'merchant_name': 'Starbucks'}]
+        with self.captureOnCommitCallbacks(execute=True):
+            PlaidService(client=MagicMock()).upsert_transactions(self.user, payload)
+
+        self.assertNotEqual(get_context_version(self.user.id), version)
+
+
+class SpendingRollupTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        clear_category_cache()
+        clear_merchant_cache()
+        self.user = User.objects.create_user(username='testuser', password='testpass')
+        self.account = Account.objects.create(user=self.user, plaid_account_id='acc_1', name='Test Checking', balance=Decimal('1000.00'))
+
+    def tearDown(self):
+        cache.clear()
+        clear_category_cache()
+        clear_merchant_cache()
+
+    def snapshot(self):
+        return sorted(SpendingRollup.objects.filter(user=self.user).values_list(
+            'month', 'dimension', 'key', 'income', 'spend', 'transaction_count'
+        ))
+
+    # incremental rows must match a from-scratch rebuild
+    def assertMatchesRebuild(self):
+        incremental = self.snapshot()
+        rebuild_user_rollups(self.user.id)
+        self.assertEqual(incremental, self.snapshot())
+
+    def test_single_row_writes_update_rollups(self):
+        paycheck = Transaction.objects.create(account=self.account, amount=Decimal('2000.00'), date=date(2025, 6, 30), description='Payroll')
+        coffee = Transaction.objects.create(account=self.account, amount=Decimal('-4.50'), date=date(2025, 7, 1), description='Coffee')
+        total = SpendingRollup.objects.get(user=self.user, month=date(2025, 7, 1), dimension=SpendingRollup.TOTAL)
+        self.assertEqual((total.spend, total.transaction_count), (Decimal('4.50'), 1))
+
+        # moving a transaction to another month shifts it between rollup rows
+        coffee.date = date(2025, 6, 15)
+        coffee.amount = Decimal('-6.00')
+        coffee.save()
+        self.assertFalse(SpendingRollup.objects.filter(user=self.user, month=date(2025, 7, 1)).exists())
+        self.assertMatchesRebuild()
+
+        paycheck.delete()
+        june = SpendingRollup.objects.get(user=self.user, month=date(2025, 6, 1), dimension=SpendingRollup.TOTAL)
+        self.assertEqual((june.income, june.spend), (Decimal('0.00'), Decimal('6.00')))
+
+    def test_sync_inserts_modifications_and_removals_are_incremental(self):
+        client = FakePlaidClient(accounts=1, transactions=60, days=120, seed=3)
+        client.accounts[0]['account_id'] = 'acc_1'
+        for transaction in client.transactions.values():
+            transaction['account_id'] = 'acc_1'
+        plaid_token = PlaidToken.objects.create(user=self.user, access_token='access-local', item_id='item-local')
+        service = PlaidService(client=client)
+
+        service.run_incremental_sync(plaid_token)
+        self.assertEqual(
+            SpendingRollup.objects.filter(user=self.user, dimension=SpendingRollup.TOTAL).aggregate(count=Sum('transaction_count'))['count'],
+            60
+        )
+        self.assertMatchesRebuild()
+
+        client.modify_transactions(10)
+        client.remove_transactions(5)
+        plaid_token.refresh_from_db()
+        service.run_incremental_sync(plaid_token)
+        self.assertMatchesRebuild()
+
+    def test_context_uses_rollups_and_a_short_tail(self):
+        today = date.today()
+        for day in range(1, 21):
+            Transaction.objects.create(account=self.account, amount=Decimal('-10.00'), date=today.replace(day=1) - timedelta(days=day), description='Lunch')
+        Transaction.objects.create(account=self.account, amount=Decimal('-25.00'), date=today, description='Dinner')
+
+        context = json.loads(LLMService().build_financial_context(self.user))
+
+        self.assertEqual(len(context['recent_transactions']), LLMService.CONTEXT_RECENT_TRANSACTIONS)
+        this_month = context['monthly_cash_flow'][0]
+        self.assertEqual((this_month['spend'], this_month['end_balance']), ('25.00', '1000.00'))
+        self.assertEqual(context['monthly_cash_flow'][1]['end_balance'], '1025.00')
+        self.assertEqual(context['spending_by_category']['this_month'], [{'name': 'Uncategorized', 'spend': '25.00'}])
+
+
+@override_settings(ANTHROPIC_API_KEY='test-key')
+class PromptCachingTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='testuser', password='testpass')
+        Account.objects.create(user=self.user, name='Test Checking', balance=Decimal('1500.00'))
+
+    def tearDown(self):
+        cache.clear()
+
+    @patch('anthropic.Anthropic')
+    def test_stable_prefix_is_cacheable_and_question_goes_last(self, mock_anthropic):
+        response = MagicMock()
+        response.content = [MagicMock(text='Yes.')]
+        response.usage = MagicMock(input_tokens=12, output_tokens=3, cache_creation_input_tokens=0, cache_read_input_tokens=2100)
+        mock_anthropic.return_value.messages.create.return_value = response
+
+        service = LLMService()
+        service.get_financial_advice('Can I afford a $500 vacation?', self.user)
+        service.get_financial_advice('What about $800?', self.user)
+
+        first, second = [call.kwargs for call in mock_anthropic.return_value.messages.create.call_args_list]
+        self.assertEqual(first['system'], second['system'])
+        self.assertEqual(second['system'][-1]['cache_control'], {'type': 'ephemeral'})
+        self.assertIn('USER_CONTEXT', second['system'][-1]['text'])
+        self.assertEqual(second['messages'][-1]['content'], 'QUESTION: What about $800?')
+        self.assertEqual(service.last_usage['cache_read_input_tokens'], 2100)
+        self.assertEqual(service.last_usage['cache_creation_input_tokens'], 0)
+
+
+class ConversationHistoryTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='testuser', password='testpass')
+        self.conversation = Conversation.objects.create(user=self.user, title='Budget')
+        for index in range(10):
+            Message.objects.create(conversation=self.conversation, role='user', content=f'question {index} ' + 'x' * 200)
+            Message.objects.create(conversation=self.conversation, role='assistant', content=f'answer {index} ' + 'y' * 200)
+
+    def tearDown(self):
+        cache.clear()
+
+    @patch('core.tasks.summarize_conversation_task.delay')
+    def test_window_keeps_recent_turns_within_budget(self, delay):
+        window = conversation_window(self.conversation.id, budget=300)
+
+        # each message costs ~53 tokens, so five fit; the leading assistant turn is dropped
+        self.assertEqual([turn['role'] for turn in window['turns']], ['user', 'assistant', 'user', 'assistant'])
+        self.assertTrue(window['turns'][-1]['content'].startswith('answer 9'))
+        delay.assert_called_once_with(self.conversation.id)
+
+        # a second overflow inside the debounce window doesn't queue another refresh
+        conversation_window(self.conversation.id, budget=300)
+        delay.assert_called_once()
+
+    @override_settings(LLM_HISTORY_TOKEN_BUDGET=300)
+    def test_older_turns_fold_into_summary(self):
+        llm_service = MagicMock()
+        llm_service.summarize_conversation.side_effect = lambda summary, turns, **kwargs: f'{summary}+{len(turns)}'
+
+        with patch('core.services.history.SUMMARY_BATCH_SIZE', 8):
+            folded = summarize_older_turns(self.conversation.id, llm_service=llm_service)
+
+        self.conversation.refresh_from_db()
+        self.assertEqual(folded, 15)
+        self.assertEqual(self.conversation.summary, '+8+7')
+        with patch('core.tasks.summarize_conversation_task.delay') as delay:
+            window = conversation_window(self.conversation.id)
+        delay.assert_not_called()
+        self.assertEqual(window['summary'], '+8+7')
+
+    @override_settings(ANTHROPIC_API_KEY='test-key')
+    @patch('anthropic.Anthropic')
+    def test_history_and_summary_precede_the_question(self, mock_anthropic):
+        history = {'summary': 'Saving for a car.', 'turns': [{'role': 'user', 'content': 'hi'}, {'role': 'assistant', 'content': 'hello'}]}
+
+        request = LLMService().build_request(self.user, 'How much can I save?', history)
+
+        self.assertEqual(request['system'][-1]['text'], 'CONVERSATION_SUMMARY:\nSaving for a car.')
+        self.assertEqual([message['role'] for message in request['messages']], ['user', 'assistant', 'user'])
+        self.assertEqual(request['messages'][1]['content'][0]['cache_control'], {'type': 'ephemeral'})
+        self.assertEqual(request['messages'][-1]['content'], 'QUESTION: How much can I save?')
+
+
+# async client whose replies take a while, to check chats overlap instead of queueing on threads
+class SlowAsyncMessages:
+    def __init__(self, delay):
+        self.delay = delay
+        self.in_flight = 0
+        self.peak = 0
+
+    async def create(self, **kwargs):
+        self.in_flight += 1
+        self.peak = max(self.peak, self.in_flight)
+        await asyncio.sleep(self.delay)
+        self.in_flight -= 1
+        return MagicMock(content=[MagicMock(text='ok')], usage=MagicMock(input_tokens=1, output_tokens=1))
+
+
+@override_settings(ANTHROPIC_API_KEY='test-key')
+class AsyncLLMServiceTest(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='testuser', password='testpass')
+        account = Account.objects.create(user=self.user, name='Test Checking', balance=Decimal('1500.00'))
+        Transaction.objects.create(account=account, amount=Decimal('-4.50'), date=date.today(), description='Coffee')
+
+    def tearDown(self):
+        cache.clear()
+
+    async def test_async_context_matches_sync_context(self):
+        service = AsyncLLMService()
+        context = await service._aserialize_financial_context(self.user)
+
+        self.assertEqual(context, await sync_to_async(LLMService()._serialize_financial_context)(self.user))
+
+    async def test_client_is_shared_within_the_event_loop(self):
+        self.assertIs(AsyncLLMService().client, AsyncLLMService().client)
+
+    @override_settings(LLM_USER_MAX_IN_FLIGHT=200, LLM_MAX_IN_FLIGHT=200)
+    async def test_concurrent_chats_overlap(self):
+        messages = SlowAsyncMessages(delay=0.2)
+        # sqlite's shared in-memory test database can't take 200 concurrent writers
+        with patch('core.services.llm.get_async_client', return_value=MagicMock(messages=messages)), \
+                patch('core.services.llm.arecord_usage', AsyncMock()):
+            replies = await asyncio.gather(*[
+                AsyncLLMService().aget_financial_advice(f'question {index}', self.user) for index in range(200)
+            ])
+
+        self.assertEqual(set(replies), {'ok'})
+        # far more generations in flight at once than a sync thread pool would allow
+        self.assertGreater(messages.peak, 50)
+
+    async def test_usage_is_recorded_from_a_worker_thread(self):
+        with patch('core.services.llm.get_async_client', return_value=MagicMock(messages=SlowAsyncMessages(delay=0))):
+            await AsyncLLMService().aget_financial_advice('question', self.user)
+
+        self.assertEqual(await LLMUsageRecord.objects.filter(user=self.user).acount(), 1)
+
+
+@override_settings(ANTHROPIC_API_KEY='test-key', LLM_RESPONSE_CACHE_SIZE=2)
+class ResponseCacheTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        clear_response_cache()
+        self.user = User.objects.create_user(username='testuser', password='testpass')
+        self.account = Account.objects.create(user=self.user, name='Test Checking', balance=Decimal('1500.00'))
+
+    def tearDown(self):
+        cache.clear()
+        clear_response_cache()
+
+    def test_normalize_question(self):
+        self.assertEqual(normalize_question('Hey, how much should I save monthly?'), 'how much should i save monthly')
+        self.assertEqual(normalize_question("What's my current spending pattern?"), normalize_question('whats my current  spending pattern'))
+        self.assertEqual(normalize_question('Can I afford a $500.50 vacation?'), 'can i afford a $500.50 vacation')
+
+    @patch('anthropic.Anthropic')
+    def test_repeat_question_is_served_from_cache_until_data_changes(self, mock_anthropic):
+        response = MagicMock(content=[MagicMock(text='Save $400 a month.')])
+        mock_anthropic.return_value.messages.create.return_value = response
+        service = LLMService()
+
+        service.get_financial_advice('How much should I save monthly?', self.user)
+        self.assertEqual(service.get_financial_advice('how much should i save monthly', self.user), 'Save $400 a month.')
+        self.assertEqual(mock_anthropic.return_value.messages.create.call_count, 1)
+
+        # a follow-up in a conversation is a different prompt
+        history = {'summary': '', 'turns': [{'role': 'user', 'content': 'hi'}, {'role': 'assistant', 'content': 'hello'}]}
+        service.get_financial_advice('How much should I save monthly?', self.user, history)
+        self.assertEqual(mock_anthropic.return_value.messages.create.call_count, 2)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.account.balance = Decimal('200.00')
+            self.account.save()
+        service.get_financial_advice('How much should I save monthly?', self.user)
+        self.assertEqual(mock_anthropic.return_value.messages.create.call_count, 3)
+
+        stats = response_cache_stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['size']), (1, 3, 2))
+        self.assertEqual(stats['evictions'], 1)
+
+
+@override_settings(ANTHROPIC_API_KEY='test-key', LLM_DAILY_REQUEST_LIMIT=2, LLM_DAILY_TOKEN_LIMIT=1000, LLM_ADMISSION_WAIT_SECONDS=0)
+class LLMQuotaTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        clear_response_cache()
+        self.user = User.objects.create_user(username='testuser', password='testpass')
+
+    def tearDown(self):
+        cache.clear()
+        clear_response_cache()
+
+    @patch('anthropic.Anthropic')
+    def test_usage_is_recorded_and_request_quota_enforced(self, mock_anthropic):
+        response = MagicMock(content=[MagicMock(text='ok')])
+        response.usage = MagicMock(input_tokens=100, output_tokens=50, cache_creation_input_tokens=0, cache_read_input_tokens=2000)
+        mock_anthropic.return_value.messages.create.return_value = response
+        service = LLMService()
+
+        service.get_financial_advice('first question', self.user)
+        service.get_financial_advice('second question', self.user)
+
+        usage = LLMDailyUsage.objects.get(user=self.user)
+        self.assertEqual((usage.requests, usage.input_tokens, usage.cache_read_input_tokens), (2, 200, 4000))
+        self.assertEqual(usage.billable_tokens, 200 + 100 + 400)
+        self.assertEqual(LLMUsageRecord.objects.filter(user=self.user).count(), 2)
+        with self.assertRaises(QuotaExceeded):
+            service.get_financial_advice('third question', self.user)
+
+        # repeats are answered from the response cache without going through admission
+        self.assertEqual(service.get_financial_advice('first question', self.user), 'ok')
+        self.assertEqual(list(service.stream_financial_advice('second question', self.user)), ['ok'])
+        self.assertEqual(mock_anthropic.return_value.messages.create.call_count, 2)
+
+    @patch('anthropic.Anthropic')
+    def test_stopped_stream_still_counts_its_usage(self, mock_anthropic):
+        mock_anthropic.return_value.messages.stream.return_value = FakeMessageStream(['You ', 'can ', 'afford it.'])
+
+        replies = LLMService().stream_financial_advice('Can I afford a vacation?', self.user)
+        self.assertEqual(next(replies), 'You ')
+        replies.close()  # superseded by a newer message
+
+        usage = LLMDailyUsage.objects.get(user=self.user)
+        self.assertEqual((usage.requests, usage.input_tokens, usage.output_tokens), (1, 10, 3))
+
+    def test_summaries_count_tokens_but_not_questions(self):
+        for _ in range(3):
+            record_usage(self.user.id, {'input_tokens': 100, 'output_tokens': 20}, kind=LLMUsageRecord.SUMMARY)
+
+        usage = LLMDailyUsage.objects.get(user=self.user)
+        self.assertEqual((usage.requests, usage.input_tokens, usage.output_tokens), (0, 300, 60))
+        check_quota(self.user.id)  # still under the two-question limit
+
+    def test_token_quota_is_enforced(self):
+        LLMDailyUsage.objects.create(user=self.user, day=timezone.localdate(), requests=1, output_tokens=1000)
+        with self.assertRaises(QuotaExceeded) as raised:
+            check_quota(self.user.id)
+        self.assertGreater(raised.exception.retry_after, 0)
+
+    @override_settings(LLM_USER_MAX_IN_FLIGHT=1)
+    def test_user_over_concurrency_cap_is_rejected(self):
+        with llm_admission(self.user.id):
+            with self.assertRaises(AdmissionRejected):
+                with llm_admission(self.user.id):
+                    pass
+        # the slot is released once the first generation finishes
+        with llm_admission(self.user.id):
+            pass
+
+    @override_settings(LLM_USER_MAX_IN_FLIGHT=1)
+    def test_slot_leaked_by_a_crashed_worker_ages_out(self):
+        admission = llm_admission(self.user.id)
+        admission.__enter__()  # the worker dies without releasing its slot
+        with self.assertRaises(AdmissionRejected):
+            with llm_admission(self.user.id):
+                pass
+
+        # two slot lifetimes later the leaked count no longer blocks the user
+        later = time.time() + 2 * (settings.ANTHROPIC_TIMEOUT + 30)
+        with patch('core.services.llm_quota.time.time', return_value=later):
+            with llm_admission(self.user.id):
+                pass
+
+
+@override_settings(ANTHROPIC_API_KEY='test-key', LLM_CONVERSATION_MAX_QUEUED=2)
+class ChatDispatchTest(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        clear_response_cache()
+        self.user = User.objects.create_user(username='testuser', password='testpass')
+        self.conversation = Conversation.objects.create(user=self.user, title='Budget')
+        self.question = Message.objects.create(conversation=self.conversation, role='user', content='Can I afford a $500 vacation?')
+
+    def tearDown(self):
+        cache.clear()
+
+    def run_task(self, generation_id, stream_id='stream-1'):
+        self.group_send = AsyncMock()
+        with patch('core.tasks.get_channel_layer', return_value=MagicMock(group_send=self.group_send)):
+            return process_chat_message_async(self.conversation.id, self.user.id, self.question.id, generation_id, stream_id)
+
+    def test_queue_depth_is_limited_per_conversation(self):
+        first = start_generation(self.conversation.id)
+        second = start_generation(self.conversation.id)
+        with self.assertRaises(ConversationBusy):
+            start_generation(self.conversation.id)
+        # other conversations have their own budget
+        start_generation(self.conversation.id + 1)
+
+        finish_generation(self.conversation.id, first)
+        third = start_generation(self.conversation.id)
+        self.assertFalse(is_current_generation(self.conversation.id, second))
+        self.assertTrue(is_current_generation(self.conversation.id, third))
+
+    @patch('anthropic.Anthropic')
+    def test_generation_runs_when_the_marker_is_missing(self, mock_anthropic):
+        mock_anthropic.return_value.messages.stream.return_value = FakeMessageStream(['Yes.'])
+        generation_id = start_generation(self.conversation.id)
+        cache.delete(f'chat:generation:{self.conversation.id}')  # evicted, or a cache the worker doesn't share
+
+        result = self.run_task(generation_id)
+
+        self.assertTrue(result['success'])
+
+    def test_expired_task_frees_its_slot_and_reports_back(self):
+        generation_id = start_generation(self.conversation.id)
+        start_generation(self.conversation.id)
+        request = MagicMock(args=[self.conversation.id, self.user.id, self.question.id, generation_id, 'stream-1'])
+        group_send = AsyncMock()
+
+        with patch('core.tasks.get_channel_layer', return_value=MagicMock(group_send=group_send)):
+            task_revoked.send(sender=process_chat_message_async, request=request, terminated=False, signum=None, expired=True)
+
+        start_generation(self.conversation.id)
+        group, event = group_send.call_args.args
+        self.assertEqual(group, f'chat_{self.conversation.id}')
+        self.assertTrue(event['error'])
+
+    @patch('anthropic.Anthropic')
+    def test_task_streams_and_persists_reply(self, mock_anthropic):
+        mock_anthropic.return_value.messages.stream.return_value = FakeMessageStream(['You ', 'can ', 'afford it.'])
+        generation_id = start_generation(self.conversation.id)
+
+        result = self.run_task(generation_id)
+
+        self.assertTrue(result['success'])
+        events = [call.args[1] for call in self.group_send.call_args_list]
+        self.assertEqual([event['type'] for event in events], ['chat_delta'] * 3 + ['chat_done'])
+        self.assertEqual(events[-1]['message'], 'You can afford it.')
+        self.assertEqual(Message.objects.get(conversation=self.conversation, role='assistant').id, result['ai_message_id'])
+        # the queue slot is handed back
+        start_generation(self.conversation.id)
+        start_generation(self.conversation.id)
+
+    @patch('anthropic.Anthropic')
+    def test_superseded_generation_is_skipped(self, mock_anthropic):
+        stale = start_generation(self.conversation.id)
+        start_generation(self.conversation.id)
+
+        result = self.run_task(stale)
+
+        self.assertTrue(result['cancelled'])
+        mock_anthropic.return_value.messages.stream.assert_not_called()
+        self.assertFalse(Message.objects.filter(role='assistant').exists())
+
+    @patch('anthropic.Anthropic')
+    def test_new_message_cancels_generation_mid_stream(self, mock_anthropic):
+        def deltas():
+            yield 'You '
+            start_generation(self.conversation.id)  # the user sends another message
+            yield 'can '
+            yield 'afford it.'
+        mock_anthropic.return_value.messages.stream.return_value = FakeMessageStream(deltas())
+        generation_id = start_generation(self.conversation.id)
+
+        result = self.run_task(generation_id)
+
+        self.assertTrue(result['cancelled'])
+        events = [call.args[1] for call in self.group_send.call_args_list]
+        self.assertEqual([event['type'] for event in events], ['chat_delta', 'chat_cancelled'])
+        self.assertFalse(Message.objects.filter(role='assistant').exists())
+
+    @override_settings(LLM_CHAT_DISPATCH='celery')
+    @patch('core.consumers.process_chat_message_async.apply_async')
+    def test_consumer_enqueues_generation_in_celery_mode(self, apply_async):
+        async def converse():
+            communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), f'/ws/chat/{self.conversation.id}/')
+            communicator.scope['user'] = self.user
+            communicator.scope['url_route'] = {'kwargs': {'conversation_id': str(self.conversation.id)}}
+            await communicator.connect()
+            events = []
+            # the third message is over the per-conversation depth
+            for question in ('first', 'second', 'third'):
+                await communicator.send_json_to({'message': question})
+                events.append(await communicator.receive_json_from())
+            self.assertTrue(await communicator.receive_nothing())
+            await communicator.disconnect()
+            return events
+
+        events = async_to_sync(converse)()
+
+        self.assertEqual(apply_async.call_count, 2)
+        # the rejected message isn't kept as a turn without a reply
+        self.assertFalse(Message.objects.filter(content='third').exists())
+        conversation_id, user_id, message_id, generation_id, _ = apply_async.call_args.kwargs['args']
+        self.assertEqual((conversation_id, user_id), (self.conversation.id, self.user.id))
+        self.assertEqual(Message.objects.get(id=message_id).content, 'second')
+        self.assertTrue(is_current_generation(self.conversation.id, generation_id))
+        self.assertTrue(events[-1]['error'])
+        self.assertIsNotNone(events[-1]['retry_after'])
+        self.assertFalse(Message.objects.filter(role='assistant').exists())
+
+
+# runs a ChatConsumer in its own process, standing in for one daphne worker
+CHAT_PROCESS_SCRIPT = """
+import asyncio, json, os, sys
+import django
+django.setup()
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import User
+from core.consumers import ChatConsumer
+from core.models import Conversation
+
+# the test database only exists in the parent process
+class RemoteChatConsumer(ChatConsumer):
+    async def get_conversation(self):
+        return Conversation(id=int(self.conversation_id))
+
+async def main(conversation_id):
+    communicator = WebsocketCommunicator(RemoteChatConsumer.as_asgi(), f'/ws/chat/{conversation_id}/')
+    communicator.scope['user'] = User(id=1, username='testuser')
+    communicator.scope['url_route'] = {'kwargs': {'conversation_id': conversation_id}}
+    connected, _ = await communicator.connect()
+    print('ready' if connected else 'rejected', flush=True)
+    events = []
+    while not events or events[-1].get('type') != 'chat_done':
+        events.append(await communicator.receive_json_from(timeout=10))
+    print(json.dumps(events), flush=True)
+    await communicator.disconnect()
+
+asyncio.run(main(sys.argv[1]))
+"""
+
+
+@unittest.skipUnless(
+    importlib.util.find_spec('channels_redis') and importlib.util.find_spec('fakeredis') and importlib.util.find_spec('lupa'),
+    'needs channels-redis and fakeredis[lua]'
+)
+@override_settings(ANTHROPIC_API_KEY='test-key')
+class RedisChannelLayerTest(TransactionTestCase):
+    PROCESSES = 3
+
+    def setUp(self):
+        from fakeredis import TcpFakeServer
+        cache.clear()
+        clear_response_cache()
+        self.server = TcpFakeServer(('127.0.0.1', 0), server_type='redis')
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        host, port = self.server.server_address
+        self.redis_url = f'redis://{host}:{port}/0'
+        self.cache_url = f'rediscache://{host}:{port}/1'
+        self.user = User.objects.create_user(username='testuser', password='testpass')
+        self.conversation = Conversation.objects.create(user=self.user, title='Budget')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        cache.clear()
+
+    def start_chat_process(self):
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE='budget_bot.settings', CHANNEL_REDIS_URL=self.redis_url, CACHE_URL=self.cache_url)
+        process = subprocess.Popen(
+            [sys.executable, '-c', CHAT_PROCESS_SCRIPT, str(self.conversation.id)],
+            cwd=settings.BASE_DIR, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
+        )
+        self.addCleanup(process.kill)
+        return process
+
+    @patch('anthropic.Anthropic')
+    def test_worker_reply_reaches_every_daphne_process(self, mock_anthropic):
+        mock_anthropic.return_value.messages.stream.return_value = FakeMessageStream(['You ', 'can ', 'afford it.'])
+        question = Message.objects.create(conversation=self.conversation, role='user', content='Can I afford a $500 vacation?')
+        processes = [self.start_chat_process() for _ in range(self.PROCESSES)]
+        for process in processes:
+            ready = process.stdout.readline().strip()
+            # an empty line means the process died; show why
+            self.assertEqual(ready, 'ready', ready or process.stderr.read())
+
+        # this process plays the celery worker, publishing through the shared redis layer
+        layers = {'default': {'BACKEND': 'channels_redis.core.RedisChannelLayer', 'CONFIG': {'hosts': [self.redis_url], 'prefix': 'budget_bot'}}}
+        with override_settings(CHANNEL_LAYERS=layers, LLM_CHAT_DISPATCH='celery'):
+            generation_id = start_generation(self.conversation.id)
+            result = process_chat_message_async(self.conversation.id, self.user.id, question.id, generation_id, 'stream-1')
+        self.assertTrue(result['success'])
+
+        for process in processes:
+            events = json.loads(process.stdout.readline())
+            process.wait(timeout=10)
+            self.assertEqual([event['delta'] for event in events[:-1]], ['You ', 'can ', 'afford it.'])
+            self.assertEqual(events[-1]['message_id'], result['ai_message_id'])
+
+
+class ChatConsumerPersistenceTest(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='testpass')
+        self.conversation = Conversation.objects.create(user=self.user, title='Budget')
+
+    def connect(self, user, conversation_id):
+        async def attempt():
+            communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), f'/ws/chat/{conversation_id}/')
+            communicator.scope['user'] = user
+            communicator.scope['url_route'] = {'kwargs': {'conversation_id': str(conversation_id)}}
+            connected, _ = await communicator.connect()
+            await communicator.disconnect()
+            return connected
+        return async_to_sync(attempt)()
+
+    def test_connect_requires_conversation_owner(self):
+        other = User.objects.create_user(username='other', password='testpass')
+        self.assertTrue(self.connect(self.user, self.conversation.id))
+        self.assertFalse(self.connect(other, self.conversation.id))
+        self.assertFalse(self.connect(self.user, self.conversation.id + 1))
+
+    def test_save_message_is_one_insert_and_one_update(self):
+        consumer = ChatConsumer()
+        consumer.conversation = Conversation.objects.only('id').get(id=self.conversation.id)
+        before = Conversation.objects.get(id=self.conversation.id).updated_at
+
+        with self.assertNumQueries(2):
+            message = async_to_sync(consumer.save_message)('How much did I spend on coffee?', 'user')
+
+        conversation = Conversation.objects.get(id=self.conversation.id)
+        self.assertEqual(conversation.updated_at, message.timestamp)
+        self.assertGreater(conversation.updated_at, before)
+        self.assertEqual(conversation.title, 'Budget')
+
+
+@override_settings(CHAT_REPLAY_BUFFER_SIZE=3, CHAT_REPLAY_MAX_MESSAGES=5)
+class ChatReplayTest(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='testuser', password='testpass')
+        self.conversation = Conversation.objects.create(user=self.user, title='Budget')
+
+    def tearDown(self):
+        cache.clear()
+
+    def say(self, count):
+        messages = []
+        for index in range(count):
+            message = Message.objects.create(conversation=self.conversation, role=['user', 'assistant'][index % 2], content=f'message {index}')
+            remember_message(message)
+            messages.append(message)
+        return messages
+
+    def test_recent_gap_is_replayed_from_the_buffer(self):
+        messages = self.say(4)
+        with self.assertNumQueries(0):
+            missed = missed_messages(self.conversation.id, messages[1].id)
+        self.assertEqual([event['seq'] for event in missed], [messages[2].id, messages[3].id])
+        self.assertEqual(missed[-1]['message'], 'message 3')
+
+    @patch('core.services.llm.LLMService.get_financial_advice', return_value='Save $400 a month.')
+    def test_messages_sent_over_rest_are_replayed(self, get_financial_advice):
+        messages = self.say(2)
+        self.client.login(username='testuser', password='testpass')
+        self.client.post(reverse('send_message', args=[self.conversation.id]), {'content': 'How much should I save?'})
+
+        with self.assertNumQueries(0):
+            missed = missed_messages(self.conversation.id, messages[-1].id)
+        self.assertEqual([event['message'] for event in missed], ['How much should I save?', 'Save $400 a month.'])
+
+    def test_older_gaps_fall_back_to_the_database(self):
+        messages = self.say(6)
+        # the buffer holds the last three, so a client that saw the first message needs the database
+        with self.assertNumQueries(1):
+            missed = missed_messages(self.conversation.id, messages[0].id)
+        self.assertEqual([event['seq'] for event in missed], [message.id for message in messages[1:]])
+        # missing more than CHAT_REPLAY_MAX_MESSAGES asks the client to reload
+        self.assertIsNone(missed_messages(self.conversation.id, 0))
+
+        cache.clear()
+        self.assertEqual([event['seq'] for event in missed_messages(self.conversation.id, messages[3].id)], [messages[4].id, messages[5].id])
+
+    def test_reconnecting_socket_gets_only_missed_messages(self):
+        seen, *missed = self.say(3)
+
+        async def reconnect():
+            communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), f'/ws/chat/{self.conversation.id}/?last_seen={seen.id}')
+            communicator.scope['user'] = self.user
+            communicator.scope['url_route'] = {'kwargs': {'conversation_id': str(self.conversation.id)}}
+            await communicator.connect()
+            replay = await communicator.receive_json_from()
+            await communicator.disconnect()
+            return replay
+
+        replay = async_to_sync(reconnect)()
+
+        self.assertEqual(replay['type'], 'chat_replay')
+        self.assertFalse(replay['reset'])
+        self.assertEqual([event['message_id'] for event in replay['messages']], [message.id for message in missed])
+
+    def test_concurrent_writers_keep_the_buffer_whole(self):
+        messages = [
+            Message.objects.create(conversation=self.conversation, role='user', content=f'message {index}')
+            for index in range(12)
+        ]
+        threads = [threading.Thread(target=remember_message, args=[message]) for message in messages]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        with self.assertNumQueries(0):
+            missed = missed_messages(self.conversation.id, messages[-4].id)
+        self.assertEqual([event['seq'] for event in missed], [message.id for message in messages[-3:]])
+
+
+# same behaviour on the redis script path used in production
+@unittest.skipUnless(
+    importlib.util.find_spec('fakeredis') and importlib.util.find_spec('lupa'),
+    'needs fakeredis[lua]'
+)
+class RedisChatReplayTest(ChatReplayTest):
+    def setUp(self):
+        from fakeredis import TcpFakeServer
+        self.server = TcpFakeServer(('127.0.0.1', 0), server_type='redis')
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        host, port = self.server.server_address
+        self.enterContext(override_settings(CACHES={
+            'default': {'BACKEND': 'django.core.cache.backends.redis.RedisCache', 'LOCATION': f'redis://{host}:{port}/1'}
+        }))
+        super().setUp()
+
+    def tearDown(self):
+        super().tearDown()
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class ConversationListTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='testpass')
+        self.client.login(username='testuser', password='testpass')
+
+    def add_conversations(self, count):
+        for index in range(count):
+            conversation = Conversation.objects.create(user=self.user, title=f'Chat {index}')
+            for content in ('How much did I spend on coffee?', 'x' * 150):
+                record_message(Message.objects.create(conversation=conversation, role='user', content=content))
+
+    def list_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/conversations/')
+        self.assertEqual(response.status_code, 200)
+        return len(queries), response.json()['results']
+
+    def test_sidebar_query_count_does_not_grow_with_page_size(self):
+        self.add_conversations(2)
+        small, _ = self.list_queries()
+        self.add_conversations(10)
+        large, results = self.list_queries()
+
+        self.assertEqual(small, large)
+        self.assertEqual(len(results), 12)
+        self.assertEqual(results[0]['message_count'], 2)
+        self.assertEqual(results[0]['last_message']['content'], 'x' * 100 + '...')
+        self.assertEqual(results[0]['last_message']['role'], 'user')
+
+    def test_backfill_migration_counts_existing_messages(self):
+        backfill = importlib.import_module('core.migrations.0017_backfill_conversation_counters')
+        conversation = Conversation.objects.create(user=self.user, title='Old chat')
+        empty = Conversation.objects.create(user=self.user, title='Empty')
+        Message.objects.create(conversation=conversation, role='user', content='Can I afford a $500 vacation?')
+        reply = Message.objects.create(conversation=conversation, role='assistant', content='y' * 120)
+
+        backfill.backfill_counters(django_apps, None)
+
+        conversation.refresh_from_db()
+        self.assertEqual(conversation.message_count, 2)
+        self.assertEqual(conversation.last_message_preview, 'y' * 100 + '...')
+        self.assertEqual((conversation.last_message_role, conversation.last_message_at), ('assistant', reply.timestamp))
+        empty.refresh_from_db()
+        self.assertEqual((empty.message_count, empty.last_message_preview, empty.last_message_at), (0, '', None))
@@ -5,14 +5,17 @@ from django.contrib import messages
 from django.http import JsonResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_POST
+from django.db import transaction
 from decimal import Decimal
 import json
 
 # our models and services
-from .models import Account, Transaction, ChatMessage, PlaidToken
+from .models import Account, Transaction, ChatMessage
 from .forms import ChatForm
 from .services.llm import LLMService
 from .services.plaid import PlaidService
+from .services.rollups import rollup_batch
+from .tasks import start_plaid_onboarding, enqueue_item_sync
 
 
 # main homepage - shows modern chat interface
@@ -155,29 +158,11 @@ def plaid_exchange_token(request):
         if not public_token:
             return JsonResponse({'error': 'No public token provided'}, status=400)
         
-        plaid_service = PlaidService()
-        access_token = plaid_service.exchange_public_token(public_token)  # get permanent token
-        
-        # save access token in database
-        plaid_token, created = PlaidToken.objects.get_or_create(user=request.user)
-        plaid_token.access_token = access_token
-        plaid_token.save()
-        
-        # sync initial data from plaid
-        plaid_service.sync_accounts(request.user, access_token)  # get accounts
-        
-        # wait a moment for transactions to be ready, then try to sync
-        import time
-        time.sleep(2)
-        try:
-            plaid_service.sync_transactions(request.user, access_token)  # get transactions
-        except Exception as e:
-            # transactions might not be ready yet, that's ok
-            import logging
-            logger = logging.getLogger(__name__)
-            logger.warning(f"Transactions not ready yet: {e}")
+        # exchange, account sync and transaction backfill run in celery;
+        # progress is pushed to the dashboard over the sync websocket
+        job_id = start_plaid_onboarding(request.user.id, public_token, data.get('institution_id'))
         
-        return JsonResponse({'success': True})
+        return JsonResponse({'success': True, 'job_id': job_id}, status=202)
     except Exception as e:
         return JsonResponse({'error': str(e)}, status=500)
 
@@ -187,21 +172,19 @@ def plaid_exchange_token(request):
 @require_POST
 def plaid_update_balances(request):
     try:
-        plaid_token = PlaidToken.objects.get(user=request.user)  # get user's plaid token
         plaid_service = PlaidService()
         
-        # update balances for all user's plaid accounts
-        updated_accounts = plaid_service.update_account_balances(
-            request.user, 
-            plaid_token.access_token
-        )
+        # refresh balances across every linked bank at once
+        summary = plaid_service.sync_user_items(request.user, stages=('balances',))
+        if not summary['items']:
+            return JsonResponse({'error': 'No Plaid token found'}, status=404)
         
         return JsonResponse({
             'success': True,
-            'updated_count': len(updated_accounts)  # how many accounts updated
+            'updated_count': summary['balances'],  # how many accounts updated
+            'cached_items': summary['balances_cached'],  # items served from stored balances
+            'errors': summary['errors']
         })
-    except PlaidToken.DoesNotExist:
-        return JsonResponse({'error': 'No Plaid token found'}, status=404)
     except Exception as e:
         return JsonResponse({'error': str(e)}, status=500)
 
@@ -216,56 +199,48 @@ def plaid_webhook(request):
         webhook_code = data.get('webhook_code')  # specific event
         item_id = data.get('item_id')  # plaid item identifier
         
-        # handle transaction update webhooks
+        if not item_id:
+            return JsonResponse({'error': 'No item id provided'}, status=400)
+        
+        # handle transaction update webhooks - the sync itself runs in celery,
+        # bursts for the same item collapse into one debounced run
         if webhook_type == 'TRANSACTIONS':
             if webhook_code in ['SYNC_UPDATES_AVAILABLE', 'DEFAULT_UPDATE']:
-                # find user with this item_id and sync transactions
-                try:
-                    plaid_token = PlaidToken.objects.get(item_id=item_id)
-                    plaid_service = PlaidService()
-                    
-                    # perform incremental sync (only new/changed transactions)
-                    sync_result = plaid_service.sync_transactions_incremental(
-                        plaid_token.access_token,
-                        plaid_token.cursor  # resume from last sync point
-                    )
-                    
-                    # update cursor for next sync
-                    plaid_token.cursor = sync_result['next_cursor']
-                    plaid_token.save()
-                    
-                    # update balances after transaction sync
-                    plaid_service.update_account_balances(
-                        plaid_token.user,
-                        plaid_token.access_token
-                    )
-                    
-                except PlaidToken.DoesNotExist:
-                    pass  # token not found, ignore webhook
+                enqueue_item_sync(item_id)
         
         return JsonResponse({'acknowledged': True})  # acknowledge webhook
     except Exception as e:
-        return JsonResponse({'error': str(e)}, status=500)# manually sync transactions for testing
+        return JsonResponse({'error': str(e)}, status=500)
+
+
+# manually sync transactions for testing
 @login_required
 @require_POST
 def plaid_sync_transactions(request):
     try:
-        plaid_token = PlaidToken.objects.get(user=request.user)
         plaid_service = PlaidService()
         
-        transactions = plaid_service.sync_transactions(
-            request.user, 
-            plaid_token.access_token
-        )
+        # pulls the delta since each item's cursor, all banks in parallel;
+        # items already syncing elsewhere are skipped
+        summary = plaid_service.sync_user_items(request.user, stages=('transactions',))
+        if not summary['items']:
+            return JsonResponse({'error': 'No Plaid token found'}, status=404)
+        if len(summary['busy']) == summary['items']:
+            return JsonResponse({'error': 'A sync is already running for this bank'}, status=409)
         
         return JsonResponse({
             'success': True,
-            'synced_count': len(transactions)
+            'synced_count': summary['inserted'] + summary['updated'],
+            'inserted': summary['inserted'],
+            'updated': summary['updated'],
+            'skipped': summary['skipped'],
+            'removed': summary['removed'],
+            'errors': summary['errors']
         })
-    except PlaidToken.DoesNotExist:
-        return JsonResponse({'error': 'No Plaid token found'}, status=404)
     except Exception as e:
         return JsonResponse({'error': str(e)}, status=500)
+
+
 # delete multiple accounts
 @login_required
 @require_POST
@@ -277,11 +252,12 @@ def delete_accounts(request):
         if not account_ids:
             return JsonResponse({'error': 'No accounts selected'}, status=400)
         
-        # delete accounts that belong to the current user
-        deleted_count = Account.objects.filter(
-            id__in=account_ids,
-            user=request.user
-        ).delete()[0]
+        # delete accounts that belong to the current user, folding their transactions out of the rollups in one pass
+        with transaction.atomic(), rollup_batch():
+            deleted_count = Account.objects.filter(
+                id__in=account_ids,
+                user=request.user
+            ).delete()[0]
         
         return JsonResponse({
             'success': True,